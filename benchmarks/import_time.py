@@ -0,0 +1,108 @@
+"""
+Reports what importing each dmutils module costs a fresh interpreter - roughly what it adds to a gunicorn worker's boot
+or a test run's collection.
+
+Run from the root of the repository:
+
+    python benchmarks/import_time.py [module ...]
+
+On python 3.7+ this uses `-X importtime`, reporting each module's cumulative import time along with the slowest
+third-party imports it brought in. Older pythons just get the wall-clock time of importing it.
+"""
+from __future__ import print_function
+
+import os
+import pkgutil
+import re
+import subprocess
+import sys
+import timeit
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+REPEAT = 5
+TOP_DEPENDENCIES = 3
+
+_IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def dmutils_modules():
+    sys.path.insert(0, REPO_ROOT)
+    import dmutils
+
+    yield "dmutils"
+    for _, name, _ in pkgutil.walk_packages(dmutils.__path__, "dmutils."):
+        yield name
+
+
+def _run(args):
+    process = subprocess.Popen(
+        [sys.executable] + args,
+        cwd=REPO_ROOT,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    _, stderr = process.communicate()
+    return process.returncode, stderr
+
+
+def import_times(module):
+    """
+        Returns the cumulative microseconds `module` took to import (the best of REPEAT runs), and the slowest
+        non-dmutils modules imported directly or indirectly on its behalf in that run
+    """
+    best = None
+    for _ in range(REPEAT):
+        returncode, stderr = _run(["-X", "importtime", "-c", "import {}".format(module)])
+        if returncode != 0:
+            raise ImportError(stderr.strip().splitlines()[-1])
+
+        timings = {}
+        for line in stderr.splitlines():
+            match = _IMPORTTIME_LINE.match(line)
+            if match:
+                timings[match.group(4)] = int(match.group(2))
+
+        if best is None or timings[module] < best[0]:
+            dependencies = sorted(
+                (
+                    (cumulative, name) for name, cumulative in timings.items()
+                    if "." not in name and name != "dmutils"
+                ),
+                reverse=True,
+            )
+            best = timings[module], dependencies[:TOP_DEPENDENCIES]
+
+    return best
+
+
+def wall_clock_time(module):
+    """Microseconds for a fresh interpreter to import `module`, less what one importing nothing takes"""
+    def time_python(statement):
+        return min(timeit.repeat(lambda: _run(["-c", statement]), number=1, repeat=REPEAT))
+
+    returncode, stderr = _run(["-c", "import {}".format(module)])
+    if returncode != 0:
+        raise ImportError(stderr.strip().splitlines()[-1])
+    return int((time_python("import {}".format(module)) - time_python("pass")) * 1e6)
+
+
+def main(modules):
+    has_importtime = sys.version_info >= (3, 7)
+    for module in modules or dmutils_modules():
+        try:
+            if has_importtime:
+                cumulative, dependencies = import_times(module)
+                print("{:<40} {:8.1f}ms   {}".format(
+                    module,
+                    cumulative / 1000.,
+                    ", ".join("{} {:.1f}ms".format(name, time / 1000.) for time, name in dependencies),
+                ))
+            else:
+                print("{:<40} {:8.1f}ms".format(module, wall_clock_time(module) / 1000.))
+        except ImportError as e:
+            print("{:<40} failed to import: {}".format(module, e))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
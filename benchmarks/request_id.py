@@ -0,0 +1,54 @@
+"""
+Measures the cost of generating ids and of reading a request's trace, span and parent span ids the way every request
+handled (and every onwards api call it makes) does.
+
+Run from the root of the repository:
+
+    python benchmarks/request_id.py
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from flask import Flask, request  # noqa
+from dmutils.request_id import generate_span_id, generate_trace_id, init_app  # noqa
+
+ITERATIONS = 100000
+
+
+def time_per_call(fn, iterations=ITERATIONS):
+    return min(timeit.repeat(fn, number=iterations, repeat=5)) / iterations
+
+
+def main():
+    for description, fn in (
+        ("str(uuid.uuid4().hex)", lambda: str(uuid.uuid4().hex)),
+        ("generate_trace_id()", generate_trace_id),
+        ("generate_trace_id(64)", lambda: generate_trace_id(64)),
+        ("generate_span_id()", generate_span_id),
+    ):
+        print("{:<30} {:8.2f}us".format(description, time_per_call(fn) * 1e6))
+
+    app = Flask(__name__)
+    init_app(app)
+    for description, headers in (
+        ("ids from request headers", {"X-B3-TraceId": "d15ea5e5deadbeefbaadf00dabadcafe", "X-B3-SpanId": "abc"}),
+        ("trace id generated", {}),
+    ):
+        environ = app.test_request_context(headers=headers).request.environ
+
+        def read_ids():
+            req = app.request_class(dict(environ))
+            return (req.trace_id, req.span_id, req.parent_span_id, req.get_onwards_request_headers())
+
+        with app.app_context():
+            print("{:<30} {:8.2f}us per request".format(description, time_per_call(read_ids, ITERATIONS // 10) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
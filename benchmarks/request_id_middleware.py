@@ -0,0 +1,57 @@
+"""
+Measures the per-request overhead ResponseHeaderMiddleware adds to a WSGI app.
+
+Run from the root of the repository:
+
+    python benchmarks/request_id_middleware.py
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from dmutils.request_id import ResponseHeaderMiddleware  # noqa
+
+ITERATIONS = 100000
+TRACE_ID_HEADERS = ("DM-Request-ID", "X-B3-TraceId")
+
+
+def bare_app(environ, start_response):
+    start_response("200 OK", [
+        ("Content-Type", "text/html; charset=utf-8"),
+        ("Content-Length", "0"),
+        ("X-Frame-Options", "DENY"),
+    ])
+    return [b""]
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def time_per_request(app, environ):
+    return min(timeit.repeat(
+        lambda: app(dict(environ), start_response),
+        number=ITERATIONS,
+        repeat=5,
+    )) / ITERATIONS
+
+
+def main():
+    middleware = ResponseHeaderMiddleware(bare_app, TRACE_ID_HEADERS)
+    scenarios = (
+        ("trace id in request header", {"HTTP_X_B3_TRACEID": "d15ea5e5deadbeefbaadf00dabadcafe"}),
+        ("trace id already resolved", {"dmutils.trace_id": "d15ea5e5deadbeefbaadf00dabadcafe"}),
+        ("trace id generated", {}),
+    )
+    for description, environ in scenarios:
+        baseline = time_per_request(bare_app, environ)
+        wrapped = time_per_request(middleware, environ)
+        print("{:<30} {:8.2f}us per request overhead".format(description, (wrapped - baseline) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
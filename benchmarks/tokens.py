@@ -0,0 +1,81 @@
+"""
+Measures how many tokens a second `dmutils.email.tokens` can generate and decode, against deriving the key and
+building a Fernet for every token as it used to, and decrypting expired invitation tokens twice to get at their data.
+Also compares decoding a token encrypted with the oldest of several rotated keys by its key id, against trying each key
+in turn as tokens from before they had key ids are.
+
+Run from the root of the repository:
+
+    python benchmarks/tokens.py
+"""
+from __future__ import print_function
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from cryptography import fernet  # noqa
+from flask import Flask  # noqa
+from freezegun import freeze_time  # noqa
+from dmutils.email.helpers import hash_string  # noqa
+from dmutils.email.tokens import decode_invitation_token, decode_token, generate_token  # noqa
+
+ITERATIONS = 2000
+SECRET_KEY = "Key"
+ROTATED_KEYS = ["Newest key", "Newer key", SECRET_KEY]
+NAMESPACE = "Salt"
+DATA = {"email_address": "test-user@example.com", "supplier_id": 1234, "role": "supplier"}
+
+
+def tokens_per_second(fn, iterations=ITERATIONS):
+    return iterations / min(timeit.repeat(fn, number=iterations, repeat=5))
+
+
+def uncached_generate_token(json_data, secret_key, namespace):
+    f = fernet.Fernet(hash_string(secret_key + namespace).encode('utf-8'))
+    return f.encrypt(json.dumps(json_data).encode('utf-8')).decode('utf-8')
+
+
+def uncached_decode_token(encrypted_data, secret_key, namespace, max_age_in_seconds):
+    f = fernet.Fernet(hash_string(secret_key + namespace).encode('utf-8'))
+    return json.loads(f.decrypt(encrypted_data.encode('utf-8'), ttl=max_age_in_seconds).decode('utf-8'))
+
+
+def decrypt_expired_token_twice(token):
+    try:
+        return uncached_decode_token(token, SECRET_KEY, NAMESPACE, 7 * 86400)
+    except fernet.InvalidToken:
+        return uncached_decode_token(token, SECRET_KEY, NAMESPACE, None)
+
+
+def main():
+    token = generate_token(DATA, SECRET_KEY, NAMESPACE)
+    # as generated before tokens had key ids, and as the uncached functions above expect them
+    legacy_token = token.split(".")[1]
+    with freeze_time("2015-01-01"):
+        expired_token = generate_token(DATA, SECRET_KEY, NAMESPACE)
+
+    app = Flask(__name__)
+    app.config.update({"SHARED_EMAIL_KEY": SECRET_KEY, "INVITE_EMAIL_SALT": NAMESPACE})
+    # so that we're timing decoding rather than logging that it's expired
+    app.logger.disabled = True
+
+    with app.app_context():
+        for description, fn in (
+            ("generate (uncached Fernet)", lambda: uncached_generate_token(DATA, SECRET_KEY, NAMESPACE)),
+            ("generate_token", lambda: generate_token(DATA, SECRET_KEY, NAMESPACE)),
+            ("decode (uncached Fernet)", lambda: uncached_decode_token(legacy_token, SECRET_KEY, NAMESPACE, 86400)),
+            ("decode_token", lambda: decode_token(token, SECRET_KEY, NAMESPACE)),
+            ("expired invitation (2 decrypts)", lambda: decrypt_expired_token_twice(expired_token.split(".")[1])),
+            ("decode_invitation_token expired", lambda: decode_invitation_token(expired_token)),
+            ("oldest of 3 keys, by key id", lambda: decode_token(token, ROTATED_KEYS, NAMESPACE)),
+            ("oldest of 3 keys, no key id", lambda: decode_token(legacy_token, ROTATED_KEYS, NAMESPACE)),
+        ):
+            print("{:<34} {:10.0f} tokens/s".format(description, tokens_per_second(fn)))
+
+
+if __name__ == "__main__":
+    main()
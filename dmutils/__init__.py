@@ -1,7 +1,45 @@
-from . import config, formats, logging, proxy_fix, request_id
-from .flask_init import init_app, init_manager
+import sys
 
-import flask_featureflags  # noqa
 
+__version__ = '37.0.14'
 
-__version__ = '34.5.0'
+
+# what `dmutils` makes available as attributes, and where from. on pythons supporting module `__getattr__` (PEP 562,
+# 3.7+) these are only imported when first used, so that apps importing e.g. `dmutils.s3` don't pay for flask_init and
+# everything it pulls in. older pythons import them all up front as they always did.
+_LAZY_ATTRIBUTES = {
+    "config": ("dmutils.config", None),
+    "formats": ("dmutils.formats", None),
+    "logging": ("dmutils.logging", None),
+    "proxy_fix": ("dmutils.proxy_fix", None),
+    "request_id": ("dmutils.request_id", None),
+    "init_app": ("dmutils.flask_init", "init_app"),
+    "init_manager": ("dmutils.flask_init", "init_manager"),
+}
+
+
+def _lazy_getattr(module_name, lazy_attributes, name):
+    """A module `__getattr__` importing `name` from wherever `lazy_attributes` says it lives"""
+    try:
+        source_module_name, attribute_name = lazy_attributes[name]
+    except KeyError:
+        raise AttributeError("module {!r} has no attribute {!r}".format(module_name, name))
+
+    __import__(source_module_name)
+    value = sys.modules[source_module_name]
+    if attribute_name is not None:
+        value = getattr(value, attribute_name)
+    # so we aren't asked again
+    setattr(sys.modules[module_name], name, value)
+    return value
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        return _lazy_getattr(__name__, _LAZY_ATTRIBUTES, name)
+
+    def __dir__():
+        return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
+else:
+    from . import config, formats, logging, proxy_fix, request_id
+    from .flask_init import init_app, init_manager
@@ -1,5 +1,98 @@
+"""
+    Fingerprinting static assets, so that the URLs they're served from change whenever their contents do.
+
+    Rather than each worker hashing assets as they're first asked for, generate a manifest of every asset's fingerprint
+    when building the app's assets:
+
+        python -m dmutils.asset_fingerprint app/static/ app/static/asset-manifest.json
+
+    and give its path to the `AssetFingerprinter`, which then never needs to read the assets themselves.
+
+    How the fingerprinter caches fingerprints depends on its `cache_mode`:
+
+    * CACHE_PRECOMPUTED (the default given a manifest) - fingerprints come from the manifest, which is never changed
+      once loaded, so looking them up needs no locking
+    * CACHE_LAZY (the default otherwise) - assets are fingerprinted when first asked for, and up to `max_cache_size`
+      of their fingerprints kept
+    * CACHE_STAT - as CACHE_LAZY, but also checking each asset's modification time and size at most every
+      `stat_interval` seconds and fingerprinting it again if they've changed, for development
+"""
+from __future__ import absolute_import, print_function
+
+from collections import OrderedDict
 import hashlib
-import codecs
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import sys
+import threading
+
+from monotonic import monotonic
+
+from . import file_watcher
+from .prometheus import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_CHUNK_SIZE = 64 * 1024
+
+CACHE_LAZY = "lazy"
+CACHE_STAT = "stat"
+CACHE_PRECOMPUTED = "precomputed"
+
+_cache_lookups = REGISTRY.counter(
+    "asset_fingerprint_cache_lookups_total", "Asset fingerprint lookups, by whether they were cached", ("result",),
+)
+_cache_hits = _cache_lookups.labels(result="hit")
+_cache_misses = _cache_lookups.labels(result="miss")
+_fingerprint_duration = REGISTRY.histogram(
+    "asset_fingerprint_duration_seconds", "Time taken to fingerprint assets not already cached",
+)
+
+
+def _new_hash():
+    # blake2b is quicker than md5 on 64-bit machines, but only available from python 3.6
+    if hasattr(hashlib, "blake2b"):
+        return hashlib.blake2b(digest_size=16)
+    return hashlib.md5()
+
+
+def hash_asset_file(asset_file_path, chunk_size=MANIFEST_CHUNK_SIZE):
+    """The fingerprint of the raw bytes of `asset_file_path`, read `chunk_size` bytes at a time"""
+    file_hash = _new_hash()
+    with open(asset_file_path, "rb") as asset_file:
+        for chunk in iter(lambda: asset_file.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def generate_manifest(filesystem_path, manifest_path=None, exclude=file_watcher.DEFAULT_EXCLUDE, threads=4):
+    """
+        Fingerprint every file below `filesystem_path` (apart from those matching `exclude` - see
+        `dmutils.file_watcher`), `threads` at a time, returning a dict of their paths relative to `filesystem_path` to
+        their fingerprints, and writing it to `manifest_path` as JSON if given.
+    """
+    asset_file_paths = list(file_watcher.iter_files([filesystem_path], exclude=exclude))
+    pool = ThreadPool(threads)
+    try:
+        fingerprints = pool.map(hash_asset_file, asset_file_paths)
+    finally:
+        pool.close()
+
+    manifest = dict(
+        (os.path.relpath(asset_file_path, filesystem_path).replace(os.sep, "/"), fingerprint)
+        for asset_file_path, fingerprint in zip(asset_file_paths, fingerprints)
+    )
+    if manifest_path is not None:
+        with open(manifest_path, "w") as manifest_file:
+            json.dump({"fingerprints": manifest}, manifest_file, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(manifest_path):
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)["fingerprints"]
 
 
 class AssetFingerprinter():
@@ -11,36 +104,117 @@ class AssetFingerprinter():
 
             Config.py:
             base_template_data.asset_fingerprinter = AssetFingerprinter(
-                asset_root='/suppliers/static/'
+                asset_root='/suppliers/static/',
+                manifest_path='app/static/asset-manifest.json'
             )
 
             _base_template.html:
             {{ asset_fingerprinter.get_url('stylesheets/application.css') }}
 
         * 'app/static' is assumed to be the root for all asset files
+        * assets not in the manifest (or all of them, without one) are
+          fingerprinted when first asked for
+        * cache_mode is one of CACHE_PRECOMPUTED, CACHE_LAZY or CACHE_STAT
+          (see above), a manifest only being used with CACHE_PRECOMPUTED
     """
 
-    def __init__(self, asset_root='/static/', filesystem_path='app/static/'):
-        self._cache = {}
+    def __init__(self, asset_root='/static/', filesystem_path='app/static/', manifest_path=None, cache_mode=None,
+                 max_cache_size=1000, stat_interval=1):
+        if cache_mode is None:
+            cache_mode = CACHE_LAZY if manifest_path is None else CACHE_PRECOMPUTED
+        if cache_mode not in (CACHE_LAZY, CACHE_STAT, CACHE_PRECOMPUTED):
+            raise ValueError("Unknown cache mode {}".format(cache_mode))
+        if (cache_mode == CACHE_PRECOMPUTED) != (manifest_path is not None):
+            raise ValueError("A manifest must be given with, and only with, the {} cache mode".format(
+                CACHE_PRECOMPUTED
+            ))
+
+        self._cache_mode = cache_mode
+        self._max_cache_size = max_cache_size
+        self._stat_interval = stat_interval
         self._asset_root = asset_root
         self._filesystem_path = filesystem_path
+        # asset path -> url, for assets fingerprinted as they're asked for, oldest first
+        self._cache = OrderedDict()
+        # asset path -> ((modification time, size), when to next check them), in CACHE_STAT mode
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._precomputed = {}
+        if manifest_path is not None:
+            self._precomputed = dict(
+                (asset_path, self._asset_root + asset_path + '?' + fingerprint)
+                for asset_path, fingerprint in load_manifest(manifest_path).items()
+            )
 
     def get_url(self, asset_path):
-        if asset_path not in self._cache:
-            self._cache[asset_path] = (
-                self._asset_root +
-                asset_path +
-                '?' +
-                self.get_asset_fingerprint(self._filesystem_path + asset_path)
-            )
-        return self._cache[asset_path]
+        url = self._precomputed.get(asset_path) or self._cache.get(asset_path)
+        if url is not None and not (self._cache_mode == CACHE_STAT and self._is_stale(asset_path)):
+            _cache_hits.inc()
+            return url
+
+        _cache_misses.inc()
+        if self._cache_mode == CACHE_PRECOMPUTED:
+            logger.warning("Asset {asset_path} is not in the manifest", extra={'asset_path': asset_path})
+        return self._fingerprint(asset_path)
+
+    def _fingerprint(self, asset_path):
+        asset_file_path = self._filesystem_path + asset_path
+        # taken before reading the file, so that a change made while we read it is noticed next time
+        stat_signature = self._stat_signature(asset_file_path) if self._cache_mode == CACHE_STAT else None
+
+        start = monotonic()
+        url = self._asset_root + asset_path + '?' + self.get_asset_fingerprint(asset_file_path)
+        _fingerprint_duration.observe(monotonic() - start)
+
+        # two threads fingerprinting the same asset at once would come up with the same url, so only changing the
+        # cache needs the lock
+        with self._lock:
+            self._cache.pop(asset_path, None)
+            self._cache[asset_path] = url
+            if stat_signature is not None:
+                self._stats[asset_path] = (stat_signature, monotonic() + self._stat_interval)
+            while len(self._cache) > self._max_cache_size:
+                evicted_path, _ = self._cache.popitem(last=False)
+                self._stats.pop(evicted_path, None)
+        return url
+
+    def _is_stale(self, asset_path):
+        stat_signature, next_check = self._stats.get(asset_path, (None, 0))
+        now = monotonic()
+        if now < next_check:
+            return False
+        current_signature = self._stat_signature(self._filesystem_path + asset_path)
+        self._stats[asset_path] = (current_signature, now + self._stat_interval)
+        return current_signature is None or current_signature != stat_signature
+
+    @staticmethod
+    def _stat_signature(asset_file_path):
+        try:
+            stat = os.stat(asset_file_path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
 
     def get_asset_fingerprint(self, asset_file_path):
-        return hashlib.md5(
-            self.get_asset_file_contents(asset_file_path).encode('utf-8')
-        ).hexdigest()
+        # as the manifest does, so that an asset's url doesn't depend on whether it's in it
+        return hash_asset_file(asset_file_path)
 
     def get_asset_file_contents(self, asset_file_path):
-        with codecs.open(asset_file_path, encoding='utf-8') as asset_file:
+        # read as bytes, so that binary assets such as fonts and images can be fingerprinted too
+        with open(asset_file_path, 'rb') as asset_file:
             contents = asset_file.read()
         return contents
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        print("Usage: python -m dmutils.asset_fingerprint <static files directory> <manifest path>", file=sys.stderr)
+        return 2
+    manifest = generate_manifest(argv[0], argv[1])
+    print("Fingerprinted {} assets".format(len(manifest)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,21 +1,158 @@
 import os
 
-from flask._compat import string_types
+from flask import current_app
+from flask._compat import integer_types, string_types
 
 
 def init_app(app):
-    for key, value in app.config.items():
-        if key in os.environ:
-            if isinstance(value, bool):
-                app.config[key] = _convert_to_boolean_or_fail(key, os.environ[key])
-            elif isinstance(value, int):
-                app.config[key] = _convert_to_int_or_fail(key, os.environ[key])
-            else:
-                app.config[key] = os.environ[key]
+    schema = _get_schema(app)
+    # only the (usually few) keys present in both need looking at
+    for key in [key for key in app.config if key in os.environ]:
+        if key in schema:
+            app.config[key] = schema[key].from_environ(key, os.environ[key])
+            continue
+        value = app.config[key]
+        if isinstance(value, bool):
+            app.config[key] = _convert_to_boolean_or_fail(key, os.environ[key])
+        elif isinstance(value, int):
+            app.config[key] = _convert_to_int_or_fail(key, os.environ[key])
+        else:
+            app.config[key] = os.environ[key]
     app.config['DM_ENVIRONMENT'] = os.environ.get('DM_ENVIRONMENT',
                                                   'development')
 
 
+class Setting(object):
+    """
+        The declaration of a setting: its type - one of bool, int, float, str or tuple (of strings, given in the
+        environment comma-separated) - and its default. A default of None makes the setting optional.
+    """
+
+    def __init__(self, type_, default=None):
+        if type_ not in _CONVERTERS:
+            raise ValueError("Settings must be one of {}".format(", ".join(t.__name__ for t in _CONVERTERS)))
+        self.type = type_
+        self.default = default
+
+    def from_environ(self, key, value):
+        return self.validate(key, _ENVIRON_PARSERS.get(self.type, lambda key, value: value)(key, value))
+
+    def validate(self, key, value):
+        """`value` as this setting's type, raising ValueError if it isn't one"""
+        if value is None and self.default is None:
+            return None
+        return _CONVERTERS[self.type](key, value)
+
+
+def declare_settings(app, settings):
+    """
+        Declare the settings in dict `settings` of names to `Setting`s, setting defaults for any the app doesn't have
+        and taking any values given in the environment, then checking the value of each is of the right type.
+    """
+    schema = _get_schema(app)
+    for key, setting in settings.items():
+        schema[key] = setting
+        if key in os.environ:
+            app.config[key] = setting.from_environ(key, os.environ[key])
+        else:
+            app.config[key] = setting.validate(key, app.config.get(key, setting.default))
+    app.extensions.pop('dmutils_config_snapshot', None)
+
+
+def freeze_config(app):
+    """
+        Check every declared setting once more - in case anything's changed them since they were declared - and return
+        a `ConfigSnapshot` of them, which `get_config_snapshot` will go on returning
+    """
+    snapshot = app.extensions['dmutils_config_snapshot'] = ConfigSnapshot(
+        (key, setting.validate(key, app.config.get(key))) for key, setting in _get_schema(app).items()
+    )
+    return snapshot
+
+
+def get_config_snapshot(app=None):
+    """The app's `ConfigSnapshot`, frozen the first time it's asked for if `freeze_config` hasn't already been run"""
+    app = app or current_app
+    return app.extensions.get('dmutils_config_snapshot') or freeze_config(app)
+
+
+class ConfigSnapshot(object):
+    """The values of an app's declared settings as they were when frozen, read by attribute or item, and read-only"""
+
+    __slots__ = ("_values",)
+
+    def __init__(self, items):
+        object.__setattr__(self, "_values", dict(items))
+
+    def __getattr__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __setattr__(self, key, value):
+        raise AttributeError("ConfigSnapshot is read-only")
+
+    def __repr__(self):
+        return "ConfigSnapshot({!r})".format(self._values)
+
+
+def _get_schema(app):
+    return app.extensions.setdefault('dmutils_config_schema', {})
+
+
+def _validate_bool(key, value):
+    if not isinstance(value, bool):
+        raise ValueError("{} must be boolean".format(key))
+    return value
+
+
+def _validate_int(key, value):
+    if isinstance(value, bool) or not isinstance(value, integer_types):
+        raise ValueError("{} must be an integer".format(key))
+    return value
+
+
+def _validate_float(key, value):
+    if isinstance(value, bool) or not isinstance(value, integer_types + (float,)):
+        raise ValueError("{} must be a number".format(key))
+    return float(value)
+
+
+def _validate_str(key, value):
+    if not isinstance(value, string_types):
+        raise ValueError("{} must be a string".format(key))
+    return value
+
+
+def _validate_tuple(key, value):
+    if isinstance(value, string_types) or not isinstance(value, (list, tuple)):
+        raise ValueError("{} must be a list or tuple".format(key))
+    return tuple(value)
+
+
+_CONVERTERS = {
+    bool: _validate_bool,
+    int: _validate_int,
+    float: _validate_float,
+    str: _validate_str,
+    tuple: _validate_tuple,
+}
+
+_ENVIRON_PARSERS = {
+    bool: lambda key, value: _convert_to_boolean_or_fail(key, value),
+    int: lambda key, value: _convert_to_int_or_fail(key, value),
+    float: lambda key, value: convert_to_number(value),
+    tuple: lambda key, value: tuple(item.strip() for item in value.split(",") if item.strip()),
+}
+
+
 def _convert_to_boolean_or_fail(key, value):
     result = convert_to_boolean(value)
     if not isinstance(result, bool):
@@ -1,7 +1,30 @@
-from dmutils.email.tokens import (
-    generate_token, decode_invitation_token, decode_password_reset_token
-)
+import sys
 
-from .exceptions import EmailError
-from .dm_notify import DMNotifyClient
-from .user_account_email import send_user_account_email
+from dmutils import _lazy_getattr
+
+# imported on first use on pythons supporting module `__getattr__`, so that e.g. `dmutils.email.tokens` doesn't bring
+# the Notify client along with it - see `dmutils._LAZY_ATTRIBUTES`
+_LAZY_ATTRIBUTES = {
+    "generate_token": ("dmutils.email.tokens", "generate_token"),
+    "decode_invitation_token": ("dmutils.email.tokens", "decode_invitation_token"),
+    "decode_password_reset_token": ("dmutils.email.tokens", "decode_password_reset_token"),
+    "EmailError": ("dmutils.email.exceptions", "EmailError"),
+    "DMNotifyClient": ("dmutils.email.dm_notify", "DMNotifyClient"),
+    "get_notify_client": ("dmutils.email.dm_notify", "get_notify_client"),
+    "send_user_account_email": ("dmutils.email.user_account_email", "send_user_account_email"),
+}
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        return _lazy_getattr(__name__, _LAZY_ATTRIBUTES, name)
+
+    def __dir__():
+        return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
+else:
+    from dmutils.email.tokens import (
+        generate_token, decode_invitation_token, decode_password_reset_token
+    )
+
+    from .exceptions import EmailError
+    from .dm_notify import DMNotifyClient, get_notify_client
+    from .user_account_email import send_user_account_email
@@ -0,0 +1,404 @@
+"""
+    asyncio versions of the email clients, for scripts sending to (or subscribing) thousands of email addresses, which
+    spend nearly all of their time waiting on Notify, Mailchimp or Mandrill. Python 3 only, and needs aiohttp.
+
+    Usage:
+
+        async def send_reminders(api_key, batch):
+            async with AsyncDMNotifyClient(api_key, concurrency=20) as notify_client:
+                return await notify_client.send_emails(batch, allow_resend=False)
+
+        loop.run_until_complete(send_reminders(api_key, batch))
+
+    A client never has more than `concurrency` requests in flight at once, and reads batches only as fast as it can
+    send them, so a generator of emails is never read far ahead of what's been sent.
+
+    References, hashing, retry policies and the handling of errors are shared with the synchronous clients.
+"""
+import asyncio
+import base64
+import json
+
+import aiohttp
+from monotonic import monotonic
+from flask import current_app
+from notifications_python_client.authentication import create_jwt_token
+
+from .dm_mailchimp import DMMailChimpClient, handle_subscribe_error, PAGINATION_SIZE
+from .dm_notify import (
+    DMNotifyClient, FAILED, iter_batch_emails, NOTIFY_BASE_URL, NOTIFY_RATE_LIMIT, SendResult, SENT,
+    SKIPPED, summarise_batch,
+)
+from .exceptions import EmailError
+from .helpers import hash_string, mandrill_message
+from .retry import CircuitOpenError, RetryPolicy
+
+MANDRILL_BASE_URL = "https://mandrillapp.com/api/1.0"
+
+
+class AsyncHTTPError(Exception):
+    """
+        A request failing, with `message` as a list of dicts of `error` and `message` as Notify gives them (so that
+        `DMNotifyClient.get_error_message` can format them), and `detail` being Mailchimp's explanation if any
+    """
+
+    def __init__(self, status_code, message, detail=""):
+        super().__init__("{} - {}".format(status_code, message))
+        self.status_code = status_code
+        self.message = message
+        self.detail = detail
+
+
+class AsyncTokenBucket(object):
+    """As `dmutils.email.helpers.TokenBucket`, but waiting for tokens without blocking the event loop"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = None
+
+    async def acquire(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            now = loop.time()
+            if self._updated is not None:
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+async def call_with_retries(retry_policy, fn, *args, on_retry=None, **kwargs):
+    """As `retry_policy.wrap(fn, on_retry)(*args, **kwargs)`, awaiting `fn` and waiting without blocking the loop"""
+    started = monotonic()
+    retried = 0
+    while True:
+        retry_policy.before_attempt()
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception as e:
+            delay = retry_policy.record_failure(e, retried, started)
+            if delay is None:
+                raise
+            if on_retry is not None:
+                on_retry(e, delay)
+            await asyncio.sleep(delay)
+            retried += 1
+            continue
+        retry_policy.record_success()
+        return result
+
+
+async def map_bounded(fn, items, concurrency):
+    """
+        The results of awaiting `fn(item)` for each of `items`, in order, with no more than `concurrency` running at
+        once. Items are only taken from `items` as there's room for them.
+    """
+    results = {}
+    items = enumerate(items)
+
+    async def worker():
+        # the workers share the one iterator, each taking the next item as it finishes with the last
+        for i, item in items:
+            results[i] = await fn(item)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return [results[i] for i in range(len(results))]
+
+
+class _AsyncHTTPClient(object):
+    """
+        The connection pool, concurrency limit and error handling of the clients below, which can be used as async
+        context managers to have the pool closed when done with
+    """
+
+    provider = "http"
+
+    def __init__(self, base_url, concurrency=10, session=None, retry_policy=None):
+        self.base_url = base_url.rstrip("/")
+        self.concurrency = concurrency
+        self.retry_policy = retry_policy or RetryPolicy(self.provider)
+        self._session = session
+        self._owns_session = session is None
+        self._semaphore = None
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency))
+        return self._session
+
+    def _request_kwargs(self):
+        return {}
+
+    async def _request(self, method, path, **kwargs):
+        # created here rather than in __init__ so that it belongs to the loop we're running in
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        kwargs.update(self._request_kwargs())
+        async with self._semaphore:
+            try:
+                async with self._get_session().request(method, self.base_url + path, **kwargs) as response:
+                    text = await response.text()
+                    status = response.status
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # as the synchronous Notify client, a request failing without a response at all counts as a 503
+                raise AsyncHTTPError(503, [{"error": type(e).__name__, "message": str(e) or "Request failed"}])
+
+        try:
+            data = json.loads(text) if text else None
+        except ValueError:
+            data = None
+        if status >= 400:
+            raise self._error(status, data, text)
+        return data
+
+    async def _retrying_request(self, method, path, **kwargs):
+        return await call_with_retries(self.retry_policy, self._request, method, path, **kwargs)
+
+    @staticmethod
+    def _error(status, data, text):
+        data = data if isinstance(data, dict) else {}
+        errors = data.get("errors") or [{"error": data.get("title", "HTTPError"), "message": data.get("detail", text)}]
+        return AsyncHTTPError(status, errors, data.get("detail", ""))
+
+    async def close(self):
+        if self._session is not None and self._owns_session:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+class AsyncDMNotifyClient(_AsyncHTTPClient):
+    """As `DMNotifyClient`, with `concurrency` requests at most in flight at once, and at most `rate_limit` a second"""
+
+    provider = "notify"
+
+    def __init__(
+            self,
+            govuk_notify_api_key,
+            govuk_notify_base_url=NOTIFY_BASE_URL,
+            logger=None,
+            concurrency=10,
+            rate_limit=NOTIFY_RATE_LIMIT,
+            session=None,
+            retry_policy=None,
+    ):
+        super().__init__(govuk_notify_base_url, concurrency, session, retry_policy)
+        self.logger = logger or current_app.logger
+        self.service_id = govuk_notify_api_key[-73:-37]
+        self.api_key = govuk_notify_api_key[-36:]
+        self._bucket = AsyncTokenBucket(rate_limit)
+        self._sent_references_cache = None
+        self._newest_synced_id = None
+
+    def _request_kwargs(self):
+        return {"headers": {"Authorization": "Bearer {}".format(create_jwt_token(self.api_key, self.service_id))}}
+
+    async def iter_delivered_notifications(self, newer_than=None):
+        """As `DMNotifyClient.iter_delivered_notifications`"""
+        older_than = None
+        while True:
+            params = {"status": "delivered"}
+            if older_than:
+                params["older_than"] = older_than
+            page = await self._retrying_request("GET", "/v2/notifications", params=params)
+            for notification in page["notifications"]:
+                if notification["id"] == newer_than:
+                    return
+                yield notification
+
+            if not page["notifications"] or "next" not in page.get("links", {}):
+                return
+            if page["notifications"][-1]["id"] == older_than:
+                return
+            older_than = page["notifications"][-1]["id"]
+
+    async def get_delivered_references(self, invalidate_cache=False):
+        """As `DMNotifyClient.get_delivered_references`, but without a database to keep them in"""
+        if invalidate_cache or self._sent_references_cache is None:
+            references, newest_id = set(), None
+            async for notification in self.iter_delivered_notifications(newer_than=self._newest_synced_id):
+                newest_id = newest_id or notification["id"]
+                if notification["reference"]:
+                    references.add(notification["reference"])
+
+            self._newest_synced_id = newest_id or self._newest_synced_id
+            self._sent_references_cache = (self._sent_references_cache or set()) | references
+        return self._sent_references_cache
+
+    async def has_been_sent(self, reference):
+        return reference in await self.get_delivered_references()
+
+    async def _send_email_notification(self, email_address, template_id, personalisation, reference):
+        await self._bucket.acquire()
+        data = {"email_address": email_address, "template_id": template_id, "reference": reference}
+        if personalisation:
+            data["personalisation"] = personalisation
+        response = await self._request("POST", "/v2/notifications/email", json=data)
+        if self._sent_references_cache is not None:
+            self._sent_references_cache.add(reference)
+        return response
+
+    async def send_email(self, email_address, template_id, personalisation=None, allow_resend=True, reference=None):
+        """As `DMNotifyClient.send_email`"""
+        reference = reference or DMNotifyClient.get_reference(email_address, template_id, personalisation)
+        if not allow_resend and await self.has_been_sent(reference):
+            self.logger.info(
+                "Email {reference} (template {template_id}) has already been sent to {email_address} through Notify",
+                extra=dict(email_address=hash_string(email_address), template_id=template_id, reference=reference),
+            )
+            return
+        try:
+            response = await call_with_retries(
+                self.retry_policy, self._send_email_notification, email_address, template_id, personalisation, reference
+            )
+        except AsyncHTTPError as e:
+            self.logger.error(DMNotifyClient.get_error_message(hash_string(email_address), e))
+            raise EmailError(str(e))
+        except CircuitOpenError as e:
+            self.logger.error(DMNotifyClient.get_error_message(hash_string(email_address), e))
+            raise
+        self.logger.info(
+            "Sent email {reference} to {email_address} (id: {notify_id}, template: {template_id}) through Notify",
+            extra=dict(
+                email_address=hash_string(email_address),
+                notify_id=response['id'],
+                template_id=template_id,
+                reference=reference,
+            ),
+        )
+        return response
+
+    async def _send_with_retries(self, email, retry_policy):
+        email_address, template_id, personalisation, reference = email
+        retries = []
+        try:
+            response = await call_with_retries(
+                retry_policy,
+                self._send_email_notification,
+                email_address,
+                template_id,
+                personalisation,
+                reference,
+                on_retry=lambda error, delay: retries.append(error),
+            )
+        except (AsyncHTTPError, CircuitOpenError) as e:
+            self.logger.error(DMNotifyClient.get_error_message(hash_string(email_address), e))
+            return SendResult(email_address, reference, FAILED, None, e, len(retries))
+        return SendResult(email_address, reference, SENT, response, None, len(retries))
+
+    async def send_emails(self, batch, allow_resend=True, max_retries=3, retry_backoff=1):
+        """As `DMNotifyClient.send_emails`, reading from `batch` only as fast as its emails can be sent"""
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        if not allow_resend:
+            await self.get_delivered_references()
+        seen_references = set()
+        retry_policy = self.retry_policy.replace(max_attempts=1 + max_retries, backoff=retry_backoff)
+
+        async def send(email):
+            if not allow_resend:
+                reference = email[3]
+                if reference in seen_references or reference in self._sent_references_cache:
+                    return SendResult(email[0], reference, SKIPPED, None, None, 0)
+                seen_references.add(reference)
+            return await self._send_with_retries(email, retry_policy)
+
+        results = await map_bounded(send, iter_batch_emails(batch), self.concurrency)
+        return summarise_batch(results, loop.time() - start, self.logger)
+
+
+class AsyncDMMailChimpClient(_AsyncHTTPClient):
+    """As `DMMailChimpClient`'s list methods, with `concurrency` requests at most in flight at once"""
+
+    provider = "mailchimp"
+
+    def __init__(
+            self,
+            mailchimp_username,
+            mailchimp_api_key,
+            logger,
+            concurrency=10,
+            base_url=None,
+            session=None,
+            retry_policy=None,
+    ):
+        # api keys end with the data centre the account's in
+        base_url = base_url or "https://{}.api.mailchimp.com/3.0".format(mailchimp_api_key.split("-")[-1])
+        super().__init__(base_url, concurrency, session, retry_policy)
+        self.logger = logger
+        self._authorization = "Basic {}".format(
+            base64.b64encode("{}:{}".format(mailchimp_username, mailchimp_api_key).encode("utf-8")).decode("ascii")
+        )
+
+    def _request_kwargs(self):
+        return {"headers": {"Authorization": self._authorization}}
+
+    async def subscribe_new_email_to_list(self, list_id, email_address):
+        """As `DMMailChimpClient.subscribe_new_email_to_list`"""
+        hashed_email = DMMailChimpClient.get_email_hash(email_address)
+        try:
+            return await self._retrying_request(
+                "PUT",
+                "/lists/{}/members/{}".format(list_id, hashed_email),
+                json={"email_address": email_address, "status_if_new": "subscribed"},
+            )
+        except AsyncHTTPError as e:
+            return handle_subscribe_error(self.logger, list_id, hashed_email, e.detail, e)
+        except CircuitOpenError as e:
+            return handle_subscribe_error(self.logger, list_id, hashed_email, "", e)
+
+    async def subscribe_new_emails_to_list(self, list_id, email_addresses):
+        """As `DMMailChimpClient.subscribe_new_emails_to_list`, subscribing `concurrency` addresses at a time"""
+        results = await map_bounded(
+            lambda email_address: self.subscribe_new_email_to_list(list_id, email_address),
+            email_addresses,
+            self.concurrency,
+        )
+        return all(results)
+
+    async def get_email_addresses_from_list(self, list_id, pagination_size=PAGINATION_SIZE):
+        email_addresses = []
+        offset = 0
+        while True:
+            member_data = await self._retrying_request(
+                "GET", "/lists/{}/members".format(list_id), params={"count": pagination_size, "offset": offset}
+            )
+            if not member_data.get("members"):
+                break
+            offset += pagination_size
+            email_addresses.extend(member["email_address"] for member in member_data["members"])
+        return email_addresses
+
+
+async def send_mandrill_email(to_email_addresses, email_body, api_key, subject, from_email, from_name, tags,
+                              reply_to=None, metadata=None, logger=None, session=None, base_url=MANDRILL_BASE_URL,
+                              retry_policy=None):
+    """As `dmutils.email.dm_mandrill.send_email`"""
+    logger = logger or current_app.logger
+    if isinstance(to_email_addresses, str):
+        to_email_addresses = [to_email_addresses]
+
+    message = mandrill_message(
+        to_email_addresses, email_body, subject, from_email, from_name, tags, reply_to=reply_to, metadata=metadata
+    )
+    # Mandrill's own errors all come with a 500
+    retry_policy = retry_policy or RetryPolicy("mandrill", retry_statuses=(429, 502, 503, 504))
+    async with _AsyncHTTPClient(base_url, session=session, retry_policy=retry_policy) as client:
+        try:
+            result = await client._retrying_request(
+                "POST", "/messages/send.json", json={"key": api_key, "message": message, "async": True}
+            )
+        except AsyncHTTPError as e:
+            logger.error("Failed to send an email: {error}", extra={'error': e})
+            raise EmailError(e)
+    logger.info("Sent {tags} response: id={id}, email={email_hash}",
+                extra={'tags': tags, 'id': result[0]['_id'], 'email_hash': hash_string(result[0]['email'])})
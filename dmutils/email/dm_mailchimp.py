@@ -3,13 +3,54 @@
 
 import six
 
+from collections import deque
 from hashlib import md5
-from requests.exceptions import RequestException, HTTPError
+from multiprocessing.pool import ThreadPool
+import requests
+from requests.exceptions import RequestException
 
 from mailchimp3 import MailChimp
+from mailchimp3.helpers import check_email
+
+from dmutils.email.retry import CircuitBreaker, CircuitOpenError, RetryPolicy
+from dmutils.trace_context import wrap_with_context
 
 PAGINATION_SIZE = 1000
 
+# the most members Mailchimp will take in one batch subscribe
+BATCH_SUBSCRIBE_SIZE = 500
+
+FAKE_OR_INVALID_EMAIL_DETAIL = "looks fake or invalid, please enter a real email address."
+ALREADY_A_MEMBER_DETAIL = "is already a list member"
+
+
+def handle_subscribe_error(logger, list_id, hashed_email, detail, error):
+    """
+    Log a failure to subscribe an email address to a list, where Mailchimp's explanation of it was `detail`, returning
+    whether it's one we can carry on regardless of.
+    """
+    # As defined in mailchimp API documentation, this particular error message may arise if a user has requested
+    # mailchimp to never add them to mailchimp lists. In this case, we resort to allowing a failed API call (but
+    # log) as a user of this method would unlikely be able to do anything as we have no control over this
+    # behaviour.
+    if FAKE_OR_INVALID_EMAIL_DETAIL in detail:
+        logger.error(
+            "Expected error: Mailchimp failed to add user ({}) to list ({}). API error: The email address looks fake or invalid, please enter a real email address.".format(  # noqa
+                hashed_email,
+                list_id
+            ),
+            extra={"error": str(error)}
+        )
+        return True
+    logger.error(
+        "Mailchimp failed to add user ({}) to list ({})".format(
+            hashed_email,
+            list_id
+        ),
+        extra={"error": str(error)}
+    )
+    return False
+
 
 class DMMailChimpClient(object):
 
@@ -18,11 +59,22 @@ class DMMailChimpClient(object):
         mailchimp_username,
         mailchimp_api_key,
         logger,
-        retries=0
+        retries=0,
+        retry_backoff=1,
     ):
         self._client = MailChimp(mailchimp_username, mailchimp_api_key)
         self.logger = logger
         self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.retry_policy = RetryPolicy(
+            "mailchimp",
+            max_attempts=1 + retries,
+            backoff=retry_backoff,
+            retry_exceptions=(requests.ConnectionError, requests.Timeout),
+            # a client that doesn't retry has a breaker of its own that never opens, rather than tripping (or being
+            # rejected by) the one shared by those that do
+            circuit_breaker=None if retries else CircuitBreaker("mailchimp", failure_threshold=float("inf")),
+        )
 
     @staticmethod
     def get_email_hash(email_address):
@@ -31,24 +83,17 @@ class DMMailChimpClient(object):
         return md5(formatted_email_address).hexdigest()
 
     def timeout_retry(self, method):
-        def wrapper(*args, **kwargs):
-            for i in range(1 + self.retries):
-                try:
-                    return method(*args, **kwargs)
-                except HTTPError as e:
-                    exception = e
-                    if exception.response.status_code == 504:
-                        continue
-                    raise exception
-            raise exception
-
-        return wrapper
+        """
+        `method`, retried up to `retries` times if it times out, fails to connect, is rate limited or fails with a
+        server error - see `dmutils.email.retry`
+        """
+        return self.retry_policy.wrap(method)
 
     def create_campaign(self, campaign_data):
         try:
-            campaign = self._client.campaigns.create(campaign_data)
+            campaign = self.timeout_retry(self._client.campaigns.create)(campaign_data)
             return campaign['id']
-        except RequestException as e:
+        except (RequestException, CircuitOpenError) as e:
             self.logger.error(
                 "Mailchimp failed to create campaign for '{0}'".format(
                     campaign_data.get("settings").get("title")
@@ -59,8 +104,8 @@ class DMMailChimpClient(object):
 
     def set_campaign_content(self, campaign_id, content_data):
         try:
-            return self._client.campaigns.content.update(campaign_id, content_data)
-        except RequestException as e:
+            return self.timeout_retry(self._client.campaigns.content.update)(campaign_id, content_data)
+        except (RequestException, CircuitOpenError) as e:
             self.logger.error(
                 "Mailchimp failed to set content for campaign id '{0}'".format(campaign_id),
                 extra={"error": str(e)}
@@ -69,9 +114,9 @@ class DMMailChimpClient(object):
 
     def send_campaign(self, campaign_id):
         try:
-            self._client.campaigns.actions.send(campaign_id)
+            self.timeout_retry(self._client.campaigns.actions.send)(campaign_id)
             return True
-        except RequestException as e:
+        except (RequestException, CircuitOpenError) as e:
             self.logger.error(
                 "Mailchimp failed to send campaign id '{0}'".format(campaign_id),
                 extra={"error": str(e)}
@@ -82,7 +127,7 @@ class DMMailChimpClient(object):
         """ Will subscribe email address to list if they do not already exist in that list else do nothing"""
         hashed_email = self.get_email_hash(email_address)
         try:
-            return self._client.lists.members.create_or_update(
+            return self.timeout_retry(self._client.lists.members.create_or_update)(
                 list_id,
                 hashed_email,
                 {
@@ -91,34 +136,57 @@ class DMMailChimpClient(object):
                 }
             )
         except RequestException as e:
-            # As defined in mailchimp API documentation, this particular error message may arise if a user has requested
-            # mailchimp to never add them to mailchimp lists. In this case, we resort to allowing a failed API call (but
-            # log) as a user of this method would unlikely be able to do anything as we have no control over this
-            # behaviour.
-            if getattr(e, "response", None) is not None and (
-                "looks fake or invalid, please enter a real email address." in e.response.json().get("detail", "")
-            ):
-                self.logger.error(
-                    "Expected error: Mailchimp failed to add user ({}) to list ({}). API error: The email address looks fake or invalid, please enter a real email address.".format(  # noqa
-                        hashed_email,
-                        list_id
-                    ),
-                    extra={"error": str(e)}
-                )
-                return True
+            detail = e.response.json().get("detail", "") if getattr(e, "response", None) is not None else ""
+            return handle_subscribe_error(self.logger, list_id, hashed_email, detail, e)
+        except CircuitOpenError as e:
+            return handle_subscribe_error(self.logger, list_id, hashed_email, "", e)
+
+    def subscribe_new_emails_to_list(self, list_id, email_addresses, batch_size=BATCH_SUBSCRIBE_SIZE):
+        """
+        Subscribe email addresses to list if they do not already exist in that list, `batch_size` at a time through
+        Mailchimp's batch subscribe endpoint, returning False if any couldn't be (other than for expected reasons)
+        """
+        email_addresses = list(email_addresses)
+        success = True
+        for start in range(0, len(email_addresses), batch_size):
+            if not self._batch_subscribe(list_id, email_addresses[start:start + batch_size]):
+                success = False
+        return success
+
+    def _batch_subscribe(self, list_id, email_addresses):
+        success = True
+        members = []
+        for email_address in email_addresses:
+            try:
+                check_email(email_address)
+            except ValueError as e:
+                # the client would refuse to send the whole batch because of it
+                handle_subscribe_error(self.logger, list_id, self.get_email_hash(email_address), str(e), e)
+                success = False
+                continue
+            members.append({"email_address": email_address, "status_if_new": "subscribed"})
+        if not members:
+            return success
+
+        try:
+            response = self.timeout_retry(
+                self._client.lists.update_members
+            )(list_id, {"members": members, "update_existing": False})
+        except (RequestException, CircuitOpenError) as e:
             self.logger.error(
-                "Mailchimp failed to add user ({}) to list ({})".format(
-                    hashed_email,
-                    list_id
-                ),
+                "Mailchimp failed to add {} users to list ({})".format(len(members), list_id),
                 extra={"error": str(e)}
             )
             return False
 
-    def subscribe_new_emails_to_list(self, list_id, email_addresses):
-        success = True
-        for email_address in email_addresses:
-            if not self.subscribe_new_email_to_list(list_id, email_address):
+        for error in response.get("errors", []):
+            # as with create_or_update's status_if_new, members already in the list are left as they are
+            if ALREADY_A_MEMBER_DETAIL in error.get("error", ""):
+                continue
+            if not handle_subscribe_error(
+                self.logger, list_id, self.get_email_hash(error["email_address"]), error.get("error", ""),
+                error.get("error"),
+            ):
                 success = False
         return success
 
@@ -135,3 +203,40 @@ class DMMailChimpClient(object):
             email_addresses.extend(member["email_address"] for member in member_data["members"])
 
         return email_addresses
+
+    def iter_email_addresses_from_list(self, list_id, pagination_size=PAGINATION_SIZE, prefetch=4):
+        """
+        The email addresses in a list, yielded as each page of them arrives. Only the addresses (and the list's size)
+        are requested, and once the first page has given the size, up to `prefetch` of the pages after the one being
+        yielded from are fetched concurrently.
+
+        Members added to or removed from the list while it's being read may be missed, or given twice.
+        """
+        fetch_page = self.timeout_retry(self._client.lists.members.all)
+
+        # run in the pool's threads, so that anything logged fetching a page is tagged with the caller's trace id
+        @wrap_with_context
+        def get_page(offset):
+            return fetch_page(
+                list_id, count=pagination_size, offset=offset, fields="members.email_address,total_items"
+            ).get("members") or []
+
+        first_page = fetch_page(list_id, count=pagination_size, offset=0, fields="members.email_address,total_items")
+        for member in first_page.get("members") or []:
+            yield member["email_address"]
+
+        offsets = iter(range(pagination_size, first_page.get("total_items", 0), pagination_size))
+        pool = ThreadPool(prefetch)
+        try:
+            # zip takes from range first, so that no offset is taken from offsets without being fetched
+            pending = deque(pool.apply_async(get_page, (offset,)) for _, offset in zip(range(prefetch), offsets))
+            while pending:
+                members = pending.popleft().get()
+                for offset in offsets:
+                    pending.append(pool.apply_async(get_page, (offset,)))
+                    break
+                for member in members:
+                    yield member["email_address"]
+        finally:
+            # if we've been abandoned part way through, don't wait for pages no one wants
+            pool.terminate()
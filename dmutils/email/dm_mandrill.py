@@ -1,49 +1,128 @@
 # -*- coding: utf-8 -*-
 """Digital Marketplace Mandrill integration."""
+from collections import Counter
+from multiprocessing.pool import ThreadPool
+import threading
+
 from flask import current_app
 from flask._compat import string_types
 
-from mandrill import Mandrill, Error
+from mandrill import Mandrill, Error, ServiceUnavailableError
+from monotonic import monotonic
+import requests
+
 from dmutils.email.exceptions import EmailError
-from dmutils.email.helpers import hash_string
+from dmutils.email.helpers import hash_string, mandrill_message
+from dmutils.email.retry import RetryPolicy
+from dmutils.fork_hooks import register_after_fork
+from dmutils.trace_context import wrap_with_context
+
+# Mandrill's errors don't say what status they came with, so only those saying it's down (or not reached at all) are
+# worth retrying
+RETRY_EXCEPTIONS = (ServiceUnavailableError, requests.ConnectionError, requests.Timeout)
+
+# recipients per message when sending to many at once - bigger messages take Mandrill longer to accept, and mean more
+# to send again if one fails
+BATCH_SIZE = 500
+
+# api key -> the Mandrill client for it, each with its own pool of kept-alive connections
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_mandrill_client(api_key):
+    """The Mandrill client for `api_key`, shared by every send using it in this process"""
+    client = _clients.get(api_key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(api_key)
+            if client is None:
+                client = _clients[api_key] = Mandrill(api_key)
+    return client
+
+
+@register_after_fork
+def _reset_after_fork():
+    # the parent's pooled connections mustn't be used by the child too
+    global _clients_lock
+    _clients_lock = threading.Lock()
+    _clients.clear()
+
+
+def _send_message(api_key, message, retry_policy):
+    return retry_policy.call(get_mandrill_client(api_key).messages.send, message=message, async=True)
 
 
 def send_email(to_email_addresses, email_body, api_key, subject, from_email, from_name, tags, reply_to=None,
-               metadata=None, logger=None):
+               metadata=None, logger=None, retry_policy=None):
     logger = logger or current_app.logger
+    retry_policy = retry_policy or RetryPolicy("mandrill", retry_exceptions=RETRY_EXCEPTIONS)
 
     if isinstance(to_email_addresses, string_types):
         to_email_addresses = [to_email_addresses]
 
     try:
-        mandrill_client = Mandrill(api_key)
-
-        message = {
-            'html': email_body,
-            'subject': subject,
-            'from_email': from_email,
-            'from_name': from_name,
-            'to': [{
-                'email': email_address,
-                'type': 'to'
-            } for email_address in to_email_addresses],
-            'important': False,
-            'track_opens': False,
-            'track_clicks': False,
-            'auto_text': True,
-            'tags': tags,
-            'metadata': metadata,
-            'headers': {'Reply-To': reply_to or from_email},
-            'preserve_recipients': False,
-            'recipient_metadata': [{
-                'rcpt': email_address
-            } for email_address in to_email_addresses]
-        }
-
-        result = mandrill_client.messages.send(message=message, async=True)
-    except Error as e:
+        message = mandrill_message(
+            to_email_addresses, email_body, subject, from_email, from_name, tags, reply_to=reply_to, metadata=metadata
+        )
+
+        result = _send_message(api_key, message, retry_policy)
+    except (Error, requests.RequestException) as e:
         # Mandrill errors are thrown as exceptions
         logger.error("Failed to send an email: {error}", extra={'error': e})
         raise EmailError(e)
     logger.info("Sent {tags} response: id={id}, email={email_hash}",
                 extra={'tags': tags, 'id': result[0]['_id'], 'email_hash': hash_string(result[0]['email'])})
+
+
+def send_emails(to_email_addresses, email_body, api_key, subject, from_email, from_name, tags, reply_to=None,
+                metadata=None, logger=None, retry_policy=None, batch_size=BATCH_SIZE, max_workers=4):
+    """
+    As `send_email`, for any number of recipients: sends messages to `batch_size` of them at a time, `max_workers` at
+    once, and returns Mandrill's results for every recipient.
+
+    Only one record is logged for the whole send. If any message couldn't be sent, `EmailError` is raised once the
+    rest have been.
+    """
+    logger = logger or current_app.logger
+    retry_policy = retry_policy or RetryPolicy("mandrill", retry_exceptions=RETRY_EXCEPTIONS)
+    if isinstance(to_email_addresses, string_types):
+        to_email_addresses = [to_email_addresses]
+    to_email_addresses = list(to_email_addresses)
+
+    def send_batch(batch_addresses):
+        message = mandrill_message(
+            batch_addresses, email_body, subject, from_email, from_name, tags, reply_to=reply_to, metadata=metadata
+        )
+        try:
+            return _send_message(api_key, message, retry_policy), None
+        except (Error, requests.RequestException, EmailError) as e:
+            return [], e
+
+    start = monotonic()
+    batches = [to_email_addresses[i:i + batch_size] for i in range(0, len(to_email_addresses), batch_size)]
+    pool = ThreadPool(max_workers)
+    try:
+        batch_results = pool.map(wrap_with_context(send_batch), batches, chunksize=1)
+    finally:
+        pool.close()
+
+    results = [result for batch_result, _ in batch_results for result in batch_result]
+    errors = [error for _, error in batch_results if error is not None]
+    statuses = Counter(result.get('status') for result in results)
+    log_extra = {
+        'tags': tags,
+        'recipients': len(to_email_addresses),
+        'batches': len(batches),
+        'failed_batches': len(errors),
+        'statuses': dict(statuses),
+        'elapsed': round(monotonic() - start, 3),
+    }
+    if errors:
+        logger.error(
+            "Failed to send {failed_batches} of {batches} batches of {tags} emails: {error}",
+            extra=dict(log_extra, error=errors[0]),
+        )
+        raise EmailError(errors[0])
+    logger.info("Sent {tags} to {recipients} recipients in {batches} batches in {elapsed}s", extra=log_extra)
+    return results
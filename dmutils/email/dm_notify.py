@@ -1,28 +1,192 @@
 # -*- coding: utf-8 -*-
 """Digital Marketplace Notify integration."""
+from __future__ import absolute_import
+
+from collections import namedtuple
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import sqlite3
+import threading
+import weakref
+
 from flask import current_app
+from monotonic import monotonic
 from notifications_python_client import NotificationsAPIClient
-from notifications_python_client.errors import HTTPError
+from notifications_python_client.authentication import create_jwt_token
+from notifications_python_client.errors import HTTPError, InvalidResponse
+import requests
+import six
+from six.moves.urllib.parse import urljoin
 
+from dmutils.config import declare_settings, Setting
 from dmutils.email.exceptions import EmailError
-from dmutils.email.helpers import hash_string
+from dmutils.email.helpers import hash_string, TokenBucket
+from dmutils.email.retry import CircuitOpenError, RetryPolicy
+from dmutils.fork_hooks import register_after_fork
+from dmutils.trace_context import wrap_with_context
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_BASE_URL = 'https://api.notifications.service.gov.uk'
+
+# Notify allows a service to send 3,000 messages a minute
+NOTIFY_RATE_LIMIT = 50
+
+SENT = "sent"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+# the outcome of sending one email of a batch - `status` being one of SENT, SKIPPED (as already sent) or FAILED, with
+# Notify's `response` if sent or the `error` if failed, and how many times it was `retried`
+SendResult = namedtuple("SendResult", ("email_address", "reference", "status", "response", "error", "retried"))
+
+# the outcome of sending a batch of emails, with the `results` for each in the order they were given
+BatchSendResult = namedtuple(
+    "BatchSendResult", ("results", "sent", "skipped", "failed", "retries", "elapsed", "emails_per_second")
+)
+
+
+class DeliveredReferenceStore(object):
+    """
+    The references of delivered notifications, kept in an sqlite database at `path` so that they can be shared by
+    every process (and every run of a script) sending through the same Notify service.
+
+    Along with the references, it keeps the id of the newest notification they've been synced up to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS delivered_references (reference TEXT PRIMARY KEY)")
+            connection.execute("CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT)")
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads, nor with processes forked from this one
+        if getattr(self._local, "pid", None) != os.getpid():
+            self._local.connection = sqlite3.connect(self.path, timeout=30)
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def __contains__(self, reference):
+        return self._connection().execute(
+            "SELECT 1 FROM delivered_references WHERE reference = ?", (reference,)
+        ).fetchone() is not None
+
+    def __iter__(self):
+        return (row[0] for row in self._connection().execute("SELECT reference FROM delivered_references"))
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM delivered_references").fetchone()[0]
+
+    def add(self, references, newest_id=None):
+        """Store `references`, and `newest_id` as the newest notification synced up to if given, in one transaction"""
+        with self._connection() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO delivered_references (reference) VALUES (?)",
+                ((reference,) for reference in references),
+            )
+            if newest_id is not None:
+                connection.execute(
+                    "INSERT OR REPLACE INTO sync_state (key, value) VALUES ('newest_id', ?)", (newest_id,)
+                )
+
+    @property
+    def newest_id(self):
+        row = self._connection().execute("SELECT value FROM sync_state WHERE key = 'newest_id'").fetchone()
+        return row[0] if row else None
+
+
+# every SessionNotificationsAPIClient in the process, so that their sessions can be replaced in a process forked from
+# this one
+_session_client_instances = weakref.WeakSet()
+
+
+class SessionNotificationsAPIClient(NotificationsAPIClient):
+    """
+    A Notify client making its requests through a `requests.Session`, so that its connections are kept alive and
+    reused between requests, rather than each request making (and doing a TLS handshake for) a new one.
+    """
+
+    def __init__(self, api_key, base_url=NOTIFY_BASE_URL, session=None):
+        super(SessionNotificationsAPIClient, self).__init__(api_key, base_url)
+        self.session = session or requests.Session()
+        _session_client_instances.add(self)
+
+    def request(self, method, url, data=None, params=None):
+        # as `BaseAPIClient.request`, but through our session
+        url = urljoin(str(self.base_url), str(url))
+        try:
+            response = self.session.request(
+                method,
+                url,
+                headers=self.generate_headers(create_jwt_token(self.api_key, self.service_id)),
+                data=json.dumps(data),
+                params=params,
+            )
+            response.raise_for_status()
+        except requests.RequestException as e:
+            api_error = HTTPError.create(e)
+            logger.error(
+                "API {method} request on {url} failed with {status_code} '{error}'",
+                extra={'method': method, 'url': url, 'status_code': api_error.status_code, 'error': api_error.message},
+            )
+            raise api_error
+
+        if response.status_code == 204:
+            return
+        try:
+            return response.json()
+        except ValueError:
+            raise InvalidResponse(response, message="No JSON response object could be decoded")
+
+
+@register_after_fork
+def _reset_after_fork():
+    # the parent's pooled connections mustn't be used by the child too
+    for client in list(_session_client_instances):
+        client.session = requests.Session()
 
 
 class DMNotifyClient(object):
     """Digital Marketplace wrapper around the Notify python client."""
 
-    _client_class = NotificationsAPIClient
+    _client_class = SessionNotificationsAPIClient
     _sent_references_cache = None
+    _newest_synced_id = None
 
     def __init__(
             self,
             govuk_notify_api_key,
-            govuk_notify_base_url='https://api.notifications.service.gov.uk',
-            logger=None
+            govuk_notify_base_url=NOTIFY_BASE_URL,
+            logger=None,
+            delivered_references_path=None,
+            session=None,
+            retry_policy=None,
     ):
-        """Set up logging and mail client."""
+        """
+        Set up logging and mail client.
+
+        :param delivered_references_path: path of an sqlite database to keep the references of delivered emails in
+                                          between runs and share them with other processes, rather than in memory
+        :param session: the `requests.Session` to make requests to Notify through, by default a new one. Only passed
+                        on to a `_client_class` that isn't a `SessionNotificationsAPIClient` if given.
+        :param retry_policy: the `dmutils.email.retry.RetryPolicy` to make requests to Notify with
+        """
         self.logger = logger or current_app.logger
-        self.client = self._client_class(govuk_notify_api_key, govuk_notify_base_url)
+        self.retry_policy = retry_policy or RetryPolicy("notify")
+        # subclasses may have a `_client_class` from before it took a session
+        client_kwargs = (
+            {'session': session}
+            if session is not None or issubclass(self._client_class, SessionNotificationsAPIClient)
+            else {}
+        )
+        self.client = self._client_class(govuk_notify_api_key, govuk_notify_base_url, **client_kwargs)
+        self._reference_store = (
+            DeliveredReferenceStore(delivered_references_path) if delivered_references_path else None
+        )
 
     def get_all_notifications(self, **kwargs):
         """Wrapper for notifications_python_client.notifications.NotificationsAPIClient::get_all_notifications"""
@@ -32,22 +196,77 @@ class DMNotifyClient(object):
         """Wrapper for notifications_python_client.notifications.NotificationsAPIClient::get_all_notifications"""
         return self.get_all_notifications(status='delivered', **kwargs)
 
+    def iter_delivered_notifications(self, newer_than=None):
+        """
+        Every delivered notification, newest first, requesting each page as it's needed and stopping short of the
+        notification with id `newer_than` if given.
+        """
+        older_than = None
+        while True:
+            kwargs = {'older_than': older_than} if older_than else {}
+            page = self.retry_policy.call(self.client.get_all_notifications, status='delivered', **kwargs)
+            for notification in page['notifications']:
+                if notification['id'] == newer_than:
+                    return
+                yield notification
+
+            if not page['notifications'] or 'next' not in page.get('links', {}):
+                return
+            if page['notifications'][-1]['id'] == older_than:
+                # shouldn't happen, but mustn't have us ask for the same page forever
+                return
+            older_than = page['notifications'][-1]['id']
+
+    def _sync_delivered_references(self):
+        """
+        Fetch the references of notifications delivered since we last synced - all of them, the first time - only
+        walking back through the pages until reaching the newest notification seen last time.
+
+        Notify orders notifications by when they were created rather than delivered, so one delivered since the last
+        sync but created before it will be missed - though any sent through this client are recorded as they're sent.
+        """
+        newest_synced_id = self._newest_synced_id
+        if newest_synced_id is None and self._reference_store is not None:
+            newest_synced_id = self._reference_store.newest_id
+
+        references, newest_id = set(), None
+        for notification in self.iter_delivered_notifications(newer_than=newest_synced_id):
+            newest_id = newest_id or notification['id']
+            if notification['reference']:
+                references.add(notification['reference'])
+
+        if self._reference_store is not None:
+            self._reference_store.add(references, newest_id=newest_id)
+            if self._sent_references_cache is None:
+                references.update(self._reference_store)
+        if newest_id is not None:
+            self._newest_synced_id = newest_id
+        self._sent_references_cache = (self._sent_references_cache or set()) | references
+
     def get_delivered_references(self, invalidate_cache=False):
-        """Get the references of all notifications that have already been delivered."""
-        if invalidate_cache:
-            self._sent_references_cache = None
-        if self._sent_references_cache is None:
-            self._sent_references_cache = set(i['reference'] for i in self.get_delivered_notifications())
+        """
+        Get the references of all notifications that have already been delivered.
+
+        The first call fetches every page of delivered notifications (or, with a `delivered_references_path`, only those
+        since the database was last synced), and invalidating the cache fetches only those delivered since.
+        """
+        if invalidate_cache or self._sent_references_cache is None:
+            self._sync_delivered_references()
         return self._sent_references_cache
 
     def _update_cache(self, reference):
         """If the cache has been instantiated then cache the new reference."""
         if self._sent_references_cache is not None:
             self._sent_references_cache.update([reference])
+            if self._reference_store is not None:
+                self._reference_store.add([reference])
 
     def has_been_sent(self, reference):
         """Checks for a matching reference in our list of delivered references."""
-        return reference in self.get_delivered_references()
+        if reference in self.get_delivered_references():
+            return True
+        # it may have been sent by another process since we synced
+        return self._reference_store is not None and reference in self._reference_store
 
     @staticmethod
     def get_reference(email_address, template_id, personalisation=None):
@@ -70,6 +289,8 @@ class DMNotifyClient(object):
         """Format a logical error message from the error response."""
         messages = []
         message_prefix = u'Error sending message to {email_address}: '.format(email_address=email_address)
+        if isinstance(error, CircuitOpenError):
+            return message_prefix + six.text_type(error)
         message_string = u'{status_code} {error}: {message}'
 
         for message in error.message:
@@ -103,7 +324,8 @@ class DMNotifyClient(object):
             )
             return
         try:
-            response = self.client.send_email_notification(
+            response = self.retry_policy.call(
+                self.client.send_email_notification,
                 email_address,
                 template_id,
                 personalisation=personalisation,
@@ -112,6 +334,9 @@ class DMNotifyClient(object):
         except HTTPError as e:
             self.logger.error(self.get_error_message(hash_string(email_address), e))
             raise EmailError(str(e))
+        except CircuitOpenError as e:
+            self.logger.error(self.get_error_message(hash_string(email_address), e))
+            raise
         self._update_cache(reference)
         self.logger.info(
             "Sent email {reference} to {email_address} (id: {notify_id}, template: {template_id}) through Notify",
@@ -123,3 +348,149 @@ class DMNotifyClient(object):
             ),
         )
         return response
+
+    def _send_with_retries(self, email, bucket, retry_policy):
+        email_address, template_id, personalisation, reference = email
+        retries = []
+
+        def send():
+            bucket.acquire()
+            return self.client.send_email_notification(
+                email_address,
+                template_id,
+                personalisation=personalisation,
+                reference=reference,
+            )
+
+        try:
+            response = retry_policy.wrap(send, on_retry=lambda error, delay: retries.append(error))()
+        except (HTTPError, CircuitOpenError) as e:
+            self.logger.error(self.get_error_message(hash_string(email_address), e))
+            return SendResult(email_address, reference, FAILED, None, e, len(retries))
+
+        self._update_cache(reference)
+        return SendResult(email_address, reference, SENT, response, None, len(retries))
+
+    def send_emails(
+            self,
+            batch,
+            allow_resend=True,
+            max_workers=8,
+            rate_limit=NOTIFY_RATE_LIMIT,
+            max_retries=3,
+            retry_backoff=1,
+    ):
+        """
+        Send many emails at once, `max_workers` at a time and no more than `rate_limit` a second between them.
+
+        Sends that are rate limited or fail with a server error are retried up to `max_retries` times, waiting up to
+        `retry_backoff` seconds before the first retry and twice as long before each one after, as the client's
+        `retry_policy` otherwise says. Other failures, and sends rejected because Notify has been failing, are logged
+        and reported in the results rather than raised. Only a summary of the batch is logged on success.
+
+        :param batch: iterable of dicts of the `email_address`, `template_id` and (optionally) `personalisation` and
+                      `reference` to send each email with, as `send_email` takes them
+        :param allow_resend: if False skip emails already delivered, or given more than once in the batch
+        :return: a `BatchSendResult`
+        """
+        start = monotonic()
+        emails = list(iter_batch_emails(batch))
+        results = [None] * len(emails)
+        to_send = []
+        seen_references = set()
+        for i, email in enumerate(emails):
+            reference = email[3]
+            if not allow_resend and (reference in seen_references or self.has_been_sent(reference)):
+                results[i] = SendResult(email[0], reference, SKIPPED, None, None, 0)
+            else:
+                to_send.append(i)
+            seen_references.add(reference)
+
+        bucket = TokenBucket(rate_limit)
+        retry_policy = self.retry_policy.replace(max_attempts=1 + max_retries, backoff=retry_backoff)
+        send = wrap_with_context(lambda email: self._send_with_retries(email, bucket, retry_policy))
+        pool = ThreadPool(max_workers)
+        try:
+            for i, result in zip(to_send, pool.map(send, [emails[i] for i in to_send], chunksize=1)):
+                results[i] = result
+        finally:
+            pool.close()
+
+        return summarise_batch(results, monotonic() - start, self.logger)
+
+
+def iter_batch_emails(batch):
+    """The emails of a `send_emails` batch as (email address, template id, personalisation, reference) tuples"""
+    for email in batch:
+        personalisation = email.get('personalisation')
+        yield (
+            email['email_address'],
+            email['template_id'],
+            personalisation,
+            email.get('reference') or DMNotifyClient.get_reference(
+                email['email_address'], email['template_id'], personalisation
+            ),
+        )
+
+
+def summarise_batch(results, elapsed, logger):
+    """The `BatchSendResult` of a batch whose emails had `results`, taking `elapsed` seconds, logged to `logger`"""
+    counts = dict((status, sum(1 for result in results if result.status == status))
+                  for status in (SENT, SKIPPED, FAILED))
+    batch_result = BatchSendResult(
+        results=results,
+        sent=counts[SENT],
+        skipped=counts[SKIPPED],
+        failed=counts[FAILED],
+        retries=sum(result.retried for result in results),
+        elapsed=elapsed,
+        emails_per_second=counts[SENT] / elapsed if elapsed else 0.0,
+    )
+    logger.info(
+        "Sent {sent} emails through Notify in {elapsed}s ({skipped} already sent, {failed} failed)",
+        extra=dict(
+            sent=batch_result.sent,
+            skipped=batch_result.skipped,
+            failed=batch_result.failed,
+            retries=batch_result.retries,
+            elapsed=round(elapsed, 3),
+            emails_per_second=round(batch_result.emails_per_second, 1),
+        ),
+    )
+    return batch_result
+
+
+_app_client_lock = threading.Lock()
+
+
+def init_app(app):
+    """
+    Declare the Notify settings and, if there's an api key, create the app's `DMNotifyClient` - see `get_notify_client`
+    """
+    declare_settings(app, {
+        'DM_NOTIFY_API_KEY': Setting(str),
+        'DM_NOTIFY_BASE_URL': Setting(str, NOTIFY_BASE_URL),
+    })
+    app.extensions.pop('dmutils_notify_client', None)
+    if app.config['DM_NOTIFY_API_KEY']:
+        get_notify_client(app)
+
+
+def get_notify_client(app=None):
+    """
+    The `DMNotifyClient` shared by everything in this process sending email for the app (`current_app` by default),
+    keeping its connections to Notify open between requests. It's created the first time it's needed if `init_app`
+    hasn't already.
+    """
+    app = app or current_app
+    client = app.extensions.get('dmutils_notify_client')
+    if client is None:
+        with _app_client_lock:
+            client = app.extensions.get('dmutils_notify_client')
+            if client is None:
+                client = app.extensions['dmutils_notify_client'] = DMNotifyClient(
+                    app.config['DM_NOTIFY_API_KEY'],
+                    app.config.get('DM_NOTIFY_BASE_URL') or NOTIFY_BASE_URL,
+                    logger=app.logger,
+                )
+    return client
@@ -2,6 +2,10 @@
 """Email helpers."""
 import base64
 import hashlib
+import threading
+import time
+
+from monotonic import monotonic
 import six
 
 
@@ -9,3 +13,54 @@ def hash_string(string):
     """Hash a given string."""
     m = hashlib.sha256(six.text_type(string).encode('utf-8'))
     return base64.urlsafe_b64encode(m.digest()).decode('utf-8')
+
+
+def mandrill_message(to_email_addresses, email_body, subject, from_email, from_name, tags, reply_to=None,
+                     metadata=None):
+    """The message to send through Mandrill's `messages/send` api"""
+    to, recipient_metadata = [], []
+    for email_address in to_email_addresses:
+        to.append({'email': email_address, 'type': 'to'})
+        recipient_metadata.append({'rcpt': email_address})
+    return {
+        'html': email_body,
+        'subject': subject,
+        'from_email': from_email,
+        'from_name': from_name,
+        'to': to,
+        'important': False,
+        'track_opens': False,
+        'track_clicks': False,
+        'auto_text': True,
+        'tags': tags,
+        'metadata': metadata,
+        'headers': {'Reply-To': reply_to or from_email},
+        'preserve_recipients': False,
+        'recipient_metadata': recipient_metadata,
+    }
+
+
+class TokenBucket(object):
+    """
+    Rate limiting shared between threads: `acquire` blocks until a token is available, tokens being added at `rate` a
+    second up to a maximum of `capacity` (by default a second's worth), so bursts can't go over that.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
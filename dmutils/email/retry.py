@@ -0,0 +1,250 @@
+"""
+    Retrying requests to the email providers (Notify, Mailchimp and Mandrill) that fail in ways that might not fail
+    the next time, and failing fast instead of retrying when a provider looks to be down.
+
+    Usage:
+
+        policy = RetryPolicy("notify", max_attempts=4, backoff=0.5, deadline=30)
+        response = policy.call(client.send_email_notification, email_address, template_id)
+
+    A failed attempt is retried if its error is one of `retry_exceptions`, or has a `status_code` (or a `response`
+    with one) in `retry_statuses`. Before the `n`th retry the policy waits `backoff * 2 ** (n - 1)` seconds, at most
+    `max_backoff`, less a random fraction of up to `jitter` of that so that clients failing together don't all retry
+    together. It gives up once `max_attempts` have been made, or if waiting would take it past `deadline` seconds since
+    the first attempt, raising the last attempt's error.
+
+    Policies for the same provider share a `CircuitBreaker`, which opens after `failure_threshold` retryable failures in
+    a row - from any thread - and then rejects every attempt with a `CircuitOpenError` for `reset_timeout` seconds,
+    after which a single attempt is let through to see whether the provider has recovered.
+"""
+from __future__ import absolute_import
+
+import logging
+import random
+import threading
+import time
+
+from monotonic import monotonic
+
+from dmutils.email.exceptions import EmailError
+from dmutils.fork_hooks import register_after_fork
+from dmutils.prometheus import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# rate limited, or an error on the provider's side (including, for the Notify client, no response at all)
+DEFAULT_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+_attempts = REGISTRY.counter(
+    "email_provider_attempts_total",
+    "Requests made to email providers, by provider and whether they succeeded, were retried, failed or were rejected "
+    "by an open circuit breaker",
+    ("provider", "outcome"),
+)
+_circuit_open = REGISTRY.gauge(
+    "email_provider_circuit_open", "Whether the circuit breaker for an email provider is open", ("provider",),
+)
+
+
+class CircuitOpenError(EmailError):
+    """An attempt rejected without being made, because the provider has been failing"""
+
+    def __init__(self, provider, retry_after):
+        super(CircuitOpenError, self).__init__(
+            "Not calling {} after repeated failures, for another {:.1f}s".format(provider, retry_after)
+        )
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    def __init__(self, provider, failure_threshold=5, reset_timeout=30):
+        self.provider = provider
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def before_attempt(self):
+        """Raise a `CircuitOpenError` if an attempt shouldn't be made now"""
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            retry_after = self._opened_at + self.reset_timeout - monotonic()
+            if self.state == OPEN and retry_after <= 0:
+                # let this one attempt through, rejecting the rest until we know how it went
+                self.state = HALF_OPEN
+                return
+        _attempts.labels(provider=self.provider, outcome="rejected").inc()
+        raise CircuitOpenError(self.provider, max(retry_after, 0))
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if self.state != CLOSED:
+                logger.info("Closing circuit breaker for {provider}", extra={'provider': self.provider})
+                self.state = CLOSED
+                _circuit_open.labels(provider=self.provider).set(0)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self.failure_threshold):
+                if self.state == CLOSED:
+                    logger.warning(
+                        "Opening circuit breaker for {provider} after {failures} failures",
+                        extra={'provider': self.provider, 'failures': self._failures},
+                    )
+                self.state = OPEN
+                self._opened_at = monotonic()
+                _circuit_open.labels(provider=self.provider).set(1)
+
+
+# provider -> the CircuitBreaker shared by every policy for it
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(provider, failure_threshold=5, reset_timeout=30):
+    """The circuit breaker for `provider`, created with `failure_threshold` and `reset_timeout` if it's the first"""
+    with _circuit_breakers_lock:
+        if provider not in _circuit_breakers:
+            _circuit_breakers[provider] = CircuitBreaker(provider, failure_threshold, reset_timeout)
+        return _circuit_breakers[provider]
+
+
+def reset_circuit_breakers():
+    """Forget every provider's failures, closing their circuit breakers"""
+    with _circuit_breakers_lock:
+        for provider in _circuit_breakers:
+            _circuit_open.labels(provider=provider).set(0)
+        _circuit_breakers.clear()
+
+
+@register_after_fork
+def _reset_after_fork():
+    global _circuit_breakers_lock
+    _circuit_breakers_lock = threading.Lock()
+    for breaker in list(_circuit_breakers.values()):
+        breaker._lock = threading.Lock()
+
+
+def get_status_code(error):
+    """The HTTP status `error` was caused by, if any"""
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code if isinstance(status_code, int) else None
+
+
+class RetryPolicy(object):
+    def __init__(
+            self,
+            provider,
+            max_attempts=3,
+            backoff=1,
+            max_backoff=30,
+            jitter=0.5,
+            retry_statuses=DEFAULT_RETRY_STATUSES,
+            retry_exceptions=(),
+            deadline=None,
+            circuit_breaker=None,
+    ):
+        self.provider = provider
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = frozenset(retry_statuses)
+        self.retry_exceptions = tuple(retry_exceptions)
+        self.deadline = deadline
+        self.circuit_breaker = circuit_breaker or get_circuit_breaker(provider)
+
+    def replace(self, **changes):
+        """A copy of this policy with `changes` made to it, sharing its circuit breaker"""
+        kwargs = dict(
+            provider=self.provider,
+            max_attempts=self.max_attempts,
+            backoff=self.backoff,
+            max_backoff=self.max_backoff,
+            jitter=self.jitter,
+            retry_statuses=self.retry_statuses,
+            retry_exceptions=self.retry_exceptions,
+            deadline=self.deadline,
+            circuit_breaker=self.circuit_breaker,
+        )
+        kwargs.update(changes)
+        return RetryPolicy(**kwargs)
+
+    def is_retryable(self, error):
+        if isinstance(error, CircuitOpenError):
+            return False
+        return isinstance(error, self.retry_exceptions) or get_status_code(error) in self.retry_statuses
+
+    def get_delay(self, retried):
+        """How long to wait before retrying for the `retried + 1`th time"""
+        delay = min(self.max_backoff, self.backoff * 2 ** retried)
+        return delay * (1 - self.jitter * random.random())
+
+    def before_attempt(self):
+        self.circuit_breaker.before_attempt()
+
+    def record_success(self):
+        _attempts.labels(provider=self.provider, outcome="success").inc()
+        self.circuit_breaker.record_success()
+
+    def record_failure(self, error, retried, started):
+        """
+            Record an attempt failing with `error`, after `retried` retries since `started` (by `monotonic`), returning
+            how long to wait before retrying, or None if we shouldn't
+        """
+        if isinstance(error, CircuitOpenError):
+            return None
+        if not self.is_retryable(error):
+            # the provider's up, it just didn't like the request
+            _attempts.labels(provider=self.provider, outcome="failed").inc()
+            self.circuit_breaker.record_success()
+            return None
+
+        self.circuit_breaker.record_failure()
+        delay = self.get_delay(retried)
+        out_of_time = self.deadline is not None and monotonic() - started + delay > self.deadline
+        # a retry would only be rejected once the circuit breaker's open
+        if retried + 1 >= self.max_attempts or out_of_time or self.circuit_breaker.state == OPEN:
+            _attempts.labels(provider=self.provider, outcome="failed").inc()
+            return None
+        _attempts.labels(provider=self.provider, outcome="retried").inc()
+        return delay
+
+    def call(self, fn, *args, **kwargs):
+        """The result of `fn(*args, **kwargs)`, retried as the policy says"""
+        return self.wrap(fn)(*args, **kwargs)
+
+    def wrap(self, fn, on_retry=None):
+        """`fn`, retried as the policy says, calling `on_retry(error, delay)` before each retry if given"""
+        def wrapper(*args, **kwargs):
+            started = monotonic()
+            retried = 0
+            while True:
+                self.before_attempt()
+                try:
+                    result = fn(*args, **kwargs)
+                except Exception as e:
+                    delay = self.record_failure(e, retried, started)
+                    if delay is None:
+                        raise
+                    if on_retry is not None:
+                        on_retry(e, delay)
+                    time.sleep(delay)
+                    retried += 1
+                    continue
+                self.record_success()
+                return result
+
+        return wrapper
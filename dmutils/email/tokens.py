@@ -1,6 +1,9 @@
 import base64
+from collections import OrderedDict
 import json
 import struct
+import threading
+import time
 
 from datetime import datetime
 
@@ -8,12 +11,70 @@ import six
 from cryptography import fernet
 from flask import current_app
 
+from dmutils.config import declare_settings, Setting
 from dmutils.formats import DATETIME_FORMAT
 from dmutils.email.helpers import hash_string
+from dmutils.fork_hooks import register_after_fork
 
 ONE_DAY_IN_SECONDS = 86400
 SEVEN_DAYS_IN_SECONDS = 604800
 
+# how far in the future a token's timestamp may be, as `fernet.Fernet.decrypt` allows
+MAX_CLOCK_SKEW = 60
+
+# the most (secret key, namespace) pairs to keep a Fernet for - apps only use a handful
+FERNET_CACHE_SIZE = 32
+
+# tokens are the id of the key they were encrypted with, this, then the Fernet token - which never contains a "."
+KEY_ID_SEPARATOR = "."
+KEY_ID_LENGTH = 6
+
+# (secret key, namespace) -> (key id, Fernet), least recently used first
+_fernets = OrderedDict()
+_fernets_lock = threading.Lock()
+
+
+def _get_key(secret_key, namespace):
+    cache_key = (secret_key, namespace)
+    with _fernets_lock:
+        key = _fernets.pop(cache_key, None)
+        if key is None:
+            derived_key = hash_string(secret_key + namespace)
+            # a hash of the key rather than anything of the key itself, so that it gives nothing away
+            key = (hash_string(u"key-id:" + derived_key)[:KEY_ID_LENGTH], fernet.Fernet(derived_key.encode('utf-8')))
+        _fernets[cache_key] = key
+        while len(_fernets) > FERNET_CACHE_SIZE:
+            _fernets.popitem(last=False)
+    return key
+
+
+def get_fernet(secret_key, namespace):
+    """
+    The Fernet for `secret_key` and `namespace` (see `generate_token`), only deriving its key the first time they're
+    used together, or if they've since been pushed out of the cache by `FERNET_CACHE_SIZE` more recently used pairs.
+    """
+    return _get_key(secret_key, namespace)[1]
+
+
+def get_key_id(secret_key, namespace):
+    """The short id that tokens encrypted with `secret_key` and `namespace` are prefixed with"""
+    return _get_key(secret_key, namespace)[0]
+
+
+def _secret_keys(secret_key):
+    """The secret keys a token can be decrypted with, the one new tokens are encrypted with first"""
+    if not isinstance(secret_key, (list, tuple)):
+        return [secret_key]
+    if not secret_key:
+        raise ValueError("At least one secret key is needed")
+    return list(secret_key)
+
+
+@register_after_fork
+def _reset_after_fork():
+    global _fernets_lock
+    _fernets_lock = threading.Lock()
+
 
 def generate_token(json_data, secret_key, namespace):
     """
@@ -27,21 +88,29 @@ def generate_token(json_data, secret_key, namespace):
       that provides HMAC, TTL (time to live), and some quality of life features (url-safe base64 encoding)
       The fernet spec can be viewed here: https://github.com/fernet/spec/blob/master/Spec.md
     * The data is dumped from json and encrypted.
-    * The output data is returned as a urlsafe_base64 (https://tools.ietf.org/html/rfc4648#section-5) unicode string.
+    * The output data is returned as a urlsafe_base64 (https://tools.ietf.org/html/rfc4648#section-5) unicode string,
+      prefixed with the id of the key it was encrypted with (see `get_key_id`) and a ".", so that decoding it can go
+      straight to the right key when there are several.
 
     Fernet acepts and returns bytes, so call `.encode` before and `.decode` after to convert to strings, to ensure we
     use regular python strings for as much of the code flow as possible
 
     :param json_data: data to encrypt. Must be json-like blob that `json.dumps` will accept
-    :param secret_key: The secret key to encrypt with. No length/content restrictions. Must be a string type.
+    :param secret_key: The secret key to encrypt with. No length/content restrictions. Must be a string type, or a
+        non-empty list or tuple of them as `decode_token` takes, of which the first is used.
     :param namespace: The namespace to encrypt with. No length/content restrictions. Must be a string type.
     :return: returns a urlsale_base64 encoded encrypted unicode string.
     :rtype: `unicode`
     """
-    secret_key = hash_string(secret_key + namespace)
     data = json.dumps(json_data).encode('utf-8')
-    f = fernet.Fernet(secret_key.encode('utf-8'))
-    return f.encrypt(data).decode('utf-8')
+    key_id, f = _get_key(_secret_keys(secret_key)[0], namespace)
+    return key_id + KEY_ID_SEPARATOR + f.encrypt(data).decode('utf-8')
+
+
+def _split_token(encrypted_data):
+    """The key id of a token (or None for tokens from before they had one) and the Fernet token in it"""
+    key_id, separator, fernet_token = encrypted_data.rpartition(KEY_ID_SEPARATOR)
+    return (key_id if separator else None), fernet_token
 
 
 def _parse_fernet_timestamp(ciphertext):
@@ -51,14 +120,48 @@ def _parse_fernet_timestamp(ciphertext):
     Decryption should be attempted before using this function, as that does cryptographically strong tests on the
     validity of the ciphertext.
     """
+    if isinstance(ciphertext, bytes):
+        ciphertext = ciphertext.decode('utf-8')
+    _, fernet_token = _split_token(ciphertext)
+    return datetime.utcfromtimestamp(_fernet_epoch_timestamp(fernet_token.encode('utf-8')))
+
+
+def _fernet_epoch_timestamp(ciphertext):
     decoded = base64.urlsafe_b64decode(ciphertext)
 
     try:
-        epoch_timestamp = struct.unpack('>Q', decoded[1:9])[0]
+        return struct.unpack('>Q', decoded[1:9])[0]
     except struct.error as e:
-        raise fernet.InvalidToken(e.message)
+        raise fernet.InvalidToken(str(e))
+
+
+def _decrypt_token(encrypted_data, secret_key, namespace):
+    """
+    The data in a token and the unix time it was encrypted at, regardless of its age, decrypting it just the once
+    whatever `_check_token_age` is then asked about it.
+
+    Tokens with a key id are only tried with the key it's the id of. Those from before tokens had them are tried with
+    each of the keys in turn.
+    """
+    key_id, fernet_token = _split_token(encrypted_data)
+    keys = [_get_key(key, namespace) for key in _secret_keys(secret_key)]
+    fernets = [f for id_, f in keys if key_id is None or id_ == key_id]
+    if not fernets:
+        raise fernet.InvalidToken()
+
+    encrypted_bytes = fernet_token.encode('utf-8')
+    # this raises fernet.InvalidToken if the key does not match
+    data = (fernets[0] if len(fernets) == 1 else fernet.MultiFernet(fernets)).decrypt(encrypted_bytes)
+    return json.loads(data.decode('utf-8')), _fernet_epoch_timestamp(encrypted_bytes)
+
 
-    return datetime.utcfromtimestamp(epoch_timestamp)
+def _check_token_age(epoch_timestamp, max_age_in_seconds):
+    """Raise fernet.InvalidToken if a token from `epoch_timestamp` is too old, as `fernet.Fernet.decrypt`'s ttl does"""
+    if max_age_in_seconds is None:
+        return
+    current_time = int(time.time())
+    if epoch_timestamp + max_age_in_seconds < current_time or current_time + MAX_CLOCK_SKEW < epoch_timestamp:
+        raise fernet.InvalidToken()
 
 
 def decode_token(encrypted_data, secret_key, namespace, max_age_in_seconds=ONE_DAY_IN_SECONDS):
@@ -77,7 +180,9 @@ def decode_token(encrypted_data, secret_key, namespace, max_age_in_seconds=ONE_D
     use regular python strings for as much of the code flow as possible
 
     :param encrypted_data: data to decrypt. Must be a string type.
-    :param secret_key: The secret key you encrypted the data with. Must be a string type.
+    :param secret_key: The secret key you encrypted the data with. Must be a string type, or a non-empty list or
+        tuple of them to allow for rotating keys - the current one first, then those that tokens still in use may have
+        been encrypted with.
     :param namespace: The namespace you encrypted the data with. Must be a string type.
     :param max_age_in_seconds: The maximum age of the encrypted data.
     :return: the original encrypted data and the datetime it was encrypted at.
@@ -85,22 +190,35 @@ def decode_token(encrypted_data, secret_key, namespace, max_age_in_seconds=ONE_D
     :raises fernet.InvalidToken: If the secret key and namespace are not able to decrypt the message,
         or max_age_in_seconds has been exceeded.
     """
-    encrypted_bytes = encrypted_data.encode('utf-8')
-    secret_key = hash_string(secret_key + namespace)
-    f = fernet.Fernet(secret_key.encode('utf-8'))
+    data, epoch_timestamp = _decrypt_token(encrypted_data, secret_key, namespace)
+    _check_token_age(epoch_timestamp, max_age_in_seconds)
+    return data, datetime.utcfromtimestamp(epoch_timestamp)
 
-    # this raises fernet.InvalidToken if the key does not match or if TTL is exceeded
-    data = f.decrypt(encrypted_bytes, ttl=max_age_in_seconds)
 
-    timestamp = _parse_fernet_timestamp(encrypted_bytes)
-    return json.loads(data.decode('utf-8')), timestamp
+def init_app(app):
+    """
+    Declare SHARED_EMAIL_OLD_KEYS, the keys tokens encrypted before SHARED_EMAIL_KEY was rotated may have been encrypted
+    with - comma-separated if given in the environment
+    """
+    declare_settings(app, {
+        'SHARED_EMAIL_OLD_KEYS': Setting(tuple, ()),
+    })
+
+
+def _shared_email_keys():
+    """SHARED_EMAIL_KEY, followed by any SHARED_EMAIL_OLD_KEYS still accepted while rotating it"""
+    old_keys = current_app.config.get('SHARED_EMAIL_OLD_KEYS') or ()
+    # as `config.init_app` leaves it if it's taken from the environment without having been declared
+    if isinstance(old_keys, six.string_types):
+        old_keys = (old_keys,)
+    return [current_app.config['SHARED_EMAIL_KEY']] + list(old_keys)
 
 
 def decode_password_reset_token(token, data_api_client):
     try:
         decoded, token_timestamp = decode_token(
             token,
-            current_app.config["SHARED_EMAIL_KEY"],
+            _shared_email_keys(),
             current_app.config["RESET_PASSWORD_SALT"],
             ONE_DAY_IN_SECONDS,
         )
@@ -127,33 +245,26 @@ def decode_password_reset_token(token, data_api_client):
 
 def decode_invitation_token(encoded_token):
     try:
-        token, _ = decode_token(
+        token, epoch_timestamp = _decrypt_token(
             encoded_token,
-            current_app.config['SHARED_EMAIL_KEY'],
+            _shared_email_keys(),
             current_app.config['INVITE_EMAIL_SALT'],
-            SEVEN_DAYS_IN_SECONDS
         )
-        return token
+    except fernet.InvalidToken as invalid_token_error:
+        current_app.logger.info("Invitation reset attempt with invalid token. error {error}",
+                                extra={'error': six.text_type(invalid_token_error)})
 
+        return {'error': 'token_invalid'}
+
+    try:
+        _check_token_age(epoch_timestamp, SEVEN_DAYS_IN_SECONDS)
     except fernet.InvalidToken as error:
-        try:
-            token, _ = decode_token(
-                encoded_token,
-                current_app.config['SHARED_EMAIL_KEY'],
-                current_app.config['INVITE_EMAIL_SALT'],
-                None
-            )
-
-            current_app.logger.info("Invitation reset attempt with expired token. error {error}",
-                                    extra={'error': six.text_type(error)})
-
-            return {
-                'error': 'token_expired',
-                'role': token.get('role') or ('supplier' if token.get('supplier_id') else 'buyer')
-            }
-
-        except fernet.InvalidToken as invalid_token_error:
-            current_app.logger.info("Invitation reset attempt with invalid token. error {error}",
-                                    extra={'error': six.text_type(invalid_token_error)})
-
-            return {'error': 'token_invalid'}
+        current_app.logger.info("Invitation reset attempt with expired token. error {error}",
+                                extra={'error': six.text_type(error)})
+
+        return {
+            'error': 'token_expired',
+            'role': token.get('role') or ('supplier' if token.get('supplier_id') else 'buyer')
+        }
+
+    return token
@@ -1,10 +1,12 @@
 from flask import current_app, session, abort, url_for
-from . import DMNotifyClient, generate_token, EmailError
+from .dm_notify import get_notify_client
+from .exceptions import EmailError
+from .tokens import generate_token
 from .helpers import hash_string
 
 
 def send_user_account_email(role, email_address, template_id, extra_token_data={}, personalisation={}):
-    notify_client = DMNotifyClient(current_app.config['DM_NOTIFY_API_KEY'])
+    notify_client = get_notify_client()
 
     token_data = {
         'role': role,
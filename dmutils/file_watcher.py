@@ -0,0 +1,303 @@
+"""
+    Watching directory trees for changes without building a list of every file in them first, for restarting the
+    development server when something outside the python code changes.
+
+    On linux this uses inotify, asking the kernel to tell us about changes in each directory of the trees, so waiting
+    for a change costs nothing. Elsewhere - or if we run out of inotify watches - it polls, walking the trees each
+    `interval` seconds but only keeping a file count and latest modification time per tree between walks.
+
+    Files are only considered if their name matches one of the `include` glob patterns and none of the `exclude` ones,
+    and directories matching an `exclude` pattern aren't looked inside at all. Patterns containing a "/" are matched
+    against the path relative to the watched directory, others against the file or directory name alone.
+"""
+from __future__ import absolute_import
+
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INCLUDE = ("*",)
+DEFAULT_EXCLUDE = ("node_modules", ".git", "__pycache__", "*.pyc", "*.swp", "*~")
+
+
+def _matches(patterns, name, relative_path):
+    for pattern in patterns:
+        if fnmatch.fnmatch(relative_path if "/" in pattern else name, pattern):
+            return True
+    return False
+
+
+def _included(include, exclude, name, relative_path):
+    return _matches(include, name, relative_path) and not _matches(exclude, name, relative_path)
+
+
+class _Entry(object):
+    """Just enough of `os.DirEntry` for our purposes, for pythons without `scandir`"""
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_file(self):
+        return os.path.isfile(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+def _scandir(directory):
+    if scandir is not None:
+        return scandir(directory)
+    return (_Entry(directory, name) for name in os.listdir(directory))
+
+
+def _entries(directory):
+    try:
+        return list(_scandir(directory))
+    except OSError:
+        return []
+
+
+def _entry_type(entry):
+    try:
+        if entry.is_dir():
+            return "directory"
+        if entry.is_file():
+            return "file"
+    except OSError:
+        pass
+    return None
+
+
+def _walk(root, include, exclude, directories_only=False):
+    """
+        Yield an `os.DirEntry`-like object for every included file (unless `directories_only`) and every directory
+        below `root`, not descending into excluded directories. Entries vanishing as we go are skipped.
+    """
+    pending = [(root, "")]
+    while pending:
+        directory, relative_directory = pending.pop()
+        for entry in _entries(directory):
+            relative_path = relative_directory + entry.name
+            entry_type = _entry_type(entry)
+            if entry_type == "directory":
+                if not _matches(exclude, entry.name, relative_path):
+                    pending.append((entry.path, relative_path + "/"))
+                    yield entry
+            elif entry_type == "file" and not directories_only:
+                if _included(include, exclude, entry.name, relative_path):
+                    yield entry
+
+
+def iter_files(directories, include=DEFAULT_INCLUDE, exclude=DEFAULT_EXCLUDE):
+    """The paths of every included file in `directories`, found as they're asked for"""
+    for directory in directories:
+        for entry in _walk(directory, include, exclude):
+            if not entry.is_dir():
+                yield entry.path
+
+
+class PollingWatcher(object):
+    def __init__(self, directories, include=DEFAULT_INCLUDE, exclude=DEFAULT_EXCLUDE, interval=1):
+        self.directories = tuple(directories)
+        self.include = include
+        self.exclude = exclude
+        self.interval = interval
+        self._fingerprints = dict((directory, self._fingerprint(directory)) for directory in self.directories)
+
+    def _fingerprint(self, directory):
+        # a change to any file makes its modification time the latest, and adding, removing or renaming one changes
+        # the count, or its directory's modification time
+        count, latest = 0, 0
+        for entry in _walk(directory, self.include, self.exclude):
+            try:
+                latest = max(latest, entry.stat().st_mtime)
+            except OSError:
+                continue
+            count += 1
+        return count, latest
+
+    def wait_for_change(self, timeout=None):
+        """Block until something changes, returning the watched directory it's in, or None after `timeout` seconds"""
+        deadline = None if timeout is None else time.time() + timeout
+        while deadline is None or time.time() < deadline:
+            time.sleep(self.interval if deadline is None else max(0, min(self.interval, deadline - time.time())))
+            for directory in self.directories:
+                fingerprint = self._fingerprint(directory)
+                if fingerprint != self._fingerprints[directory]:
+                    self._fingerprints[directory] = fingerprint
+                    return directory
+        return None
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    _IN_MODIFY = 0x00000002
+    _IN_ATTRIB = 0x00000004
+    _IN_CLOSE_WRITE = 0x00000008
+    _IN_MOVED_FROM = 0x00000040
+    _IN_MOVED_TO = 0x00000080
+    _IN_CREATE = 0x00000100
+    _IN_DELETE = 0x00000200
+    _IN_Q_OVERFLOW = 0x00004000
+    _IN_ISDIR = 0x40000000
+    _IN_NONBLOCK = 0o4000
+    _IN_CLOEXEC = 0o2000000
+
+    _MASK = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+    _EVENT_HEADER = struct.Struct("iIII")
+
+    _libc = None
+
+    @classmethod
+    def available(cls):
+        if not sys.platform.startswith("linux"):
+            return False
+        if cls._libc is None:
+            try:
+                cls._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+                cls._libc.inotify_init1
+            except (OSError, AttributeError):
+                cls._libc = False
+        return bool(cls._libc)
+
+    def __init__(self, directories, include=DEFAULT_INCLUDE, exclude=DEFAULT_EXCLUDE):
+        if not self.available():
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.include = include
+        self.exclude = exclude
+        self._fd = self._libc.inotify_init1(self._IN_NONBLOCK | self._IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # watch descriptor -> (absolute path, path relative to the watched directory it's in)
+        self._watches = {}
+        try:
+            for directory in directories:
+                self._add_tree(directory, "")
+        except OSError:
+            self.close()
+            raise
+
+    def _add_watch(self, path, relative_path):
+        wd = self._libc.inotify_add_watch(self._fd, path.encode(sys.getfilesystemencoding()), self._MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return
+            # most likely ENOSPC, having reached fs.inotify.max_user_watches
+            raise OSError(error, "inotify_add_watch failed for {}".format(path))
+        self._watches[wd] = (path, relative_path)
+
+    def _add_tree(self, path, relative_path):
+        self._add_watch(path, relative_path)
+        prefix = relative_path + "/" if relative_path else ""
+        for entry in _walk(path, self.include, self.exclude, directories_only=True):
+            self._add_watch(entry.path, prefix + os.path.relpath(entry.path, path).replace(os.sep, "/"))
+
+    def _events(self, data):
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self._EVENT_HEADER.unpack_from(data, offset)
+            offset += self._EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(sys.getfilesystemencoding())
+            offset += length
+            yield wd, mask, name
+
+    def wait_for_change(self, timeout=None):
+        """Block until something changes, returning the path that did, or None after `timeout` seconds"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            readable, _, _ = select.select([self._fd], [], [], remaining)
+            if not readable:
+                return None
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    continue
+                raise
+
+            for wd, mask, name in self._events(data):
+                path = self._changed_path(wd, mask, name)
+                if path is not None:
+                    return path
+
+    def _changed_path(self, wd, mask, name):
+        """The path an event is about, if it's one we care about"""
+        if mask & self._IN_Q_OVERFLOW:
+            # we've missed events, so can't say what changed - only that something did
+            return "(inotify queue overflowed)"
+        if wd not in self._watches or not name:
+            return None
+
+        directory, relative_directory = self._watches[wd]
+        path = os.path.join(directory, name)
+        relative_path = relative_directory + "/" + name if relative_directory else name
+        if mask & self._IN_ISDIR:
+            if _matches(self.exclude, name, relative_path):
+                return None
+            if mask & (self._IN_CREATE | self._IN_MOVED_TO):
+                self._add_tree(path, relative_path)
+            return path
+        if _included(self.include, self.exclude, name, relative_path):
+            return path
+        return None
+
+    def close(self):
+        if self._fd is not None and self._fd >= 0:
+            os.close(self._fd)
+        self._fd = None
+
+
+def watch(directories, include=DEFAULT_INCLUDE, exclude=DEFAULT_EXCLUDE, interval=1):
+    """
+        An `InotifyWatcher` for `directories` if possible, otherwise a `PollingWatcher` checking every `interval`
+        seconds
+    """
+    if InotifyWatcher.available():
+        try:
+            return InotifyWatcher(directories, include, exclude)
+        except OSError as e:
+            logger.warning("Falling back to polling for file changes: {error}", extra={'error': e})
+    return PollingWatcher(directories, include, exclude, interval)
+
+
+def exit_on_change(directories, include=DEFAULT_INCLUDE, exclude=DEFAULT_EXCLUDE, exit_code=3):
+    """
+        Start a background thread which ends the process with `exit_code` as soon as anything changes in `directories`
+        - 3 being what tells werkzeug's reloader to start the server again
+    """
+    def run():
+        path = watcher.wait_for_change()
+        logger.info("Detected change in {path}, reloading", extra={'path': path})
+        os._exit(exit_code)
+
+    watcher = watch(directories, include, exclude)
+    thread = threading.Thread(target=run, name="dmutils-file-watcher")
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -1,7 +1,5 @@
 import os
-from flask_featureflags.contrib.inline import InlineFeatureFlag
 from . import config, logging, proxy_fix, request_id, formats, filters
-from flask_script import Manager, Server
 
 
 def init_app(
@@ -24,6 +22,7 @@ def init_app(
     logging.init_app(application)
     proxy_fix.init_app(application)
     request_id.init_app(application)
+    _init_opt_in_modules(application)
 
     if bootstrap:
         bootstrap.init_app(application)
@@ -32,6 +31,8 @@ def init_app(
     if db:
         db.init_app(application)
     if feature_flags:
+        from flask_featureflags.contrib.inline import InlineFeatureFlag
+
         # Standardize FeatureFlags, only accept inline config variables
         feature_flags.init_app(application)
         feature_flags.clear_handlers()
@@ -67,30 +68,61 @@ def init_app(
             **(application.config['BASE_TEMPLATE_DATA'] or {}))
 
 
+def _may_be_enabled(application, setting):
+    """Whether the app's config or the environment could turn on `setting`, which hasn't been declared yet"""
+    return bool(application.config.get(setting)) or setting in os.environ
+
+
+def _init_opt_in_modules(application):
+    # only imported by the apps that might have turned them on
+    if _may_be_enabled(application, 'DM_TRACING_ENABLED'):
+        from . import tracing
+        tracing.init_app(application)
+    if _may_be_enabled(application, 'DM_METRICS_ENDPOINT_ENABLED'):
+        from . import prometheus
+        prometheus.init_app(application)
+
+
 def pluralize(count, singular, plural):
     return singular if count == 1 else plural
 
 
+# this method is deprecated - `init_manager` watches extra directories itself now
 def get_extra_files(paths):
-    for path in paths:
-        for dirname, dirs, files in os.walk(path):
-            for filename in files:
-                filename = os.path.join(dirname, filename)
-                if os.path.isfile(filename):
-                    yield filename
+    """Every file in `paths`, as `file_watcher.iter_files` finds them"""
+    from . import file_watcher
+
+    return file_watcher.iter_files(paths, include=("*",), exclude=())
 
 
-def init_manager(application, port, extra_directories=()):
+def init_manager(
+        application,
+        port,
+        extra_directories=(),
+        include=None,
+        exclude=None,
+):
+    # only needed by the dev server and management commands, so not worth importing for every app process
+    from flask_script import Manager, Server
 
     manager = Manager(application)
 
-    extra_files = list(get_extra_files(extra_directories))
+    # werkzeug's reloader runs the server in a child process with WERKZEUG_RUN_MAIN set, restarting it whenever it
+    # exits with code 3. rather than handing it every file in extra_directories to stat each second, we watch them
+    # ourselves in that child (see `file_watcher`) and exit with 3 ourselves when anything changes.
+    if extra_directories and os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        from . import file_watcher
 
-    logging.logger.debug("Watching {} extra files".format(len(extra_files)))
+        file_watcher.exit_on_change(
+            extra_directories,
+            include=file_watcher.DEFAULT_INCLUDE if include is None else include,
+            exclude=file_watcher.DEFAULT_EXCLUDE if exclude is None else exclude,
+        )
+        logging.logger.debug("Watching {} for changes".format(", ".join(extra_directories)))
 
     manager.add_command(
         "runserver",
-        Server(port=port, extra_files=extra_files)
+        Server(port=port)
     )
 
     @manager.command
@@ -0,0 +1,53 @@
+"""
+    Re-creating per-process state in a process forked from one that already had it set up - most usefully gunicorn
+    workers forked from a master that has loaded the app with `--preload`, so that they share its memory
+    copy-on-write instead of each loading their own.
+
+    Anything holding connections, locks or threads which mustn't be shared with the parent (the CloudWatch and S3
+    clients' connection pools, the metrics and span exporting threads, ...) registers a hook with
+    `register_after_fork` to replace them in the child.
+
+    On python 3.7+ the hooks run automatically in the child after every `os.fork`. Elsewhere, run them from gunicorn's
+    `post_fork` server hook:
+
+        # gunicorn.conf.py
+        def post_fork(server, worker):
+            from dmutils.fork_hooks import run_after_fork_hooks
+            run_after_fork_hooks()
+
+    which is harmless to do on 3.7+ too - the hooks only ever run once per process.
+"""
+from __future__ import absolute_import
+
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+_hooks = []
+_pid = os.getpid()
+
+
+def register_after_fork(hook):
+    """Have `hook` called with no arguments in every process forked from this one. Can be used as a decorator."""
+    _hooks.append(hook)
+    return hook
+
+
+def run_after_fork_hooks():
+    """Run the registered hooks, in the order they were registered, unless they've already run in this process"""
+    global _pid
+    if os.getpid() == _pid:
+        return
+    _pid = os.getpid()
+
+    for hook in _hooks:
+        try:
+            hook()
+        except Exception:
+            # a hook failing should leave the worker no worse off than if we hadn't tried
+            logger.exception("After fork hook {hook} failed", extra={'hook': getattr(hook, '__name__', repr(hook))})
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=run_after_fork_hooks)
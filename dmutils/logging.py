@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 import logging
+import os
 import sys
 import re
 
@@ -8,15 +9,25 @@ from flask.ctx import has_request_context
 
 from pythonjsonlogger.jsonlogger import JsonFormatter as BaseJSONFormatter
 
+from .config import declare_settings, Setting
+from .fork_hooks import register_after_fork
+from .trace_context import get_trace_id
+
 LOG_FORMAT = '%(asctime)s %(app_name)s %(name)s %(levelname)s ' \
              '%(request_id)s "%(message)s" [in %(pathname)s:%(lineno)d]'
 
+# the field `dmutils.metrics.EMFClient` puts its metadata in. Embedded Metric Format wants it under "_aws", but
+# python-json-logger drops any field beginning with an underscore, so `JSONFormatter` renames it on the way out.
+EMF_METADATA_FIELD = 'emf_metadata'
+
 logger = logging.getLogger(__name__)
 
 
 def init_app(app):
-    app.config.setdefault('DM_LOG_LEVEL', 'INFO')
-    app.config.setdefault('DM_APP_NAME', 'none')
+    declare_settings(app, {
+        'DM_LOG_LEVEL': Setting(str, 'INFO'),
+        'DM_APP_NAME': Setting(str, 'none'),
+    })
 
     @app.after_request
     def after_request(response):
@@ -44,6 +55,18 @@ def init_app(app):
     app.logger.info("Logging configured")
 
 
+@register_after_fork
+def _reinit_handler_locks():
+    # python 3.7+ does this itself. before that, a handler's lock held by another thread at the moment of the fork would
+    # stay held forever in the child, hanging the first thing to log through it.
+    if hasattr(os, "register_at_fork"):
+        return
+    for handler_ref in list(logging._handlerList):
+        handler = handler_ref()
+        if handler is not None:
+            handler.createLock()
+
+
 def configure_handler(handler, app, formatter):
     handler.setLevel(logging.getLevelName(app.config['DM_LOG_LEVEL']))
     handler.setFormatter(formatter)
@@ -83,7 +106,8 @@ class RequestIdFilter(logging.Filter):
         if has_request_context() and hasattr(request, 'request_id'):
             return request.request_id
         else:
-            return 'no-request-id'
+            # outside of a request (or in a thread it has handed work to) there may still be a trace context about
+            return get_trace_id() or 'no-request-id'
 
     def filter(self, record):
         record.request_id = self.request_id
@@ -133,6 +157,8 @@ class JSONFormatter(BaseJSONFormatter):
         }
         for key, newkey in rename_map.items():
             log_record[newkey] = log_record.pop(key)
+        if EMF_METADATA_FIELD in log_record:
+            log_record['_aws'] = log_record.pop(EMF_METADATA_FIELD)
         log_record['logType'] = "application"
         try:
             log_record['message'] = log_record['message'].format(**log_record)
@@ -1,11 +1,45 @@
+from __future__ import absolute_import
+import atexit
+import calendar
 import copy
+import logging
+import math
+import os
+import threading
+import weakref
 from datetime import datetime
 
-from boto.ec2.cloudwatch import connect_to_region
-from flask import current_app, _app_ctx_stack as stack
+import six
+from flask import _app_ctx_stack as stack
 from contextlib2 import ContextDecorator
 from monotonic import monotonic
 
+from .config import declare_settings, get_config_snapshot, Setting
+from .fork_hooks import register_after_fork
+from .logging import EMF_METADATA_FIELD
+
+logger = logging.getLogger(__name__)
+
+# the most MetricData members CloudWatch will accept in a single PutMetricData call
+MAX_METRICS_PER_REQUEST = 20
+
+# attributes every LogRecord has, which therefore can't be used as metric or dimension names in an EMF log line
+_LOG_RECORD_ATTRIBUTES = frozenset(
+    logging.LogRecord(None, None, "", 0, "", (), None).__dict__
+) | frozenset(("message", "asctime"))
+
+# the percentiles published, as `<name>.p50` etc, for each timer recorded into a BufferedClient
+TIMER_PERCENTILES = (50, 90, 99)
+
+_buffered_client_lock = threading.Lock()
+
+_cloudwatch_clients = {}
+_cloudwatch_clients_lock = threading.Lock()
+
+# every BufferedClient in the process, so that they can be given their own thread in a process forked from this one,
+# and closed at exit - without keeping those that are no longer used alive
+_buffered_client_instances = weakref.WeakSet()
+
 
 def flask_client():
     return CloudWatchFlaskClient()
@@ -14,8 +48,13 @@ def flask_client():
 class CloudWatchFlaskClient(object):
     def init_app(self, app):
         c = app.config
-        c.setdefault('DM_METRICS_REGION', 'eu-west-1')
-        c.setdefault('DM_METRICS_NAMESPACE', c.get('DM_ENVIRONMENT', 'none'))
+        declare_settings(app, {
+            'DM_METRICS_REGION': Setting(str, 'eu-west-1'),
+            'DM_METRICS_NAMESPACE': Setting(str, c.get('DM_ENVIRONMENT', 'none')),
+            'DM_METRICS_BACKEND': Setting(str, 'cloudwatch'),
+            'DM_METRICS_BUFFERED': Setting(bool, False),
+            'DM_METRICS_FLUSH_INTERVAL': Setting(float, 60),
+        })
         dimensions = {
             "applicationName": c.get('DM_APP_NAME', 'none'),
         }
@@ -27,25 +66,87 @@ class CloudWatchFlaskClient(object):
         ctx = stack.top
         if ctx is not None:
             if not hasattr(ctx, 'dmutils_metrics_client'):
-                ctx.dmutils_metrics_client = client(
-                    current_app.config['DM_METRICS_REGION'],
-                    current_app.config['DM_METRICS_NAMESPACE'],
-                    current_app.config['DM_METRICS_DIMENSIONS'])
+                # the declared settings as checked and frozen once, rather than looked up afresh for every context
+                settings = get_config_snapshot(ctx.app)
+                if settings.DM_METRICS_BACKEND == 'emf':
+                    ctx.dmutils_metrics_client = emf_client(
+                        settings.DM_METRICS_NAMESPACE,
+                        ctx.app.config['DM_METRICS_DIMENSIONS'])
+                elif settings.DM_METRICS_BUFFERED:
+                    ctx.dmutils_metrics_client = self._get_buffered_client(ctx.app, settings)
+                else:
+                    ctx.dmutils_metrics_client = client(
+                        settings.DM_METRICS_REGION,
+                        settings.DM_METRICS_NAMESPACE,
+                        ctx.app.config['DM_METRICS_DIMENSIONS'])
             return ctx.dmutils_metrics_client
 
+    @staticmethod
+    def _get_buffered_client(app, settings):
+        """
+            A buffered client has to outlive the app context - it owns the buffer and the thread flushing it - so we
+            keep a single one per app.
+        """
+        with _buffered_client_lock:
+            if 'dmutils_metrics_buffered_client' not in app.extensions:
+                app.extensions['dmutils_metrics_buffered_client'] = buffered_client(
+                    settings.DM_METRICS_REGION,
+                    settings.DM_METRICS_NAMESPACE,
+                    app.config['DM_METRICS_DIMENSIONS'],
+                    flush_interval=settings.DM_METRICS_FLUSH_INTERVAL)
+            return app.extensions['dmutils_metrics_buffered_client']
+
+
+def get_cloudwatch_client(region):
+    """
+        The boto3 CloudWatch client for `region`, created the first time it is asked for and then shared by the whole
+        process. boto3 clients are thread-safe, so every app context and thread can reuse the one connection pool.
+    """
+    try:
+        return _cloudwatch_clients[region]
+    except KeyError:
+        with _cloudwatch_clients_lock:
+            if region not in _cloudwatch_clients:
+                # imported here rather than at the top, as apps sending metrics as EMF log lines have no need of it
+                import boto3
+
+                # boto3's default session isn't thread-safe, so we give each client its own
+                _cloudwatch_clients[region] = boto3.session.Session().client("cloudwatch", region_name=region)
+            return _cloudwatch_clients[region]
+
 
 def client(region, namespace, default_dimensions=None):
     return CloudWatchClient(region, namespace, default_dimensions)
 
 
+def buffered_client(region, namespace, default_dimensions=None, **kwargs):
+    return BufferedClient(client(region, namespace, default_dimensions), **kwargs)
+
+
+def emf_client(namespace, default_dimensions=None):
+    return EMFClient(namespace, default_dimensions)
+
+
 class CloudWatchClient(object):
     def __init__(self, region, namespace, default_dimensions=None):
-        self._conn = connect_to_region(region)
+        self.region = region
+        self._connect()
         self.namespace = namespace
         if default_dimensions is None:
             default_dimensions = dict()
         self.default_dimensions = default_dimensions
 
+    def _connect(self):
+        self._connection = get_cloudwatch_client(self.region)
+        self._connection_pid = os.getpid()
+
+    @property
+    def _conn(self):
+        # a process forked from the one we were created in needs a client of its own
+        if self._connection_pid != os.getpid():
+            self._connect()
+        return self._connection
+
     def dimensions(self, dimensions):
         _dimensions = copy.copy(self.default_dimensions)
         if dimensions is not None:
@@ -54,32 +155,386 @@ class CloudWatchClient(object):
 
     def _put_metric(self, name, value=None, timestamp=None, unit=None,
                     dimensions=None, statistics=None):
-        if timestamp is None:
-            timestamp = datetime.utcnow()
         self._conn.put_metric_data(
-            namespace=self.namespace,
-            name=name,
-            value=value,
-            timestamp=timestamp,
-            unit=unit,
-            dimensions=self.dimensions(dimensions),
-            statistics=statistics)
+            Namespace=self.namespace,
+            MetricData=[self._metric_datum(name, value, timestamp, unit, dimensions, statistics)])
+
+    def _put_statistic_sets(self, metrics):
+        """
+            Send several StatisticSets in a single call. `metrics` is a list of at most MAX_METRICS_PER_REQUEST dicts
+            with the keys `name`, `timestamp`, `unit`, `dimensions` and `statistics`.
+        """
+        self._conn.put_metric_data(
+            Namespace=self.namespace,
+            MetricData=[self._metric_datum(**metric) for metric in metrics])
+
+    def _metric_datum(self, name, value=None, timestamp=None, unit=None, dimensions=None, statistics=None):
+        """
+            Translate our arguments - which follow the form boto2's `put_metric_data` took - into a boto3 MetricDatum
+        """
+        if value is None and statistics is None:
+            raise ValueError("Must specify a value or statistics to put")
+
+        datum = {
+            "MetricName": name,
+            "Timestamp": timestamp or datetime.utcnow(),
+            "Dimensions": [
+                # boto3 only accepts strings
+                {"Name": dimension_name, "Value": six.text_type(dimension_value)}
+                for dimension_name, dimension_value in sorted(self.dimensions(dimensions).items())
+            ],
+        }
+        if unit is not None:
+            datum["Unit"] = unit
+        if statistics is not None:
+            datum["StatisticValues"] = {
+                "SampleCount": statistics["samplecount"],
+                "Sum": statistics["sum"],
+                "Minimum": statistics["minimum"],
+                "Maximum": statistics["maximum"],
+            }
+        else:
+            datum["Value"] = value
+        return datum
+
+    def timing(self, name, milliseconds, dimensions=None):
+        self._put_metric(name, int(milliseconds), unit="Milliseconds", dimensions=dimensions)
+
+    def timer(self, name, dimensions=None):
+        return Timer(self, name, dimensions)
+
+
+class EMFClient(object):
+    """
+        Writes each metric as a log line in CloudWatch's Embedded Metric Format
+        https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format.html
+        through the `dmutils.metrics` logger - and so through the JSON handler `dmutils.logging.init_app` sets up -
+        rather than calling the CloudWatch API. CloudWatch extracts the metrics when the logs are ingested, so recording
+        one costs nothing on the request path. Each timing is logged at full precision, leaving CloudWatch to work out
+        percentiles, so this client doesn't need a `BufferedClient` in front of it.
+    """
+
+    def __init__(self, namespace, default_dimensions=None):
+        self.namespace = namespace
+        if default_dimensions is None:
+            default_dimensions = dict()
+        self.default_dimensions = default_dimensions
+
+    def dimensions(self, dimensions):
+        _dimensions = copy.copy(self.default_dimensions)
+        if dimensions is not None:
+            _dimensions.update(dimensions)
+        return _dimensions
+
+    def _put_metric(self, name, value=None, timestamp=None, unit=None,
+                    dimensions=None, statistics=None):
+        if statistics is not None:
+            raise ValueError("StatisticSets can't be represented in Embedded Metric Format")
+        if value is None:
+            raise ValueError("Must specify a value to put")
+
+        dimensions = self.dimensions(dimensions)
+        clashing_names = _LOG_RECORD_ATTRIBUTES.intersection(set(dimensions) | set((name,)))
+        if clashing_names:
+            raise ValueError("Can't use {} as metric or dimension names".format(", ".join(sorted(clashing_names))))
+
+        metric = {"Name": name}
+        if unit is not None:
+            metric["Unit"] = unit
+
+        fields = dict(
+            (dimension_name, six.text_type(dimension_value))
+            for dimension_name, dimension_value in dimensions.items()
+        )
+        fields[name] = value
+        fields[EMF_METADATA_FIELD] = {
+            "Timestamp": _epoch_milliseconds(timestamp or datetime.utcnow()),
+            "CloudWatchMetrics": [{
+                "Namespace": self.namespace,
+                "Dimensions": [sorted(dimensions)],
+                "Metrics": [metric],
+            }],
+        }
+        logger.info("Embedded metrics", extra=fields)
+
+    def timing(self, name, milliseconds, dimensions=None):
+        self._put_metric(name, milliseconds, unit="Milliseconds", dimensions=dimensions)
+
+    def timer(self, name, dimensions=None):
+        return Timer(self, name, dimensions)
+
+
+def _epoch_milliseconds(timestamp):
+    return calendar.timegm(timestamp.utctimetuple()) * 1000 + timestamp.microsecond // 1000
+
+
+class BufferedClient(object):
+    """
+        Wraps a metrics client so that datapoints are rolled up in memory into a StatisticSet per metric name, unit and
+        set of dimensions instead of each being sent as it is recorded. Timings (including everything measured with
+        `timer()`) are recorded at full precision into a `Histogram` per name and set of dimensions, which is
+        published as a StatisticSet under the timer's name (giving count, sum, minimum and maximum) plus a value for
+        each of TIMER_PERCENTILES under `<name>.p<percentile>`.
+
+        A background thread sends the buffered StatisticSets in batches of up to MAX_METRICS_PER_REQUEST every
+        `flush_interval` seconds, or sooner if the buffer fills up.
+
+        The buffer is bounded by the number of distinct series it holds: datapoints for a new series arriving while it
+        is full are dropped (and counted in `dropped`) rather than blocking the caller. Anything still buffered is sent
+        when `close` is called, which happens automatically at interpreter exit for clients still in use - a client
+        garbage collected without being closed loses whatever it hadn't yet sent.
+    """
+
+    def __init__(self, client, flush_interval=60, max_buffer_size=1000):
+        self.client = client
+        self.flush_interval = flush_interval
+        self.max_buffer_size = max_buffer_size
+        self.dropped = 0
+
+        self._buffer = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._closed = threading.Event()
+        self._thread = None
+
+        _buffered_client_instances.add(self)
+
+    @property
+    def namespace(self):
+        return self.client.namespace
+
+    def dimensions(self, dimensions):
+        return self.client.dimensions(dimensions)
+
+    def _put_metric(self, name, value=None, timestamp=None, unit=None,
+                    dimensions=None, statistics=None):
+        if statistics is None:
+            if value is None:
+                raise ValueError("Must specify a value or statistics to put")
+            statistics = {'samplecount': 1, 'sum': value, 'minimum': value, 'maximum': value}
+
+        dimensions = self.dimensions(dimensions)
+        key = (name, unit, tuple(sorted(dimensions.items())))
+
+        with self._lock:
+            buffered = self._buffer.get(key)
+            if buffered is not None:
+                _merge_statistics(buffered['statistics'], statistics)
+            elif len(self._buffer) < self.max_buffer_size:
+                self._buffer[key] = {
+                    'name': name,
+                    'timestamp': timestamp or datetime.utcnow(),
+                    'unit': unit,
+                    'dimensions': dimensions,
+                    'statistics': dict(statistics),
+                }
+            else:
+                self.dropped += 1
+            full = self._buffer_size() >= self.max_buffer_size
+
+        self._start_thread()
+        if full:
+            self._flush_requested.set()
+
+    def timing(self, name, milliseconds, dimensions=None):
+        dimensions = self.dimensions(dimensions)
+        key = (name, tuple(sorted(dimensions.items())))
+
+        with self._lock:
+            buffered = self._histograms.get(key)
+            if buffered is None and self._buffer_size() < self.max_buffer_size:
+                buffered = self._histograms[key] = {
+                    'name': name,
+                    'timestamp': datetime.utcnow(),
+                    'dimensions': dimensions,
+                    'histogram': Histogram(),
+                }
+            if buffered is not None:
+                buffered['histogram'].record(milliseconds)
+            else:
+                self.dropped += 1
+            full = self._buffer_size() >= self.max_buffer_size
+
+        self._start_thread()
+        if full:
+            self._flush_requested.set()
+
+    def timer(self, name, dimensions=None):
+        return Timer(self, name, dimensions)
+
+    def flush(self):
+        """Send everything currently buffered, blocking until done."""
+        with self._lock:
+            metrics, self._buffer = list(self._buffer.values()), {}
+            histograms, self._histograms = self._histograms, {}
+
+        for buffered in histograms.values():
+            metrics.extend(self._histogram_statistic_sets(**buffered))
+
+        for i in range(0, len(metrics), MAX_METRICS_PER_REQUEST):
+            try:
+                self.client._put_statistic_sets(metrics[i:i + MAX_METRICS_PER_REQUEST])
+            except Exception:
+                # sending metrics must never take down the flushing thread, nor the caller of `close`
+                logger.exception("Failed to send {count} buffered metrics", extra={
+                    'count': len(metrics[i:i + MAX_METRICS_PER_REQUEST]),
+                })
+
+    def close(self):
+        """Stop the background thread and send anything left in the buffer."""
+        self._closed.set()
+        self._flush_requested.set()
+        if self._thread is not None:
+            self._thread.join(self.flush_interval)
+        self.flush()
+
+    def _buffer_size(self):
+        return len(self._buffer) + len(self._histograms)
+
+    @staticmethod
+    def _histogram_statistic_sets(name, timestamp, dimensions, histogram):
+        yield {
+            'name': name,
+            'timestamp': timestamp,
+            'unit': "Milliseconds",
+            'dimensions': dimensions,
+            'statistics': {
+                'samplecount': histogram.count,
+                'sum': histogram.sum,
+                'minimum': histogram.minimum,
+                'maximum': histogram.maximum,
+            },
+        }
+        for percentile in TIMER_PERCENTILES:
+            value = histogram.percentile(percentile)
+            yield {
+                'name': "{}.p{}".format(name, percentile),
+                'timestamp': timestamp,
+                'unit': "Milliseconds",
+                'dimensions': dimensions,
+                'statistics': {'samplecount': 1, 'sum': value, 'minimum': value, 'maximum': value},
+            }
+
+    def _start_thread(self):
+        if self._thread is not None or self._closed.is_set():
+            return
+        with self._lock:
+            if self._thread is None:
+                # holding only a weak reference to us, so that we can be garbage collected while it runs
+                self._thread = threading.Thread(
+                    target=self._run, args=(weakref.ref(self),), name="dmutils-metrics-flush",
+                )
+                self._thread.daemon = True
+                self._thread.start()
+
+    @staticmethod
+    def _run(ref):
+        while True:
+            client = ref()
+            if client is None or client._closed.is_set():
+                return
+            flush_requested, flush_interval = client._flush_requested, client.flush_interval
+            # not keeping it alive while we wait
+            del client
+            flush_requested.wait(flush_interval)
+            flush_requested.clear()
+            client = ref()
+            if client is None:
+                return
+            client.flush()
+            del client
+
+    def _reset_after_fork(self):
+        # whatever was buffered before the fork is for the parent to send, and its flushing thread didn't come with us
+        closed = self._closed.is_set()
+        self._buffer = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._closed = threading.Event()
+        if closed:
+            self._closed.set()
+        self._thread = None
+
+
+@register_after_fork
+def _reset_after_fork():
+    global _buffered_client_lock, _cloudwatch_clients_lock
+    _buffered_client_lock = threading.Lock()
+    _cloudwatch_clients_lock = threading.Lock()
+    # boto3 clients' connection pools can't be shared with the parent
+    _cloudwatch_clients.clear()
+    for buffered_client in list(_buffered_client_instances):
+        buffered_client._reset_after_fork()
+
+
+@atexit.register
+def _close_buffered_clients():
+    for buffered_client in list(_buffered_client_instances):
+        buffered_client.close()
+
+
+def _merge_statistics(statistics, other):
+    statistics['samplecount'] += other['samplecount']
+    statistics['sum'] += other['sum']
+    statistics['minimum'] = min(statistics['minimum'], other['minimum'])
+    statistics['maximum'] = max(statistics['maximum'], other['maximum'])
+
+
+class Histogram(object):
+    """
+        A compact histogram of positive values using fixed log-scale buckets: a value is counted in the bucket whose
+        upper bound is the next power of GROWTH above it, so percentiles read back are never more than 5% above the true
+        value, and only buckets that have actually been hit take up any space. Also keeps the exact count, sum,
+        minimum and maximum.
+    """
+
+    GROWTH = 1.05
+    # values smaller than this all share the lowest bucket
+    MIN_VALUE = 0.001
+
+    _log_growth = math.log(GROWTH)
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0
+        self.minimum = None
+        self.maximum = None
+
+    def record(self, value):
+        index = int(math.ceil(math.log(max(value, self.MIN_VALUE)) / self._log_growth))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+    def percentile(self, percentile):
+        """The (approximate) value below which `percentile` percent of recorded values fall, or None if empty"""
+        if not self.count:
+            return None
 
-    def timer(self, name):
-        return Timer(self, name)
+        rank = max(1, int(math.ceil(self.count * percentile / 100.0)))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                break
+        # a bucket's upper bound can lie outside the range of values actually recorded
+        return min(max(self.GROWTH ** index, self.minimum), self.maximum)
 
 
 class Timer(ContextDecorator):
-    def __init__(self, client, name):
+    def __init__(self, client, name, dimensions=None):
         self.client = client
         self.name = name
+        self.dimensions = dimensions
 
     def __enter__(self):
         self.start = monotonic()
 
     def __exit__(self, *exc):
         elapsed = monotonic() - self.start
-        self.client._put_metric(
-            self.name,
-            int(elapsed * 1000),
-            unit="Milliseconds")
+        self.client.timing(self.name, elapsed * 1000, dimensions=self.dimensions)
@@ -0,0 +1,444 @@
+"""
+    A lightweight, Prometheus-style, in-process registry of counters, gauges and histograms, with a Flask blueprint
+    exposing them in the Prometheus text format at `/_metrics`.
+
+    Usage:
+
+        from dmutils.prometheus import REGISTRY
+
+        emails_sent = REGISTRY.counter("emails_sent_total", "Emails sent through Notify", ("template",))
+        emails_sent.labels(template="invite").inc()
+
+    Under gunicorn each worker would normally only be able to report its own share of the metrics. Setting
+    DM_METRICS_MULTIPROCESS_DIR makes every process keep its values in a memory-mapped file in that directory instead,
+    and `/_metrics` then reports the totals across all of them. Note that this means gauges are summed across processes
+    too. The directory should be emptied when the app is (re)deployed.
+"""
+from __future__ import absolute_import
+
+from bisect import bisect_left
+from collections import OrderedDict
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import weakref
+
+from flask import Blueprint, Response, current_app, g, request
+from monotonic import monotonic
+import six
+
+from .config import declare_settings, Setting
+from .fork_hooks import register_after_fork
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, float("inf"))
+
+
+# every Registry in the process, so that their locks can be replaced in a process forked from this one
+_registry_instances = weakref.WeakSet()
+
+
+class Registry(object):
+    def __init__(self, multiprocess_dir=None):
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+        self.set_multiprocess_dir(multiprocess_dir)
+        _registry_instances.add(self)
+
+    def set_multiprocess_dir(self, multiprocess_dir):
+        """
+            Switch where values are kept - in memory if `multiprocess_dir` is None, otherwise in a memory-mapped file
+            per process in that directory. Values recorded before switching are not carried over.
+        """
+        self._values = _MmapValues(multiprocess_dir) if multiprocess_dir else _InProcessValues()
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def _get_or_create(self, metric_class, name, documentation, labelnames, **kwargs):
+        """
+            Metrics are usually declared at import time or in an `init_app`, which may happen more than once per
+            process (particularly in tests), so asking for an existing metric again just returns it.
+        """
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(self, name, documentation, labelnames, **kwargs)
+            elif type(metric) is not metric_class or metric.labelnames != tuple(labelnames):
+                raise ValueError("Metric {} already registered as a different type or with different labels".format(
+                    name
+                ))
+            return metric
+
+    def render(self):
+        """The current value of every registered metric, in the Prometheus text exposition format"""
+        samples = {}
+        for key, value in self._values.snapshot().items():
+            sample_name, labels = json.loads(key)
+            samples.setdefault(sample_name, []).append((tuple(tuple(label) for label in labels), value))
+
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, _escape_help(metric.documentation)))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for sample_name, labels, value in metric._samples(samples):
+                lines.append("{}{} {}".format(sample_name, _format_labels(labels), _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self._registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+
+    def labels(self, **labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("{} takes exactly the labels {}".format(self.name, ", ".join(self.labelnames)))
+
+        label_values = tuple(six.text_type(labels[labelname]) for labelname in self.labelnames)
+        child = self._children.get(label_values)
+        if child is None:
+            # creating the same child twice in a race is harmless - they'd refer to the same values
+            child = self._children[label_values] = self._child(tuple(zip(self.labelnames, label_values)))
+        return child
+
+    def _key(self, sample_name, labels):
+        return json.dumps([sample_name, sorted(labels)])
+
+    def _samples(self, samples):
+        """(sample name, labels, value) for every sample of this metric found in `samples`"""
+        found = sorted(samples.get(self.name, ()))
+        if not found and not self.labelnames:
+            found = [((), 0.0)]
+        for labels, value in found:
+            yield self.name, labels, value
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _child(self, labels):
+        return _CounterChild(self._registry, self._key(self.name, labels))
+
+
+class _CounterChild(object):
+    def __init__(self, registry, key):
+        self._registry = registry
+        self._key = key
+
+    def inc(self, amount=1):
+        if amount < 0:
+            raise ValueError("Counters can only be increased")
+        self._registry._values.inc(((self._key, amount),))
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def _child(self, labels):
+        return _GaugeChild(self._registry, self._key(self.name, labels))
+
+
+class _GaugeChild(object):
+    def __init__(self, registry, key):
+        self._registry = registry
+        self._key = key
+
+    def set(self, value):
+        self._registry._values.set(self._key, value)
+
+    def inc(self, amount=1):
+        self._registry._values.inc(((self._key, amount),))
+
+    def dec(self, amount=1):
+        self._registry._values.inc(((self._key, -amount),))
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        if "le" in labelnames:
+            raise ValueError("Histograms can't have a label called le")
+        super(Histogram, self).__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(float(bucket) for bucket in buckets))
+        if self.buckets[-1] != float("inf"):
+            self.buckets += (float("inf"),)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _child(self, labels):
+        return _HistogramChild(
+            self._registry,
+            self.buckets,
+            [self._key(self.name + "_bucket", labels + (("le", _format_value(bucket)),)) for bucket in self.buckets],
+            self._key(self.name + "_sum", labels),
+        )
+
+    def _samples(self, samples):
+        # buckets are stored non-cumulatively so that observing a value only has to touch one of them, and the count is
+        # the total of all the buckets
+        buckets = {}
+        for labels, value in samples.get(self.name + "_bucket", ()):
+            labels = dict(labels)
+            le = labels.pop("le")
+            buckets.setdefault(tuple(sorted(labels.items())), {})[float(le)] = value
+
+        for labels, sum_ in sorted(samples.get(self.name + "_sum", ())):
+            cumulative = 0.0
+            for bucket in self.buckets:
+                cumulative += buckets.get(labels, {}).get(bucket, 0.0)
+                yield self.name + "_bucket", labels + (("le", _format_value(bucket)),), cumulative
+            yield self.name + "_sum", labels, sum_
+            yield self.name + "_count", labels, cumulative
+
+
+class _HistogramChild(object):
+    def __init__(self, registry, buckets, bucket_keys, sum_key):
+        self._registry = registry
+        self._buckets = buckets
+        self._bucket_keys = bucket_keys
+        self._sum_key = sum_key
+
+    def observe(self, value):
+        bucket_key = self._bucket_keys[bisect_left(self._buckets, value)]
+        self._registry._values.inc(((bucket_key, 1), (self._sum_key, value)))
+
+
+@register_after_fork
+def _reset_after_fork():
+    # a lock held by another thread at the moment of the fork would otherwise stay held forever in the child. a
+    # multiprocess registry's values will go to a new file of the child's own the next time one is written.
+    for registry in list(_registry_instances):
+        registry._lock = threading.Lock()
+        registry._values._lock = threading.Lock()
+
+
+class _InProcessValues(object):
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amounts):
+        with self._lock:
+            for key, amount in amounts:
+                self._values[key] = self._values.get(key, 0.0) + amount
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = float(value)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+
+class _MmapValues(object):
+    """
+        Values kept in a memory-mapped file per process in `directory`, so updating one costs about the same as
+        updating a dict, whose `snapshot` is the total across every process that has written to the directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None
+
+    def _own_file(self):
+        # checking the pid means a process forked from one that already had a file open starts its own
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._file = _MmapDict(os.path.join(self.directory, "{}.db".format(self._pid)))
+        return self._file
+
+    def inc(self, amounts):
+        with self._lock:
+            own_file = self._own_file()
+            for key, amount in amounts:
+                own_file.write(key, own_file.read(key) + amount)
+
+    def set(self, key, value):
+        with self._lock:
+            self._own_file().write(key, float(value))
+
+    def snapshot(self):
+        totals = {}
+        for path in glob.glob(os.path.join(self.directory, "*.db")):
+            for key, value in _MmapDict.read_all(path):
+                totals[key] = totals.get(key, 0.0) + value
+        return totals
+
+
+class _MmapDict(object):
+    """
+        A file of string keys and float values. It starts with a 4 byte count of the bytes in use, followed by entries
+        each made up of a 4 byte key length, the utf-8 key, padding to 8 bytes and an 8 byte double. The count is
+        only updated after an entry has been written, so other processes can read the file safely at any time.
+    """
+
+    _INITIAL_SIZE = 64 * 1024
+    _HEADER_SIZE = 8
+
+    def __init__(self, path):
+        self._f = open(path, "a+b")
+        if os.fstat(self._f.fileno()).st_size == 0:
+            self._f.truncate(self._INITIAL_SIZE)
+        self._capacity = os.fstat(self._f.fileno()).st_size
+        self._mmap = mmap.mmap(self._f.fileno(), self._capacity)
+
+        self._used = struct.unpack_from("i", self._mmap, 0)[0] or self._HEADER_SIZE
+        self._positions = dict(
+            (key, position) for key, _, position in self._entries(self._mmap, self._used)
+        )
+
+    @classmethod
+    def read_all(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) < cls._HEADER_SIZE:
+            return
+        for key, value, _ in cls._entries(data, struct.unpack_from("i", data, 0)[0]):
+            yield key, value
+
+    @classmethod
+    def _entries(cls, data, used):
+        position = cls._HEADER_SIZE
+        while position < used:
+            length = struct.unpack_from("i", data, position)[0]
+            key = data[position + 4:position + 4 + length].decode("utf-8")
+            position += 4 + length + (-(4 + length) % 8)
+            yield key, struct.unpack_from("d", data, position)[0], position
+            position += 8
+
+    def read(self, key):
+        position = self._positions.get(key)
+        return 0.0 if position is None else struct.unpack_from("d", self._mmap, position)[0]
+
+    def write(self, key, value):
+        position = self._positions.get(key)
+        if position is None:
+            position = self._add_entry(key)
+        struct.pack_into("d", self._mmap, position, value)
+
+    def _add_entry(self, key):
+        encoded_key = key.encode("utf-8")
+        padding = -(4 + len(encoded_key)) % 8
+        entry = struct.pack("i", len(encoded_key)) + encoded_key + b" " * padding + struct.pack("d", 0.0)
+
+        while self._used + len(entry) > self._capacity:
+            self._mmap.close()
+            self._capacity *= 2
+            self._f.truncate(self._capacity)
+            self._mmap = mmap.mmap(self._f.fileno(), self._capacity)
+
+        self._mmap[self._used:self._used + len(entry)] = entry
+        self._used += len(entry)
+        struct.pack_into("i", self._mmap, 0, self._used)
+
+        position = self._used - 8
+        self._positions[key] = position
+        return position
+
+
+def _escape_help(documentation):
+    return documentation.replace("\\", r"\\").replace("\n", r"\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"'))
+        for name, value in labels
+    ) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+REGISTRY = Registry()
+
+metrics = Blueprint('metrics', __name__)
+
+
+@metrics.route('/_metrics')
+def render_metrics():
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+def init_app(app):
+    """
+        If DM_METRICS_ENDPOINT_ENABLED is set, expose REGISTRY at `/_metrics` and count and time every request by
+        endpoint.
+    """
+    declare_settings(app, {
+        'DM_METRICS_ENDPOINT_ENABLED': Setting(bool, False),
+        'DM_METRICS_MULTIPROCESS_DIR': Setting(str),
+    })
+
+    if not app.config['DM_METRICS_ENDPOINT_ENABLED']:
+        return
+
+    if app.config['DM_METRICS_MULTIPROCESS_DIR']:
+        REGISTRY.set_multiprocess_dir(app.config['DM_METRICS_MULTIPROCESS_DIR'])
+
+    requests_total = REGISTRY.counter(
+        "http_requests_total", "HTTP requests handled", ("app", "endpoint", "method", "status"),
+    )
+    request_duration = REGISTRY.histogram(
+        "http_request_duration_seconds", "Time taken to handle HTTP requests", ("app", "endpoint", "method"),
+    )
+
+    @app.before_request
+    def start_request_timer():
+        g.dmutils_request_start = monotonic()
+
+    @app.after_request
+    def record_request_metrics(response):
+        endpoint = request.endpoint or "none"
+        app_name = current_app.config.get('DM_APP_NAME', 'none')
+        requests_total.labels(
+            app=app_name, endpoint=endpoint, method=request.method, status=response.status_code,
+        ).inc()
+        if hasattr(g, 'dmutils_request_start'):
+            request_duration.labels(app=app_name, endpoint=endpoint, method=request.method).observe(
+                monotonic() - g.dmutils_request_start
+            )
+        return response
+
+    app.register_blueprint(metrics)
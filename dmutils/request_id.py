@@ -1,7 +1,39 @@
-import uuid
+import binascii
+import os
+from contextlib import contextmanager
 from itertools import chain
 
-from flask import request, current_app
+from flask import current_app, request
+
+from .config import declare_settings, Setting
+from .trace_context import reset_trace_context, set_trace_context, TraceContext
+
+
+# where the trace id for a request is kept in the WSGI environ once it has been worked out, so that anything handling
+# the request - whether or not it has access to flask's request context - sees the same one
+TRACE_ID_ENVIRON_KEY = "dmutils.trace_id"
+
+
+def _environ_key(header_name):
+    """The key under which a WSGI server puts the request header `header_name` in the environ"""
+    return "HTTP_" + header_name.upper().replace("-", "_")
+
+
+def _environ_keys(header_names):
+    return tuple(_environ_key(header_name) for header_name in header_names)
+
+
+def generate_trace_id(bits=128):
+    """
+        A random trace id of `bits` bits as lowercase hex - B3 accepts either 128 or 64. The default 128 bit form is
+        the same length as the `uuid4().hex` ids we used to generate, but skips building a UUID object to get there.
+    """
+    return binascii.hexlify(os.urandom(bits // 8)).decode("ascii")
+
+
+def generate_span_id():
+    """A random 64 bit span id, as the 16 lowercase hex characters B3 expects"""
+    return generate_trace_id(64)
 
 
 class RequestIdRequestMixin(object):
@@ -10,6 +42,16 @@ class RequestIdRequestMixin(object):
         headers approximately according to the "zipkin" scheme https://github.com/openzipkin/b3-propagation
     """
 
+    # each of the app's DM_*_HEADERS settings and the environ keys they correspond to, filled in on the class `init_app`
+    # creates so that they needn't be looked up in (or worked out from) `current_app.config` on every access
+    _trace_id_headers = None
+    _span_id_headers = None
+    _parent_span_id_headers = None
+    _trace_id_environ_keys = None
+    _span_id_environ_keys = None
+    _parent_span_id_environ_keys = None
+    _trace_id_bits = 128
+
     @property
     def request_id(self):
         return self.trace_id
@@ -21,7 +63,12 @@ class RequestIdRequestMixin(object):
             be used. Failing that, this will be an id we've generated and assigned ourselves.
         """
         if not hasattr(self, "_trace_id"):
-            self._trace_id = self._get_first_header(current_app.config['DM_TRACE_ID_HEADERS']) or str(uuid.uuid4().hex)
+            self._trace_id = (
+                self.environ.get(TRACE_ID_ENVIRON_KEY)
+                or self._get_first_environ(self._trace_id_environ_keys, 'DM_TRACE_ID_HEADERS')
+                or generate_trace_id(self._trace_id_bits)
+            )
+            self.environ[TRACE_ID_ENVIRON_KEY] = self._trace_id
         return self._trace_id
 
     @property
@@ -34,7 +81,7 @@ class RequestIdRequestMixin(object):
             # an environment with no span-id-aware request router, and thus would have no intermediary to prevent the
             # propagation of our span id all the way through all our onwards requests much like trace id. and the point
             # of span id is to assign identifiers to each individual request.
-            self._span_id = self._get_first_header(current_app.config['DM_SPAN_ID_HEADERS'])
+            self._span_id = self._get_first_environ(self._span_id_environ_keys, 'DM_SPAN_ID_HEADERS')
         return self._span_id
 
     @property
@@ -43,50 +90,123 @@ class RequestIdRequestMixin(object):
             The "parent span id" (in zipkin terms) set in this request's header, if present (None otherwise)
         """
         if not hasattr(self, "_parent_span_id"):
-            self._parent_span_id = self._get_first_header(current_app.config['DM_PARENT_SPAN_ID_HEADERS'])
+            self._parent_span_id = self._get_first_environ(
+                self._parent_span_id_environ_keys,
+                'DM_PARENT_SPAN_ID_HEADERS',
+            )
         return self._parent_span_id
 
-    def _get_first_header(self, header_names):
+    def _get_first_environ(self, environ_keys, config_key):
         """
-        Returns value of request's first present (and Truthy) header from header_names
+        Returns value of request's first present (and Truthy) header from environ_keys, or if this class wasn't set up
+        by `init_app`, from the header names in config_key
         """
-        for header_name in header_names:
-            if header_name in self.headers and self.headers[header_name]:
-                return self.headers[header_name]
-        else:
-            return None
+        if environ_keys is None:
+            environ_keys = _environ_keys(current_app.config[config_key])
+        environ = self.environ
+        for environ_key in environ_keys:
+            value = environ.get(environ_key)
+            if value:
+                return value
+        return None
 
     def get_onwards_request_headers(self):
         """
             Headers to add to any further (internal) http api requests we perform if we want that request to be
             considered part of this "trace id"
+
+            These only pass on this request's span - use `onwards_request_span` instead to have the onwards request
+            timed as a span of its own when tracing is enabled.
         """
+        tracing_span = getattr(self, "tracing_span", None)
+        return self._onwards_request_headers(self.span_id if tracing_span is None else tracing_span.span_id, None)
+
+    @contextmanager
+    def onwards_request_span(self, name="onwards request"):
+        """
+            Context manager giving the headers for an onwards request made within it, timing that request as a
+            child span of this request's when tracing is enabled, whose id is passed on as the onwards request's own
+        """
+        tracing_span = getattr(self, "tracing_span", None)
+        if tracing_span is None:
+            yield self._onwards_request_headers(self.span_id, None)
+            return
+
+        with tracing_span.child(name, kind="CLIENT") as onwards_span:
+            yield self._onwards_request_headers(onwards_span.span_id, tracing_span.span_id)
+
+    def _onwards_request_headers(self, span_id, parent_span_id):
         return dict(chain(
             (
                 (header_name, self.trace_id)
-                for header_name in current_app.config['DM_TRACE_ID_HEADERS']
+                for header_name in self._headers(self._trace_id_headers, 'DM_TRACE_ID_HEADERS')
                 if self.trace_id
             ),
             (
-                (header_name, self.span_id)
-                for header_name in current_app.config['DM_SPAN_ID_HEADERS']
-                if self.span_id
+                (header_name, span_id)
+                for header_name in self._headers(self._span_id_headers, 'DM_SPAN_ID_HEADERS')
+                if span_id
+            ),
+            (
+                (header_name, parent_span_id)
+                for header_name in self._headers(self._parent_span_id_headers, 'DM_PARENT_SPAN_ID_HEADERS')
+                if parent_span_id
             ),
         ))
 
+    @staticmethod
+    def _headers(header_names, config_key):
+        return current_app.config[config_key] if header_names is None else header_names
+
 
 class ResponseHeaderMiddleware(object):
-    def __init__(self, app, trace_id_headers):
+    """
+        WSGI middleware adding the request's trace id to the response under each of `trace_id_headers` the app hasn't
+        already set. It works purely from the WSGI environ, so needs no flask request context, and picks up the trace
+        id `RequestIdRequestMixin` settled on if the app got as far as asking for it.
+    """
+
+    def __init__(self, app, trace_id_headers, trace_id_bits=128):
         self.app = app
-        self.trace_id_headers = trace_id_headers
+        self.trace_id_headers = tuple(trace_id_headers)
+        self.trace_id_bits = trace_id_bits
+        self._trace_id_environ_keys = _environ_keys(self.trace_id_headers)
+        self._lowercase_trace_id_headers = tuple(header_name.lower() for header_name in self.trace_id_headers)
+        self._lowercase_trace_id_header_set = frozenset(self._lowercase_trace_id_headers)
+
+    def _trace_id(self, environ):
+        trace_id = environ.get(TRACE_ID_ENVIRON_KEY)
+        if not trace_id:
+            for environ_key in self._trace_id_environ_keys:
+                if environ.get(environ_key):
+                    trace_id = environ[environ_key]
+                    break
+            else:
+                trace_id = generate_trace_id(self.trace_id_bits)
+            environ[TRACE_ID_ENVIRON_KEY] = trace_id
+        return trace_id
 
     def __call__(self, environ, start_response):
         def rewrite_response_headers(status, headers, exc_info=None):
-            headers = headers + [
-                (header_name, str(request.request_id),)
-                for header_name in self.trace_id_headers
-                if header_name not in dict(headers)
-            ]
+            already_set = None
+            for header_name, _ in headers:
+                lowercase_header_name = header_name.lower()
+                if lowercase_header_name in self._lowercase_trace_id_header_set:
+                    if already_set is None:
+                        already_set = set()
+                    already_set.add(lowercase_header_name)
+
+            if already_set is None or len(already_set) < len(self._lowercase_trace_id_header_set):
+                trace_id = self._trace_id(environ)
+                # a new list rather than extending the app's, which it may be reusing for other responses
+                headers = headers + [
+                    (trace_id_header, trace_id)
+                    for trace_id_header, lowercase_trace_id_header in zip(
+                        self.trace_id_headers,
+                        self._lowercase_trace_id_headers,
+                    )
+                    if already_set is None or lowercase_trace_id_header not in already_set
+                ]
 
             return start_response(status, headers, exc_info)
 
@@ -94,12 +214,16 @@ class ResponseHeaderMiddleware(object):
 
 
 def init_app(app):
-    app.config.setdefault("DM_TRACE_ID_HEADERS", (
-        (app.config.get("DM_REQUEST_ID_HEADER") or "DM-Request-ID"),
-        (app.config.get("DM_DOWNSTREAM_REQUEST_ID_HEADER") or "X-B3-TraceId"),
-    ))
-    app.config.setdefault("DM_SPAN_ID_HEADERS", ("X-B3-SpanId",))
-    app.config.setdefault("DM_PARENT_SPAN_ID_HEADERS", ("X-B3-ParentSpan",))
+    declare_settings(app, {
+        "DM_TRACE_ID_HEADERS": Setting(tuple, (
+            (app.config.get("DM_REQUEST_ID_HEADER") or "DM-Request-ID"),
+            (app.config.get("DM_DOWNSTREAM_REQUEST_ID_HEADER") or "X-B3-TraceId"),
+        )),
+        "DM_SPAN_ID_HEADERS": Setting(tuple, ("X-B3-SpanId",)),
+        "DM_PARENT_SPAN_ID_HEADERS": Setting(tuple, ("X-B3-ParentSpan",)),
+        # 128 or 64 - the length of the trace ids we generate ourselves
+        "DM_TRACE_ID_BITS": Setting(int, 128),
+    })
 
     # we do something a little odd here now - back-populate the first value of DM_TRACE_ID_HEADERS back to the
     # DM_REQUEST_ID_HEADER setting, because it turns out that some components (notably the apiclient) depend on that
@@ -110,6 +234,27 @@ def init_app(app):
     # dynamically define this class as we don't necessarily know how request_class may have already been modified by
     # another init_app
     class _RequestIdRequest(RequestIdRequestMixin, app.request_class):
-        pass
+        _trace_id_headers = app.config["DM_TRACE_ID_HEADERS"]
+        _span_id_headers = app.config["DM_SPAN_ID_HEADERS"]
+        _parent_span_id_headers = app.config["DM_PARENT_SPAN_ID_HEADERS"]
+        _trace_id_environ_keys = _environ_keys(app.config["DM_TRACE_ID_HEADERS"])
+        _span_id_environ_keys = _environ_keys(app.config["DM_SPAN_ID_HEADERS"])
+        _parent_span_id_environ_keys = _environ_keys(app.config["DM_PARENT_SPAN_ID_HEADERS"])
+        _trace_id_bits = app.config["DM_TRACE_ID_BITS"]
     app.request_class = _RequestIdRequest
-    app.wsgi_app = ResponseHeaderMiddleware(app.wsgi_app, app.config['DM_TRACE_ID_HEADERS'])
+
+    @app.before_request
+    def set_request_trace_context():
+        request.trace_context_token = set_trace_context(TraceContext(request.trace_id, request.span_id))
+
+    @app.teardown_request
+    def reset_request_trace_context(exception=None):
+        # the token may legitimately be None, but won't be there at all if an earlier before_request cut things short
+        if hasattr(request, "trace_context_token"):
+            reset_trace_context(request.trace_context_token)
+
+    app.wsgi_app = ResponseHeaderMiddleware(
+        app.wsgi_app,
+        app.config['DM_TRACE_ID_HEADERS'],
+        trace_id_bits=app.config['DM_TRACE_ID_BITS'],
+    )
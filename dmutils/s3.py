@@ -22,12 +22,32 @@ default_region = "eu-west-1"
 
 class S3(object):
     def __init__(self, bucket_name, region_name=default_region):
-        self._resource = boto3.resource("s3", region_name=region_name)
-        self._bucket = self._resource.Bucket(bucket_name)
+        self.region_name = region_name
+        self._bucket_name = bucket_name
+        self._connect()
+
+    def _connect(self):
+        self._connection = boto3.resource("s3", region_name=self.region_name)
+        self._bucket_connection = self._connection.Bucket(self._bucket_name)
+        self._connection_pid = os.getpid()
+
+    @property
+    def _resource(self):
+        # a process forked from the one we were created in needs connections of its own, as boto3 resources'
+        # connection pools can't be shared with the parent
+        if self._connection_pid != os.getpid():
+            self._connect()
+        return self._connection
+
+    @property
+    def _bucket(self):
+        if self._connection_pid != os.getpid():
+            self._connect()
+        return self._bucket_connection
 
     @property
     def bucket_name(self):
-        return self._bucket.name
+        return self._bucket_name
 
     def save(self, path, file_, acl='public-read', timestamp=None, download_filename=None,
              disposition_type='attachment'):
@@ -0,0 +1,114 @@
+"""
+    The trace (request) id of whatever we're currently doing, held somewhere that outlives flask's request context and
+    can be carried across to other threads.
+
+    `request_id.init_app` sets it for the duration of each request, and `RequestIdFilter` falls back to it when there's
+    no flask request to ask, so log lines written by work handed off to a thread pool are still tagged with the id of
+    the request that started it - provided it was handed off through `submit_with_context` or `wrap_with_context`:
+
+        executor.submit(upload_file, f)                       # logs "no-request-id"
+        submit_with_context(executor, upload_file, f)         # logs the request's id
+        pool.map(wrap_with_context(send_email), addresses)    # works for multiprocessing.pool.ThreadPool too
+
+    Scripts and background jobs with no request to speak of can set one for a block of work with `trace_context`.
+
+    On pythons with `contextvars` (3.7+) the trace context is a context variable, so copying it copies every other
+    context variable along with it. Elsewhere it falls back to a thread local.
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+import functools
+import threading
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+
+TraceContext = namedtuple("TraceContext", ("trace_id", "span_id"))
+
+
+class _ThreadLocalVar(object):
+    """Just enough of `contextvars.ContextVar` for our purposes, for pythons without it"""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def get(self):
+        return getattr(self._local, "value", None)
+
+    def set(self, value):
+        token = self.get()
+        self._local.value = value
+        return token
+
+    def reset(self, token):
+        self._local.value = token
+
+
+if contextvars is not None:
+    _trace_context = contextvars.ContextVar("dmutils_trace_context", default=None)
+else:
+    _trace_context = _ThreadLocalVar()
+
+
+def get_trace_context():
+    """The current `TraceContext`, or None if there isn't one"""
+    return _trace_context.get()
+
+
+def set_trace_context(context):
+    """Make `context` current, returning a token to pass to `reset_trace_context` to restore the previous one"""
+    return _trace_context.set(context)
+
+
+def reset_trace_context(token):
+    _trace_context.reset(token)
+
+
+def wrap_with_context(fn):
+    """
+        Returns a version of `fn` which runs in a copy of the calling thread's context (or just its trace context
+        without `contextvars`), as it is now, wherever it's eventually called
+    """
+    if contextvars is not None:
+        context = contextvars.copy_context()
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            # a context can only be entered by one thread at a time, and a pool may well call us from several at once
+            return context.copy().run(fn, *args, **kwargs)
+    else:
+        current = get_trace_context()
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            token = set_trace_context(current)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                reset_trace_context(token)
+
+    return wrapper
+
+
+def get_trace_id():
+    """The current trace id, or None if there isn't one"""
+    context = get_trace_context()
+    return context.trace_id if context is not None else None
+
+
+@contextmanager
+def trace_context(trace_id, span_id=None):
+    """Run the block with `trace_id` (and `span_id`) as the current trace context"""
+    token = set_trace_context(TraceContext(trace_id, span_id))
+    try:
+        yield
+    finally:
+        reset_trace_context(token)
+
+
+def submit_with_context(executor, fn, *args, **kwargs):
+    """`executor.submit(fn, *args, **kwargs)`, with `fn` run in a copy of the calling thread's trace context"""
+    return executor.submit(wrap_with_context(fn), *args, **kwargs)
@@ -0,0 +1,305 @@
+"""
+    Lightweight request tracing in the zipkin model https://zipkin.io/pages/data_model.html
+
+    With DM_TRACING_ENABLED set, every request handled gets a SERVER span, timed from `before_request` to
+    `teardown_request`. An onwards request made in `with request.onwards_request_span("name") as headers:` gets a
+    CLIENT span that is a child of it, timed from our side, whose id is passed on in the B3 span id headers. The onwards
+    request's service, if it traces too, reports its own SERVER span under that same id, so the time spent in each hop
+    shows up beneath ours. `request.get_onwards_request_headers()` only passes on the request's own span.
+
+    Finished spans are queued and sent in batches from a background thread to a sink: by default a JSON log line per
+    batch through the `dmutils.tracing` logger, or if DM_TRACING_ZIPKIN_URL is set, a zipkin-compatible collector's
+    `/api/v2/spans` endpoint.
+"""
+from __future__ import absolute_import
+
+import atexit
+import logging
+import threading
+import time
+import weakref
+
+from flask import current_app, request
+from monotonic import monotonic
+import six
+
+from .config import declare_settings, Setting
+from .fork_hooks import register_after_fork
+from .request_id import generate_span_id
+
+logger = logging.getLogger(__name__)
+
+# every Tracer and ZipkinSink in the process, so that they can be given their own thread and connections in a process
+# forked from this one, and Tracers closed at exit - without keeping those that are no longer used alive
+_tracer_instances = weakref.WeakSet()
+_zipkin_sink_instances = weakref.WeakSet()
+
+
+class Span(object):
+    def __init__(self, tracer, trace_id, span_id, parent_id=None, name=None, kind=None, shared=False):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        # whether another service reports this span id as well (e.g. the client side of the request we're serving)
+        self.shared = shared
+        self.tags = {}
+
+        self.timestamp = time.time()
+        self.duration = None
+        self._start = monotonic()
+        self._finished = False
+
+    def child(self, name, kind=None):
+        return Span(self.tracer, self.trace_id, generate_span_id(), self.span_id, name=name, kind=kind)
+
+    def finish(self, record_duration=True):
+        """
+            Stop timing the span and queue it for export. A span whose duration we can't know should be finished
+            without recording one.
+        """
+        if self._finished:
+            return
+        self._finished = True
+        if record_duration:
+            self.duration = monotonic() - self._start
+        self.tracer.record(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.tags["error"] = six.text_type(exc_value) or exc_type.__name__
+        self.finish()
+
+    def to_zipkin(self):
+        """This span as a zipkin v2 JSON span https://zipkin.io/zipkin-api/#/default/post_spans"""
+        span = {
+            "traceId": self.trace_id,
+            "id": self.span_id,
+            "name": self.name,
+            "timestamp": int(self.timestamp * 1000000),
+            "localEndpoint": {"serviceName": self.tracer.service_name},
+            "tags": dict((key, six.text_type(value)) for key, value in self.tags.items()),
+        }
+        if self.parent_id:
+            span["parentId"] = self.parent_id
+        if self.kind:
+            span["kind"] = self.kind
+        if self.duration is not None:
+            # zipkin treats a duration of 0 as missing
+            span["duration"] = max(1, int(self.duration * 1000000))
+        if self.shared:
+            span["shared"] = True
+        return span
+
+
+class Tracer(object):
+    """
+        Collects finished spans, sending them to `sink` in batches of up to `batch_size` from a background thread every
+        `flush_interval` seconds, or sooner once a batch's worth is waiting. At most `max_queue_size` spans are held -
+        any more are dropped (and counted in `dropped`) rather than holding up requests. Anything still queued is sent
+        when `close` is called, which happens automatically at interpreter exit for tracers still in use - a tracer
+        garbage collected without being closed loses whatever it hadn't yet sent.
+    """
+
+    def __init__(self, sink, service_name, batch_size=100, flush_interval=5, max_queue_size=10000):
+        self.sink = sink
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.dropped = 0
+
+        self._queue = []
+        self._lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._closed = threading.Event()
+        self._thread = None
+
+        _tracer_instances.add(self)
+
+    def start_span(self, trace_id, span_id=None, parent_id=None, name=None, kind=None):
+        """Start a span, which is shared with whoever assigned `span_id` if given, or has a new id otherwise"""
+        return Span(
+            self,
+            trace_id,
+            span_id or generate_span_id(),
+            parent_id,
+            name=name,
+            kind=kind,
+            shared=bool(span_id),
+        )
+
+    def record(self, span):
+        with self._lock:
+            if len(self._queue) < self.max_queue_size:
+                self._queue.append(span)
+            else:
+                self.dropped += 1
+            batch_ready = len(self._queue) >= self.batch_size
+
+        self._start_thread()
+        if batch_ready:
+            self._flush_requested.set()
+
+    def flush(self):
+        """Send every queued span, blocking until done."""
+        with self._lock:
+            spans, self._queue = self._queue, []
+
+        for i in range(0, len(spans), self.batch_size):
+            batch = spans[i:i + self.batch_size]
+            try:
+                self.sink.send([span.to_zipkin() for span in batch])
+            except Exception:
+                # exporting spans must never take down the flushing thread, nor the caller of `close`
+                logger.exception("Failed to export {count} spans", extra={'count': len(batch)})
+
+    def close(self):
+        """Stop the background thread and send anything left in the queue."""
+        self._closed.set()
+        self._flush_requested.set()
+        if self._thread is not None:
+            self._thread.join(self.flush_interval)
+        self.flush()
+
+    def _start_thread(self):
+        if self._thread is not None or self._closed.is_set():
+            return
+        with self._lock:
+            if self._thread is None:
+                # holding only a weak reference to us, so that we can be garbage collected while it runs
+                self._thread = threading.Thread(
+                    target=self._run, args=(weakref.ref(self),), name="dmutils-tracing-export",
+                )
+                self._thread.daemon = True
+                self._thread.start()
+
+    @staticmethod
+    def _run(ref):
+        while True:
+            tracer = ref()
+            if tracer is None or tracer._closed.is_set():
+                return
+            flush_requested, flush_interval = tracer._flush_requested, tracer.flush_interval
+            # not keeping it alive while we wait
+            del tracer
+            flush_requested.wait(flush_interval)
+            flush_requested.clear()
+            tracer = ref()
+            if tracer is None:
+                return
+            tracer.flush()
+            del tracer
+
+    def _reset_after_fork(self):
+        # whatever was queued before the fork is for the parent to send, and its exporting thread didn't come with us
+        closed = self._closed.is_set()
+        self._queue = []
+        self._lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._closed = threading.Event()
+        if closed:
+            self._closed.set()
+        self._thread = None
+
+
+class LogSink(object):
+    """Writes each batch of spans as a single JSON log line through the `dmutils.tracing` logger"""
+
+    def send(self, spans):
+        logger.info("Exported {span_count} spans", extra={'span_count': len(spans), 'spans': spans})
+
+
+class ZipkinSink(object):
+    """POSTs each batch of spans to a zipkin-compatible collector, e.g. `http://localhost:9411/api/v2/spans`"""
+
+    def __init__(self, url, timeout=2):
+        self.url = url
+        self.timeout = timeout
+        self._session = self._new_session()
+        _zipkin_sink_instances.add(self)
+
+    @staticmethod
+    def _new_session():
+        # not imported at the top, as apps logging their spans have no need of it
+        import requests
+        return requests.Session()
+
+    def send(self, spans):
+        self._session.post(self.url, json=spans, timeout=self.timeout).raise_for_status()
+
+    def _reset_after_fork(self):
+        # the session's connection pool can't be shared with the parent
+        self._session = self._new_session()
+
+
+@register_after_fork
+def _reset_after_fork():
+    for tracer in list(_tracer_instances):
+        tracer._reset_after_fork()
+    for sink in list(_zipkin_sink_instances):
+        sink._reset_after_fork()
+
+
+@atexit.register
+def _close_tracers():
+    for tracer in list(_tracer_instances):
+        tracer.close()
+
+
+def init_app(app):
+    declare_settings(app, {
+        'DM_TRACING_ENABLED': Setting(bool, False),
+        'DM_TRACING_ZIPKIN_URL': Setting(str),
+        'DM_TRACING_FLUSH_INTERVAL': Setting(float, 5),
+    })
+
+    if not app.config['DM_TRACING_ENABLED']:
+        return
+
+    if app.config['DM_TRACING_ZIPKIN_URL']:
+        sink = ZipkinSink(app.config['DM_TRACING_ZIPKIN_URL'])
+    else:
+        sink = LogSink()
+    tracer = app.extensions['dmutils_tracer'] = Tracer(
+        sink,
+        app.config.get('DM_APP_NAME', 'none'),
+        flush_interval=app.config['DM_TRACING_FLUSH_INTERVAL'],
+    )
+
+    @app.before_request
+    def start_request_span():
+        # relies on `request_id.init_app` having been run, to give us the incoming trace, span and parent span ids
+        request.tracing_span = tracer.start_span(
+            request.trace_id,
+            span_id=request.span_id,
+            parent_id=request.parent_span_id,
+            name="{} {}".format(request.method, request.endpoint),
+            kind="SERVER",
+        )
+        request.tracing_span.tags["http.path"] = request.path
+
+    @app.after_request
+    def tag_request_span(response):
+        span = getattr(request, "tracing_span", None)
+        if span is not None:
+            span.tags["http.status_code"] = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request_span(exception=None):
+        span = getattr(request, "tracing_span", None)
+        if span is not None:
+            if exception is not None:
+                span.tags["error"] = six.text_type(exception) or type(exception).__name__
+            span.finish()
+
+
+def get_tracer(app=None):
+    """The app's `Tracer`, or None if tracing isn't enabled"""
+    return (app or current_app).extensions.get('dmutils_tracer')
@@ -14,7 +14,13 @@ function display_result {
   fi
 }
 
-flake8 .
+if python -c 'import sys; sys.exit(sys.version_info[0] < 3)'; then
+  flake8 .
+else
+  # the asyncio clients and their tests are python 3 only, so python 2's flake8 can't parse them. --exclude replaces
+  # the one in .flake8, so repeats it
+  flake8 --exclude='venv*,__pycache__,node_modules,bower_components,dmutils/email/aio.py,tests/email/test_aio.py' .
+fi
 display_result $? 1 "Code style check"
 
 py.test $@
@@ -35,7 +35,7 @@ setup(
          'mailchimp3==2.0.11',
          'mandrill==1.0.57',
          'monotonic==0.3',
-         'notifications-python-client==4.1.0',
+         'notifications-python-client==4.4.0',
          'odfpy==1.3.6',
          'python-json-logger==0.1.4',
          'pytz==2015.4',
@@ -44,4 +44,8 @@ setup(
          'unicodecsv==0.14.1',
          'workdays==1.4'
     ],
+    extras_require={
+        # for dmutils.email.aio, which is python 3 only
+        'aio': ['aiohttp>=3.0,<4'],
+    },
 )
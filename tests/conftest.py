@@ -1,10 +1,14 @@
+import sys
+
 import pytest
 from flask import Flask
 import mock
-from boto.ec2.cloudwatch import CloudWatchConnection
 
 from dmutils.logging import init_app
 
+# the asyncio email clients are python 3 only
+collect_ignore = ["email/test_aio.py"] if sys.version_info < (3, 5) else []
+
 
 @pytest.fixture
 def app():
@@ -15,9 +19,9 @@ def app():
 
 @pytest.yield_fixture
 def cloudwatch():
-    with mock.patch('dmutils.metrics.connect_to_region') as connect_to_region:
-        conn = mock.Mock(spec=CloudWatchConnection)
-        connect_to_region.return_value = conn
+    with mock.patch('dmutils.metrics.get_cloudwatch_client') as get_cloudwatch_client:
+        conn = mock.Mock(spec=['put_metric_data'])
+        get_cloudwatch_client.return_value = conn
         yield conn
 
 
@@ -0,0 +1,18 @@
+import mock
+import pytest
+
+from dmutils.email.retry import reset_circuit_breakers
+
+
+@pytest.yield_fixture(autouse=True)
+def circuit_breakers():
+    # so that one test's failures don't have the next rejected
+    reset_circuit_breakers()
+    yield
+    reset_circuit_breakers()
+
+
+@pytest.yield_fixture
+def retry_sleep():
+    with mock.patch('dmutils.email.retry.time.sleep') as sleep:
+        yield sleep
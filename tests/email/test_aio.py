@@ -0,0 +1,385 @@
+"""Tests for the asyncio email clients, against fake Notify, Mailchimp and Mandrill servers."""
+import asyncio
+from collections import Counter
+
+import mock
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+
+from aiohttp import web  # noqa
+from aiohttp.test_utils import TestServer  # noqa
+
+from dmutils.email.aio import (  # noqa
+    AsyncDMMailChimpClient, AsyncDMNotifyClient, AsyncHTTPError, AsyncTokenBucket, map_bounded, send_mandrill_email,
+)
+from dmutils.email.dm_notify import DMNotifyClient, FAILED, SENT, SKIPPED  # noqa
+from dmutils.email.dm_mailchimp import DMMailChimpClient  # noqa
+from dmutils.email.exceptions import EmailError  # noqa
+from dmutils.email.helpers import hash_string  # noqa
+from dmutils.email.retry import CircuitOpenError, get_circuit_breaker, RetryPolicy  # noqa
+
+API_KEY = "1111111111" * 8
+
+
+@pytest.yield_fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.yield_fixture(autouse=True)
+def create_jwt_token():
+    with mock.patch('dmutils.email.aio.create_jwt_token', return_value="token") as create_jwt_token:
+        yield create_jwt_token
+
+
+class FakeServer(object):
+    """An aiohttp server on localhost, keeping track of the requests it's handled and how many at once"""
+
+    def __init__(self, loop, routes):
+        self.loop = loop
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        app = web.Application(middlewares=[self._track])
+        for method, path, handler in routes:
+            app.router.add_route(method, path, handler)
+        self.server = TestServer(app)
+        loop.run_until_complete(self.server.start_server())
+        self.url = str(self.server.make_url("")).rstrip("/")
+
+    @web.middleware
+    async def _track(self, request, handler):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            body = await request.json() if request.can_read_body else None
+            self.requests.append((request.method, request.path, dict(request.query), body))
+            # give other requests the chance to be made at the same time
+            await asyncio.sleep(0.01)
+            return await handler(request)
+        finally:
+            self.in_flight -= 1
+
+    def close(self):
+        self.loop.run_until_complete(self.server.close())
+
+
+@pytest.yield_fixture
+def notify_server(loop):
+    attempts = Counter()
+    notifications = [{"id": str(i), "reference": "ref-{}".format(i)} for i in range(5, 0, -1)]
+
+    async def send_email(request):
+        data = await request.json()
+        attempts[data["email_address"]] += 1
+        if data["email_address"].startswith("flaky") and attempts[data["email_address"]] == 1:
+            return web.json_response({"errors": [{"error": "RateLimitError", "message": "Slow down"}]}, status=429)
+        if data["email_address"].startswith("invalid"):
+            return web.json_response({"errors": [{"error": "ValidationError", "message": "Not valid"}]}, status=400)
+        return web.json_response({"id": "id-" + data["email_address"], "reference": data["reference"]}, status=201)
+
+    async def get_notifications(request):
+        older_than = request.query.get("older_than")
+        start = [n["id"] for n in notifications].index(older_than) + 1 if older_than else 0
+        page = notifications[start:start + 2]
+        links = {"current": "/v2/notifications"}
+        if start + 2 < len(notifications):
+            links["next"] = "/v2/notifications?older_than={}".format(page[-1]["id"])
+        return web.json_response({"notifications": page, "links": links})
+
+    server = FakeServer(loop, [
+        ("POST", "/v2/notifications/email", send_email),
+        ("GET", "/v2/notifications", get_notifications),
+    ])
+    server.notifications = notifications
+    yield server
+    server.close()
+
+
+@pytest.yield_fixture
+def mailchimp_server(loop):
+    members = {}
+
+    async def create_or_update(request):
+        data = await request.json()
+        if data["email_address"].startswith("fake"):
+            return web.json_response({
+                "title": "Invalid Resource",
+                "detail": "{} looks fake or invalid, please enter a real email address.".format(data["email_address"]),
+            }, status=400)
+        if data["email_address"].startswith("broken"):
+            return web.json_response({"title": "Internal Server Error", "detail": "Oops"}, status=500)
+        members[request.match_info["hash"]] = data
+        return web.json_response(data)
+
+    async def all_members(request):
+        offset, count = int(request.query["offset"]), int(request.query["count"])
+        return web.json_response({"members": sorted(members.values(), key=lambda m: m["email_address"])[
+            offset:offset + count
+        ]})
+
+    server = FakeServer(loop, [
+        ("PUT", "/lists/{list_id}/members/{hash}", create_or_update),
+        ("GET", "/lists/{list_id}/members", all_members),
+    ])
+    server.members = members
+    yield server
+    server.close()
+
+
+@pytest.yield_fixture
+def mandrill_server(loop):
+    async def send(request):
+        data = await request.json()
+        if data["key"] != "good-key":
+            return web.json_response(
+                {"status": "error", "name": "Invalid_Key", "message": "Invalid API key"}, status=500
+            )
+        return web.json_response([
+            {"_id": "id-{}".format(i), "email": to["email"], "status": "queued"}
+            for i, to in enumerate(data["message"]["to"])
+        ])
+
+    server = FakeServer(loop, [("POST", "/messages/send.json", send)])
+    yield server
+    server.close()
+
+
+def _batch(*email_addresses):
+    return [{"email_address": email_address, "template_id": "template"} for email_address in email_addresses]
+
+
+class TestMapBounded(object):
+    def test_results_in_order_with_bounded_concurrency(self, loop):
+        running = Counter()
+
+        async def double(item):
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+            await asyncio.sleep(0.001 * (item % 3))
+            running["now"] -= 1
+            return item * 2
+
+        assert loop.run_until_complete(map_bounded(double, iter(range(20)), 4)) == [i * 2 for i in range(20)]
+        assert running["max"] == 4
+
+    def test_items_are_only_taken_as_there_is_room(self, loop):
+        taken = []
+
+        def items():
+            for i in range(10):
+                taken.append(i)
+                yield i
+
+        async def check(item):
+            # never more than the item being worked on and one per other worker taken
+            assert len(taken) <= item + 2
+            await asyncio.sleep(0)
+
+        loop.run_until_complete(map_bounded(check, items(), 2))
+        assert len(taken) == 10
+
+
+class TestAsyncTokenBucket(object):
+    def test_waits_for_tokens(self, loop):
+        bucket = AsyncTokenBucket(rate=100, capacity=2)
+
+        async def acquire(count):
+            start = loop.time()
+            for _ in range(count):
+                await bucket.acquire()
+            return loop.time() - start
+
+        assert loop.run_until_complete(acquire(2)) < 0.01
+        assert loop.run_until_complete(acquire(3)) >= 0.02
+
+
+class TestAsyncDMNotifyClient(object):
+    def _client(self, server, **kwargs):
+        return AsyncDMNotifyClient(API_KEY, server.url, logger=mock.Mock(), **kwargs)
+
+    def test_send_email(self, loop, notify_server):
+        async def send():
+            async with self._client(notify_server) as client:
+                return await client.send_email("user@example.com", "template", {"name": "User"})
+
+        assert loop.run_until_complete(send())["id"] == "id-user@example.com"
+        assert notify_server.requests == [("POST", "/v2/notifications/email", {}, {
+            "email_address": "user@example.com",
+            "template_id": "template",
+            "personalisation": {"name": "User"},
+            "reference": DMNotifyClient.get_reference("user@example.com", "template", {"name": "User"}),
+        })]
+
+    def test_send_email_error(self, loop, notify_server):
+        client = self._client(notify_server)
+
+        with pytest.raises(EmailError):
+            loop.run_until_complete(client.send_email("invalid@example.com", "template"))
+        loop.run_until_complete(client.close())
+
+        client.logger.error.assert_called_once_with(
+            DMNotifyClient.get_error_message(hash_string("invalid@example.com"), mock.Mock(
+                status_code=400, message=[{"error": "ValidationError", "message": "Not valid"}],
+            ))
+        )
+
+    def test_get_delivered_references_walks_pages_then_only_fetches_newer(self, loop, notify_server):
+        client = self._client(notify_server)
+
+        assert loop.run_until_complete(client.get_delivered_references()) == {
+            "ref-5", "ref-4", "ref-3", "ref-2", "ref-1"
+        }
+        assert len(notify_server.requests) == 3
+
+        notify_server.notifications.insert(0, {"id": "6", "reference": "ref-6"})
+        assert "ref-6" in loop.run_until_complete(client.get_delivered_references(invalidate_cache=True))
+        assert len(notify_server.requests) == 4
+        loop.run_until_complete(client.close())
+
+    def test_send_emails(self, loop, notify_server):
+        client = self._client(notify_server, concurrency=3)
+        batch = _batch(*["user{}@example.com".format(i) for i in range(10)] + ["flaky@example.com"])
+
+        result = loop.run_until_complete(client.send_emails(iter(batch), retry_backoff=0.01))
+        loop.run_until_complete(client.close())
+
+        assert [r.status for r in result.results] == [SENT] * 11
+        assert [r.response["id"] for r in result.results] == ["id-" + email["email_address"] for email in batch]
+        assert result.results[-1].retried == 1
+        assert (result.sent, result.failed, result.retries) == (11, 0, 1)
+        assert notify_server.max_in_flight == 3
+
+    def test_send_emails_skips_delivered_and_duplicates_without_allow_resend(self, loop, notify_server):
+        client = self._client(notify_server)
+        batch = _batch("user@example.com", "invalid@example.com", "user@example.com") + [
+            {"email_address": "old@example.com", "template_id": "template", "reference": "ref-3"},
+        ]
+
+        result = loop.run_until_complete(client.send_emails(batch, allow_resend=False))
+        loop.run_until_complete(client.close())
+
+        assert [r.status for r in result.results] == [SENT, FAILED, SKIPPED, SKIPPED]
+        assert result.results[1].error.status_code == 400
+
+    def test_rate_limit(self, loop, notify_server):
+        client = self._client(notify_server, rate_limit=100)
+        start = loop.time()
+
+        loop.run_until_complete(client.send_emails(_batch(*["user{}@example.com".format(i) for i in range(105)])))
+        loop.run_until_complete(client.close())
+
+        # a second's worth can go straight away, the rest have to wait for the bucket to refill
+        assert loop.time() - start >= 0.05
+
+    def test_connection_error_is_retryable(self, loop):
+        client = AsyncDMNotifyClient(API_KEY, "http://127.0.0.1:1", logger=mock.Mock())
+
+        result = loop.run_until_complete(
+            client.send_emails(_batch("user@example.com"), max_retries=1, retry_backoff=0)
+        )
+        loop.run_until_complete(client.close())
+
+        assert result.results[0].status == FAILED
+        assert result.results[0].error.status_code == 503
+        assert result.retries == 1
+
+    def test_fails_fast_once_circuit_breaker_opens(self, loop):
+        client = AsyncDMNotifyClient(
+            API_KEY, "http://127.0.0.1:1", logger=mock.Mock(), concurrency=1,
+            retry_policy=RetryPolicy("notify", circuit_breaker=get_circuit_breaker("notify", failure_threshold=2)),
+        )
+
+        result = loop.run_until_complete(client.send_emails(
+            _batch("user1@example.com", "user2@example.com"), max_retries=3, retry_backoff=0,
+        ))
+        loop.run_until_complete(client.close())
+
+        assert [r.status for r in result.results] == [FAILED, FAILED]
+        assert [type(r.error) for r in result.results] == [AsyncHTTPError, CircuitOpenError]
+        assert result.retries == 1
+
+
+class TestAsyncDMMailChimpClient(object):
+    def _client(self, server, **kwargs):
+        return AsyncDMMailChimpClient("username", "api-key-us1", mock.Mock(), base_url=server.url, **kwargs)
+
+    def test_base_url_from_api_key(self):
+        assert AsyncDMMailChimpClient("username", "abc-us12", mock.Mock()).base_url == (
+            "https://us12.api.mailchimp.com/3.0"
+        )
+
+    def test_subscribe_new_emails_to_list(self, loop, mailchimp_server):
+        client = self._client(mailchimp_server, concurrency=2)
+        email_addresses = ["user{}@example.com".format(i) for i in range(6)]
+
+        assert loop.run_until_complete(client.subscribe_new_emails_to_list("list", email_addresses)) is True
+        assert loop.run_until_complete(client.get_email_addresses_from_list("list", pagination_size=4)) == (
+            email_addresses
+        )
+        loop.run_until_complete(client.close())
+
+        assert mailchimp_server.max_in_flight == 2
+        assert ("PUT", "/lists/list/members/{}".format(DMMailChimpClient.get_email_hash("user0@example.com")), {}, {
+            "email_address": "user0@example.com", "status_if_new": "subscribed",
+        }) in mailchimp_server.requests
+
+    def test_fake_or_invalid_emails_are_expected(self, loop, mailchimp_server):
+        client = self._client(mailchimp_server)
+
+        assert loop.run_until_complete(
+            client.subscribe_new_emails_to_list("list", ["fake@example.com", "user@example.com"])
+        ) is True
+        loop.run_until_complete(client.close())
+
+        assert client.logger.error.call_args[0][0].startswith("Expected error: Mailchimp failed to add user")
+
+    def test_other_errors_fail(self, loop, mailchimp_server):
+        client = self._client(mailchimp_server, retry_policy=RetryPolicy("mailchimp", backoff=0))
+
+        assert loop.run_until_complete(
+            client.subscribe_new_emails_to_list("list", ["broken@example.com", "user@example.com"])
+        ) is False
+        loop.run_until_complete(client.close())
+
+        assert [r[1] for r in mailchimp_server.requests].count(
+            "/lists/list/members/{}".format(DMMailChimpClient.get_email_hash("broken@example.com"))
+        ) == 3
+        client.logger.error.assert_called_once_with(
+            "Mailchimp failed to add user ({}) to list (list)".format(
+                DMMailChimpClient.get_email_hash("broken@example.com")
+            ),
+            extra={"error": mock.ANY},
+        )
+        assert "user@example.com" in [member["email_address"] for member in mailchimp_server.members.values()]
+
+
+class TestSendMandrillEmail(object):
+    def test_send(self, loop, mandrill_server):
+        logger = mock.Mock()
+        loop.run_until_complete(send_mandrill_email(
+            "user@example.com", "<p>Hello</p>", "good-key", "Subject", "from@example.com", "From", ["tag"],
+            logger=logger, base_url=mandrill_server.url,
+        ))
+
+        (_, _, _, body), = mandrill_server.requests
+        assert body["async"] is True
+        assert body["message"]["to"] == [{"email": "user@example.com", "type": "to"}]
+        logger.info.assert_called_once_with("Sent {tags} response: id={id}, email={email_hash}", extra={
+            'tags': ["tag"], 'id': "id-0", 'email_hash': hash_string("user@example.com"),
+        })
+
+    def test_error(self, loop, mandrill_server):
+        with pytest.raises(EmailError):
+            loop.run_until_complete(send_mandrill_email(
+                ["user@example.com"], "<p>Hello</p>", "bad-key", "Subject", "from@example.com", "From", ["tag"],
+                logger=mock.Mock(), base_url=mandrill_server.url,
+            ))
+
+        # Mandrill's own errors come with a 500, and aren't worth retrying
+        assert len(mandrill_server.requests) == 1
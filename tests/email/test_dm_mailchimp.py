@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 """Tests for the Digital Marketplace MailChimp integration."""
+from operator import attrgetter
+
 import mock
 import pytest
 
+import requests
 from requests import RequestException
 from requests.exceptions import HTTPError
 
 from dmutils.email.dm_mailchimp import DMMailChimpClient
+from dmutils.email.retry import get_circuit_breaker, CLOSED
+from dmutils.trace_context import get_trace_id, trace_context
 
 
 def test_create_campaign():
@@ -82,6 +87,21 @@ def test_log_error_message_if_error_sending_campaign(logger):
         )
 
 
+@pytest.mark.parametrize(("method", "args", "client_method"), (
+    ("create_campaign", ({"settings": {"title": "Foo"}},), "campaigns.create"),
+    ("set_campaign_content", ("1", {"html": "some html"}), "campaigns.content.update"),
+    ("send_campaign", ("1",), "campaigns.actions.send"),
+))
+def test_campaign_requests_are_retried(retry_sleep, method, args, client_method):
+    dm_mailchimp_client = DMMailChimpClient('username', 'api key', mock.MagicMock(), retries=1)
+    endpoint, name = client_method.rsplit(".", 1)
+    with mock.patch.object(attrgetter(endpoint)(dm_mailchimp_client._client), name, autospec=True) as client_function:
+        client_function.side_effect = [HTTPError(response=mock.Mock(status_code=503)), {"id": "100"}]
+
+        assert getattr(dm_mailchimp_client, method)(*args)
+        assert client_function.call_args_list == [mock.call(*args)] * 2
+
+
 @mock.patch("dmutils.email.dm_mailchimp.DMMailChimpClient.get_email_hash", return_value="foo")
 def test_subscribe_new_email_to_list(get_email_hash):
     dm_mailchimp_client = DMMailChimpClient('username', 'api key', mock.MagicMock())
@@ -143,25 +163,94 @@ def test_returns_true_if_expected_error_subscribing_email_to_list(get_email_hash
 
 def test_subscribe_new_emails_to_list():
     dm_mailchimp_client = DMMailChimpClient('username', 'api key', mock.MagicMock())
-    with mock.patch.object(dm_mailchimp_client, 'subscribe_new_email_to_list', autospec=True):
-        dm_mailchimp_client.subscribe_new_email_to_list.return_value = True
+    with mock.patch.object(dm_mailchimp_client._client.lists, 'update_members', autospec=True) as update_members:
+        update_members.return_value = {"new_members": [{}, {}], "errors": []}
         res = dm_mailchimp_client.subscribe_new_emails_to_list('list_id', ['email1@example.com', 'email2@example.com'])
-        calls = [mock.call('list_id', 'email1@example.com'), mock.call('list_id', 'email2@example.com')]
 
         assert res is True
-        dm_mailchimp_client.subscribe_new_email_to_list.assert_has_calls(calls)
+        update_members.assert_called_once_with('list_id', {
+            "members": [
+                {"email_address": "email1@example.com", "status_if_new": "subscribed"},
+                {"email_address": "email2@example.com", "status_if_new": "subscribed"},
+            ],
+            "update_existing": False,
+        })
+
+
+def test_subscribe_new_emails_to_list_in_batches():
+    dm_mailchimp_client = DMMailChimpClient('username', 'api key', mock.MagicMock())
+    with mock.patch.object(dm_mailchimp_client._client.lists, 'update_members', autospec=True) as update_members:
+        update_members.return_value = {"errors": []}
+        email_addresses = ('email{}@example.com'.format(i) for i in range(5))
+        res = dm_mailchimp_client.subscribe_new_emails_to_list('list_id', email_addresses, batch_size=2)
+
+        assert res is True
+        assert [len(c[0][1]["members"]) for c in update_members.call_args_list] == [2, 2, 1]
 
 
 def test_subscribe_new_emails_to_list_tries_all_emails_returns_false_on_error():
     dm_mailchimp_client = DMMailChimpClient('username', 'api key', mock.MagicMock())
-    with mock.patch.object(
-            dm_mailchimp_client, 'subscribe_new_email_to_list', autospec=True) as subscribe_new_email_to_list:
-        subscribe_new_email_to_list.side_effect = [False, True]
+    with mock.patch.object(dm_mailchimp_client._client.lists, 'update_members', autospec=True) as update_members:
+        update_members.return_value = {"errors": []}
         res = dm_mailchimp_client.subscribe_new_emails_to_list('list_id', ['foo', 'email2@example.com'])
-        calls = [mock.call('list_id', 'foo'), mock.call('list_id', 'email2@example.com')]
 
         assert res is False
-        subscribe_new_email_to_list.assert_has_calls(calls)
+        update_members.assert_called_once_with('list_id', {
+            "members": [{"email_address": "email2@example.com", "status_if_new": "subscribed"}],
+            "update_existing": False,
+        })
+
+
+def test_subscribe_new_emails_to_list_maps_member_errors():
+    logger = mock.MagicMock()
+    dm_mailchimp_client = DMMailChimpClient('username', 'api key', logger)
+    with mock.patch.object(dm_mailchimp_client._client.lists, 'update_members', autospec=True) as update_members:
+        update_members.return_value = {"errors": [
+            {"email_address": "member@example.com", "error": "member@example.com is already a list member"},
+            {
+                "email_address": "fake@example.com",
+                "error": "fake@example.com looks fake or invalid, please enter a real email address.",
+            },
+        ]}
+        assert dm_mailchimp_client.subscribe_new_emails_to_list(
+            'list_id', ['member@example.com', 'fake@example.com']
+        ) is True
+
+        update_members.return_value = {"errors": [
+            {"email_address": "other@example.com", "error": "Something else went wrong"},
+        ]}
+        assert dm_mailchimp_client.subscribe_new_emails_to_list('list_id', ['other@example.com']) is False
+
+    assert logger.error.call_args_list == [
+        mock.call(
+            "Expected error: Mailchimp failed to add user ({}) to list (list_id). API error: The email address looks fake or invalid, please enter a real email address.".format(  # noqa
+                DMMailChimpClient.get_email_hash("fake@example.com")
+            ),
+            extra={"error": "fake@example.com looks fake or invalid, please enter a real email address."}
+        ),
+        mock.call(
+            "Mailchimp failed to add user ({}) to list (list_id)".format(
+                DMMailChimpClient.get_email_hash("other@example.com")
+            ),
+            extra={"error": "Something else went wrong"}
+        ),
+    ]
+
+
+def test_subscribe_new_emails_to_list_returns_false_if_batch_fails(retry_sleep):
+    logger = mock.MagicMock()
+    dm_mailchimp_client = DMMailChimpClient('username', 'api key', logger, retries=1)
+    with mock.patch.object(dm_mailchimp_client._client.lists, 'update_members', autospec=True) as update_members:
+        update_members.side_effect = [
+            HTTPError(response=mock.Mock(status_code=504)), RequestException("error sending"), {"errors": []},
+        ]
+        email_addresses = ['email1@example.com', 'email2@example.com', 'email3@example.com']
+        assert dm_mailchimp_client.subscribe_new_emails_to_list('list_id', email_addresses, batch_size=2) is False
+
+    assert update_members.call_count == 3
+    logger.error.assert_called_once_with(
+        "Mailchimp failed to add 2 users to list (list_id)", extra={"error": "error sending"}
+    )
 
 
 def test_get_email_hash():
@@ -210,7 +299,28 @@ def test_default_timeout_retry_performs_no_retries():
         ]
 
 
-def test_timeout_retry_performs_retries():
+def test_retry_policy_is_built_once():
+    dm_mailchimp_client = DMMailChimpClient('username', 'api key', mock.MagicMock(), retries=2)
+
+    assert dm_mailchimp_client.retry_policy is dm_mailchimp_client.retry_policy
+    assert dm_mailchimp_client.retry_policy.max_attempts == 3
+    assert dm_mailchimp_client.retry_policy.circuit_breaker is get_circuit_breaker("mailchimp")
+
+
+def test_failures_without_retries_do_not_open_circuit_breaker():
+    dm_mailchimp_client = DMMailChimpClient('username', 'api key', mock.MagicMock())
+    with mock.patch.object(dm_mailchimp_client._client.lists.members, 'all', autospec=True) as all_members:
+        all_members.side_effect = HTTPError(response=mock.Mock(status_code=504))
+        for _ in range(10):
+            with pytest.raises(HTTPError):
+                dm_mailchimp_client.get_email_addresses_from_list('a_list_id')
+
+    assert all_members.call_count == 10
+    assert dm_mailchimp_client.retry_policy.circuit_breaker.state == CLOSED
+    assert get_circuit_breaker("mailchimp").state == CLOSED
+
+
+def test_timeout_retry_performs_retries(retry_sleep):
     dm_mailchimp_client = DMMailChimpClient('username', 'api key', mock.MagicMock(), retries=2)
     with mock.patch.object(dm_mailchimp_client._client.lists.members, 'all', autospec=True) as all_members:
         all_members.side_effect = HTTPError(response=mock.Mock(status_code=504))
@@ -223,6 +333,31 @@ def test_timeout_retry_performs_retries():
         ]
 
 
+def test_timeout_retry_retries_server_errors_and_connection_failures(retry_sleep):
+    dm_mailchimp_client = DMMailChimpClient('username', 'api key', mock.MagicMock(), retries=2)
+    with mock.patch.object(dm_mailchimp_client._client.lists.members, 'all', autospec=True) as all_members:
+        all_members.side_effect = [
+            HTTPError(response=mock.Mock(status_code=500)),
+            requests.ConnectionError("connection refused"),
+            {"members": []},
+        ]
+        assert dm_mailchimp_client.get_email_addresses_from_list('a_list_id') == []
+
+    assert all_members.call_count == 3
+    assert retry_sleep.call_count == 2
+
+
+def test_timeout_retry_does_not_retry_client_errors(retry_sleep):
+    dm_mailchimp_client = DMMailChimpClient('username', 'api key', mock.MagicMock(), retries=2)
+    with mock.patch.object(dm_mailchimp_client._client.lists.members, 'all', autospec=True) as all_members:
+        all_members.side_effect = HTTPError(response=mock.Mock(status_code=404))
+        with pytest.raises(HTTPError):
+            dm_mailchimp_client.get_email_addresses_from_list('a_list_id')
+
+    assert all_members.call_count == 1
+    assert retry_sleep.called is False
+
+
 def test_success_does_not_perform_retry():
     dm_mailchimp_client = DMMailChimpClient('username', 'api key', mock.MagicMock(), retries=2)
     with mock.patch.object(dm_mailchimp_client._client.lists.members, 'all', autospec=True) as all_members:
@@ -281,3 +416,76 @@ def test_offset_increments_until_no_members():
             mock.call('a_list_id', count=1000, offset=6000),
             mock.call('a_list_id', count=1000, offset=7000),
         ]
+
+
+def _members_page(list_id, count, offset, fields):
+    assert fields == "members.email_address,total_items"
+    return {
+        "members": [
+            {"email_address": "user{}@example.com".format(i)} for i in range(offset, min(offset + count, 10))
+        ],
+        "total_items": 10,
+    }
+
+
+def test_iter_email_addresses_from_list():
+    dm_mailchimp_client = DMMailChimpClient('username', 'api key', mock.MagicMock())
+    with mock.patch.object(dm_mailchimp_client._client.lists.members, 'all', autospec=True) as all_members:
+        all_members.side_effect = _members_page
+
+        res = list(dm_mailchimp_client.iter_email_addresses_from_list('list_id', pagination_size=3, prefetch=2))
+
+        assert res == ["user{}@example.com".format(i) for i in range(10)]
+        assert sorted(c[1]['offset'] for c in all_members.call_args_list) == [0, 3, 6, 9]
+
+
+def test_iter_email_addresses_from_list_yields_first_page_before_fetching_others():
+    dm_mailchimp_client = DMMailChimpClient('username', 'api key', mock.MagicMock())
+    with mock.patch.object(dm_mailchimp_client._client.lists.members, 'all', autospec=True) as all_members:
+        all_members.side_effect = _members_page
+        email_addresses = dm_mailchimp_client.iter_email_addresses_from_list('list_id', pagination_size=3)
+
+        assert next(email_addresses) == "user0@example.com"
+        assert all_members.call_count == 1
+        email_addresses.close()
+
+
+def test_iter_email_addresses_from_list_fetches_pages_in_callers_trace_context():
+    dm_mailchimp_client = DMMailChimpClient('username', 'api key', mock.MagicMock())
+    with mock.patch.object(dm_mailchimp_client._client.lists.members, 'all', autospec=True) as all_members:
+        trace_ids = []
+
+        def all_members_side_effect(list_id, count, offset, fields):
+            trace_ids.append(get_trace_id())
+            return _members_page(list_id, count, offset, fields)
+        all_members.side_effect = all_members_side_effect
+
+        with trace_context("some-trace-id"):
+            list(dm_mailchimp_client.iter_email_addresses_from_list('list_id', pagination_size=3, prefetch=2))
+
+        assert trace_ids == ["some-trace-id"] * 4
+
+
+def test_iter_email_addresses_from_empty_list():
+    dm_mailchimp_client = DMMailChimpClient('username', 'api key', mock.MagicMock())
+    with mock.patch.object(dm_mailchimp_client._client.lists.members, 'all', autospec=True) as all_members:
+        all_members.return_value = {"members": [], "total_items": 0}
+
+        assert list(dm_mailchimp_client.iter_email_addresses_from_list('list_id')) == []
+        assert all_members.call_count == 1
+
+
+def test_iter_email_addresses_from_list_retries_pages(retry_sleep):
+    dm_mailchimp_client = DMMailChimpClient('username', 'api key', mock.MagicMock(), retries=1)
+    with mock.patch.object(dm_mailchimp_client._client.lists.members, 'all', autospec=True) as all_members:
+        responses = {3: [HTTPError(response=mock.Mock(status_code=504))]}
+
+        def all_members_side_effect(list_id, count, offset, fields):
+            if responses.get(offset):
+                raise responses[offset].pop()
+            return _members_page(list_id, count, offset, fields)
+        all_members.side_effect = all_members_side_effect
+
+        res = list(dm_mailchimp_client.iter_email_addresses_from_list('list_id', pagination_size=3))
+
+        assert res == ["user{}@example.com".format(i) for i in range(10)]
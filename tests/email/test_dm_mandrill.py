@@ -3,18 +3,23 @@
 
 import mock
 import pytest
-from mandrill import Error
+from mandrill import Error, ServiceUnavailableError
 
 from dmutils.config import init_app
-from dmutils.email.dm_mandrill import send_email
+from dmutils.email.dm_mandrill import send_email, send_emails
 from dmutils.email.exceptions import EmailError
 
 
 @pytest.yield_fixture
-def mandrill():
-    with mock.patch('dmutils.email.dm_mandrill.Mandrill') as Mandrill:
-        instance = Mandrill.return_value
-        yield instance
+def Mandrill():
+    with mock.patch.dict('dmutils.email.dm_mandrill._clients', clear=True):
+        with mock.patch('dmutils.email.dm_mandrill.Mandrill') as Mandrill:
+            yield Mandrill
+
+
+@pytest.fixture
+def mandrill(Mandrill):
+    return Mandrill.return_value
 
 
 @pytest.yield_fixture
@@ -154,3 +159,84 @@ def test_should_throw_exception_if_mandrill_fails(email_app, mandrill):
 
             )
         assert str(e.value) == 'this is an error'
+
+
+def test_retries_if_mandrill_is_unavailable(email_app, mandrill, retry_sleep):
+    with email_app.app_context():
+        mandrill.messages.send.side_effect = [
+            ServiceUnavailableError('down for maintenance'), [{'_id': '123', 'email': '123'}],
+        ]
+
+        send_email('email_address', 'body', 'api_key', 'subject', 'from_email', 'from_name', ['password-resets'])
+
+        assert mandrill.messages.send.call_count == 2
+        assert retry_sleep.call_count == 1
+
+
+def test_does_not_retry_other_mandrill_errors(email_app, mandrill, retry_sleep):
+    with email_app.app_context():
+        mandrill.messages.send.side_effect = Error('this is an error')
+
+        with pytest.raises(EmailError):
+            send_email('email_address', 'body', 'api_key', 'subject', 'from_email', 'from_name', ['password-resets'])
+
+        assert mandrill.messages.send.call_count == 1
+
+
+def test_client_is_reused_for_the_same_api_key(email_app, Mandrill):
+    with email_app.app_context():
+        Mandrill.return_value.messages.send.return_value = [{'_id': '123', 'email': '123'}]
+
+        for api_key in ('api_key', 'api_key', 'other_api_key'):
+            send_email('email_address', 'body', api_key, 'subject', 'from_email', 'from_name', ['password-resets'])
+
+        assert Mandrill.call_args_list == [mock.call('api_key'), mock.call('other_api_key')]
+
+
+class TestSendEmails(object):
+    def _send(self, mandrill, email_addresses, **kwargs):
+        mandrill.messages.send.side_effect = lambda message, **kwargs: [
+            {'_id': recipient['email'], 'email': recipient['email'], 'status': 'sent'} for recipient in message['to']
+        ]
+        return send_emails(
+            email_addresses, 'body', 'api_key', 'subject', 'from_email', 'from_name', ['tag'], **kwargs
+        )
+
+    def test_sends_in_batches(self, email_app, mandrill):
+        email_addresses = ['user{}@example.com'.format(i) for i in range(5)]
+        with email_app.app_context():
+            results = self._send(mandrill, email_addresses, batch_size=2)
+
+        assert sorted(result['email'] for result in results) == email_addresses
+        assert sorted(len(call[1]['message']['to']) for call in mandrill.messages.send.call_args_list) == [1, 2, 2]
+
+    def test_logs_once_for_the_whole_send(self, email_app, mandrill):
+        logger = mock.Mock()
+        with email_app.app_context():
+            self._send(mandrill, ['user{}@example.com'.format(i) for i in range(5)], batch_size=2, logger=logger)
+
+        logger.info.assert_called_once_with(
+            "Sent {tags} to {recipients} recipients in {batches} batches in {elapsed}s",
+            extra={
+                'tags': ['tag'],
+                'recipients': 5,
+                'batches': 3,
+                'failed_batches': 0,
+                'statuses': {'sent': 5},
+                'elapsed': mock.ANY,
+            },
+        )
+
+    def test_raises_after_sending_the_other_batches_if_one_fails(self, email_app, mandrill):
+        logger = mock.Mock()
+        with email_app.app_context():
+            mandrill.messages.send.side_effect = [Error('this is an error'), [{'_id': '1', 'email': '1'}]]
+
+            with pytest.raises(EmailError):
+                send_emails(
+                    ['user1@example.com', 'user2@example.com'], 'body', 'api_key', 'subject', 'from_email',
+                    'from_name', ['tag'], logger=logger, batch_size=1, max_workers=1,
+                )
+
+        assert mandrill.messages.send.call_count == 2
+        assert logger.error.call_args[1]['extra']['failed_batches'] == 1
@@ -6,8 +6,20 @@ import mock
 import os
 from collections import OrderedDict
 import pytest
+import shutil
+import tempfile
+import threading
 
-from dmutils.email.dm_notify import DMNotifyClient
+from notifications_python_client import NotificationsAPIClient
+from notifications_python_client.errors import HTTPError
+import requests
+
+from dmutils.email import dm_notify
+from dmutils.email.dm_notify import (
+    DeliveredReferenceStore, DMNotifyClient, FAILED, SENT, SessionNotificationsAPIClient, SKIPPED,
+)
+from dmutils.email.exceptions import EmailError
+from dmutils.email.retry import CircuitOpenError, get_circuit_breaker, RetryPolicy
 
 
 FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
@@ -21,6 +33,24 @@ def dm_notify_client(app):
         return DMNotifyClient(test_api_key)
 
 
+@pytest.yield_fixture
+def delivered_references_path():
+    directory = tempfile.mkdtemp()
+    yield os.path.join(directory, "delivered-references.db")
+    shutil.rmtree(directory)
+
+
+def _page(*ids, **kwargs):
+    """A page of delivered notifications with ids (and references) `ids`, with a link to the next if `next`"""
+    links = {"current": "https://api.notifications.service.gov.uk/v2/notifications"}
+    if kwargs.get("next", True):
+        links["next"] = "https://api.notifications.service.gov.uk/v2/notifications?older_than={}".format(ids[-1])
+    return {
+        "links": links,
+        "notifications": [{"id": id_, "reference": "ref-{}".format(id_), "status": "delivered"} for id_ in ids],
+    }
+
+
 @pytest.fixture
 def notify_example_http_error():
     """Return a mock object with attributes of Notify `HTTPError`."""
@@ -167,6 +197,24 @@ class TestDMNotifyClient(object):
 
         assert actual == expected
 
+    def test_send_email_retries_server_errors(self, dm_notify_client, notify_send_email, retry_sleep):
+        with mock.patch(self.client_class_str + '.send_email_notification') as send_email_notification:
+            send_email_notification.side_effect = [_http_error(502), notify_send_email]
+
+            assert dm_notify_client.send_email(self.email_address, self.template_id) == notify_send_email
+
+        assert send_email_notification.call_count == 2
+        assert retry_sleep.call_count == 1
+
+    def test_send_email_does_not_retry_client_errors(self, dm_notify_client):
+        with mock.patch(self.client_class_str + '.send_email_notification') as send_email_notification:
+            send_email_notification.side_effect = _http_error(400)
+
+            with pytest.raises(EmailError):
+                dm_notify_client.send_email(self.email_address, self.template_id)
+
+        assert send_email_notification.call_count == 1
+
     def test_cache_not_instantiated_with_allow_resend(self, dm_notify_client):
         """The cache shouldn't be touched until we pass `allow_resend=False` to `send_email`."""
         with mock.patch(self.client_class_str + '.' + 'send_email_notification'):
@@ -184,12 +232,15 @@ class TestDMNotifyClient(object):
         with mock.patch(self.client_class_str + '.' + 'send_email_notification') as send_email_notification_mock:
             with mock.patch(self.client_class_str + '.' + 'get_all_notifications') as get_all_notifications_mock:
                 send_email_notification_mock.return_value = notify_send_email
-                get_all_notifications_mock.return_value = notify_get_all_notifications
+                get_all_notifications_mock.side_effect = [notify_get_all_notifications, {"notifications": []}]
 
                 assert dm_notify_client._sent_references_cache is None
                 dm_notify_client.send_email(self.email_address, self.template_id, allow_resend=False)
 
-                get_all_notifications_mock.assert_called_once_with(status='delivered')
+                assert get_all_notifications_mock.call_args_list == [
+                    mock.call(status='delivered'),
+                    mock.call(status='delivered', older_than='ac0973cd-3d1c-446d-bec5-665347beaf53'),
+                ]
 
                 # Dummy data from notify_get_all_notifications + the one we just sent = 9
                 assert len(dm_notify_client._sent_references_cache) == 9
@@ -245,3 +296,272 @@ class TestDMNotifyClient(object):
                     personalisation=None,
                     reference='niC4qhMflcnl8MkY82N7Gqze2ZA7ed1pSBTGnxeDPj0='
                 )
+
+
+class TestDeliveredReferences(object):
+    client_class_str = 'notifications_python_client.NotificationsAPIClient'
+
+    def test_walks_every_page(self, dm_notify_client):
+        with mock.patch(self.client_class_str + '.get_all_notifications') as get_all_notifications:
+            get_all_notifications.side_effect = [_page("5", "4"), _page("3", "2"), _page("1", next=False)]
+
+            assert dm_notify_client.get_delivered_references() == {"ref-5", "ref-4", "ref-3", "ref-2", "ref-1"}
+
+        assert get_all_notifications.call_args_list == [
+            mock.call(status='delivered'),
+            mock.call(status='delivered', older_than="4"),
+            mock.call(status='delivered', older_than="2"),
+        ]
+
+    def test_invalidating_cache_only_fetches_newer_notifications(self, dm_notify_client):
+        with mock.patch(self.client_class_str + '.get_all_notifications') as get_all_notifications:
+            get_all_notifications.side_effect = [_page("2", "1", next=False), _page("4", "3"), _page("2", "1")]
+            dm_notify_client.get_delivered_references()
+
+            assert dm_notify_client.get_delivered_references(invalidate_cache=True) == {
+                "ref-4", "ref-3", "ref-2", "ref-1"
+            }
+
+        assert get_all_notifications.call_args_list == [
+            mock.call(status='delivered'),
+            mock.call(status='delivered'),
+            mock.call(status='delivered', older_than="3"),
+        ]
+
+    def test_stops_if_given_the_same_page_again(self, dm_notify_client):
+        with mock.patch(self.client_class_str + '.get_all_notifications') as get_all_notifications:
+            get_all_notifications.return_value = _page("2", "1")
+
+            assert dm_notify_client.get_delivered_references() == {"ref-2", "ref-1"}
+
+        assert get_all_notifications.call_count == 2
+
+    def test_references_are_shared_through_store(self, app, delivered_references_path):
+        with app.app_context(), mock.patch(self.client_class_str + '.get_all_notifications') as get_all_notifications:
+            get_all_notifications.side_effect = [_page("2", "1", next=False), _page("3", "2")]
+            first_client = DMNotifyClient('1111111111' * 8, delivered_references_path=delivered_references_path)
+            second_client = DMNotifyClient('1111111111' * 8, delivered_references_path=delivered_references_path)
+
+            assert first_client.get_delivered_references() == {"ref-2", "ref-1"}
+            # the second client only needs to fetch what's been delivered since the first synced
+            assert second_client.get_delivered_references() == {"ref-3", "ref-2", "ref-1"}
+
+            first_client._update_cache("sent-by-first")
+            assert second_client.has_been_sent("sent-by-first")
+
+        assert get_all_notifications.call_args_list == [mock.call(status='delivered'), mock.call(status='delivered')]
+
+
+class TestDeliveredReferenceStore(object):
+    def test_add_and_contains(self, delivered_references_path):
+        store = DeliveredReferenceStore(delivered_references_path)
+        store.add(["a", "b"])
+        store.add(["b", "c"], newest_id="id-3")
+
+        assert "a" in store
+        assert "d" not in store
+        assert sorted(store) == ["a", "b", "c"]
+        assert len(store) == 3
+        assert store.newest_id == "id-3"
+
+    def test_persists_between_instances(self, delivered_references_path):
+        DeliveredReferenceStore(delivered_references_path).add(["a"], newest_id="id-1")
+        store = DeliveredReferenceStore(delivered_references_path)
+
+        assert "a" in store
+        assert store.newest_id == "id-1"
+
+    def test_usable_from_other_threads(self, delivered_references_path):
+        store = DeliveredReferenceStore(delivered_references_path)
+        thread = threading.Thread(target=store.add, args=(["a"],))
+        thread.start()
+        thread.join()
+
+        assert "a" in store
+
+
+def _http_error(status_code):
+    return HTTPError(mock.Mock(status_code=status_code, json=mock.Mock(return_value={
+        "errors": [{"error": "Error", "message": "Status {}".format(status_code)}],
+    })))
+
+
+class TestSendEmails(object):
+    client_class_str = 'notifications_python_client.NotificationsAPIClient'
+
+    @pytest.yield_fixture(autouse=True)
+    def sleep(self):
+        with mock.patch('time.sleep') as sleep:
+            yield sleep
+
+    def _batch(self, count):
+        return [{'email_address': 'user{}@example.com'.format(i), 'template_id': 'template'} for i in range(count)]
+
+    def test_sends_every_email(self, dm_notify_client):
+        with mock.patch(self.client_class_str + '.send_email_notification') as send_email_notification:
+            send_email_notification.side_effect = lambda email_address, *args, **kwargs: {'id': email_address}
+            result = dm_notify_client.send_emails(self._batch(20), max_workers=4)
+
+        assert [r.response for r in result.results] == [{'id': 'user{}@example.com'.format(i)} for i in range(20)]
+        assert [r.status for r in result.results] == [SENT] * 20
+        assert (result.sent, result.skipped, result.failed, result.retries) == (20, 0, 0, 0)
+        # sent from 4 threads at once, so not necessarily first
+        assert mock.call(
+            'user0@example.com', 'template', personalisation=None,
+            reference=dm_notify_client.get_reference('user0@example.com', 'template'),
+        ) in send_email_notification.call_args_list
+
+    def test_retries_rate_limited_and_server_errors(self, dm_notify_client, sleep):
+        with mock.patch(self.client_class_str + '.send_email_notification') as send_email_notification:
+            send_email_notification.side_effect = [_http_error(429), _http_error(503), {'id': 'notify-id'}]
+            result = dm_notify_client.send_emails(self._batch(1), retry_backoff=0.5)
+
+        assert result.results[0].status == SENT
+        assert result.results[0].retried == 2
+        assert result.retries == 2
+        # each wait is up to half as short again, so that emails failing together aren't all retried together
+        first_wait, second_wait = [c[0][0] for c in sleep.call_args_list if c[0][0] >= 0.25]
+        assert 0.25 <= first_wait <= 0.5
+        assert 0.5 <= second_wait <= 1
+
+    def test_gives_up_after_max_retries(self, dm_notify_client):
+        with mock.patch(self.client_class_str + '.send_email_notification') as send_email_notification:
+            send_email_notification.side_effect = _http_error(500)
+            result = dm_notify_client.send_emails(self._batch(1), max_retries=2)
+
+        assert send_email_notification.call_count == 3
+        assert result.results[0].status == FAILED
+        assert result.failed == 1
+
+    def test_does_not_retry_client_errors(self, dm_notify_client):
+        with mock.patch(self.client_class_str + '.send_email_notification') as send_email_notification:
+            send_email_notification.side_effect = [_http_error(400), {'id': 'notify-id'}]
+            result = dm_notify_client.send_emails(self._batch(2), max_workers=1)
+
+        assert [r.status for r in result.results] == [FAILED, SENT]
+        assert result.results[0].error.status_code == 400
+
+    def test_fails_fast_once_circuit_breaker_opens(self, app):
+        with app.app_context():
+            dm_notify_client = DMNotifyClient('1111111111' * 8, retry_policy=RetryPolicy(
+                "notify", circuit_breaker=get_circuit_breaker("notify", failure_threshold=3),
+            ))
+        with mock.patch(self.client_class_str + '.send_email_notification') as send_email_notification:
+            send_email_notification.side_effect = _http_error(503)
+            result = dm_notify_client.send_emails(self._batch(3), max_workers=1, max_retries=1)
+
+        assert send_email_notification.call_count == 3
+        assert [type(r.error) for r in result.results] == [HTTPError, HTTPError, CircuitOpenError]
+        assert result.failed == 3
+
+    def test_skips_delivered_and_duplicate_emails_without_allow_resend(self, dm_notify_client):
+        batch = self._batch(3) + self._batch(1)
+        with mock.patch(self.client_class_str + '.send_email_notification') as send_email_notification:
+            with mock.patch(self.client_class_str + '.get_all_notifications') as get_all_notifications:
+                send_email_notification.return_value = {'id': 'notify-id'}
+                get_all_notifications.return_value = {"notifications": [{
+                    "id": "1",
+                    "reference": dm_notify_client.get_reference('user1@example.com', 'template'),
+                }]}
+                result = dm_notify_client.send_emails(batch, allow_resend=False)
+
+        assert [r.status for r in result.results] == [SENT, SKIPPED, SENT, SKIPPED]
+        assert send_email_notification.call_count == 2
+        assert dm_notify_client.has_been_sent(dm_notify_client.get_reference('user2@example.com', 'template'))
+
+    def test_logs_summary(self, app):
+        with app.app_context():
+            logger = mock.Mock()
+            client = DMNotifyClient('1111111111' * 8, logger=logger)
+        with mock.patch(self.client_class_str + '.send_email_notification') as send_email_notification:
+            send_email_notification.return_value = {'id': 'notify-id'}
+            client.send_emails(self._batch(3))
+
+        assert logger.info.call_count == 1
+        assert logger.info.call_args[1]['extra']['sent'] == 3
+
+
+class TestSessionNotificationsAPIClient(object):
+    @pytest.yield_fixture(autouse=True)
+    def create_jwt_token(self):
+        with mock.patch('dmutils.email.dm_notify.create_jwt_token', return_value="token") as create_jwt_token:
+            yield create_jwt_token
+
+    def _client(self, session):
+        return SessionNotificationsAPIClient('1111111111' * 8, session=session)
+
+    def test_requests_go_through_session(self):
+        session = mock.Mock()
+        session.request.return_value.status_code = 200
+        session.request.return_value.json.return_value = {"notifications": []}
+
+        assert self._client(session).get_all_notifications(status='delivered') == {"notifications": []}
+        (method, url), kwargs = session.request.call_args
+        assert (method, url) == ("GET", "https://api.notifications.service.gov.uk/v2/notifications")
+        assert kwargs['params'] == {'status': 'delivered'}
+        assert kwargs['headers']['Authorization'] == "Bearer token"
+
+    def test_errors_are_raised_as_notify_http_errors(self):
+        session = mock.Mock()
+        response = session.request.return_value
+        response.status_code = 429
+        response.raise_for_status.side_effect = requests.HTTPError(response=response)
+
+        with pytest.raises(HTTPError) as e:
+            self._client(session).send_email_notification('example@example.com', 'template')
+        assert e.value.status_code == 429
+
+    def test_session_is_replaced_after_fork(self):
+        client = self._client(None)
+        session = client.session
+
+        dm_notify._reset_after_fork()
+
+        assert client.session is not session
+
+    def test_dm_notify_client_passes_on_session(self, app):
+        session = requests.Session()
+        with app.app_context():
+            assert DMNotifyClient('1111111111' * 8, session=session).client.session is session
+
+    def test_subclass_client_class_without_a_session(self, app):
+        class ClientWithoutSession(NotificationsAPIClient):
+            pass
+
+        class SubclassedDMNotifyClient(DMNotifyClient):
+            _client_class = ClientWithoutSession
+
+        with app.app_context():
+            assert isinstance(SubclassedDMNotifyClient('1111111111' * 8).client, ClientWithoutSession)
+
+
+class TestGetNotifyClient(object):
+    def test_init_app_creates_client(self, app):
+        app.config['DM_NOTIFY_API_KEY'] = '1111111111' * 8
+        dm_notify.init_app(app)
+
+        client = app.extensions['dmutils_notify_client']
+        assert isinstance(client, DMNotifyClient)
+        with app.app_context():
+            assert dm_notify.get_notify_client() is client
+
+    def test_init_app_without_api_key(self, app):
+        dm_notify.init_app(app)
+
+        assert 'dmutils_notify_client' not in app.extensions
+
+    def test_client_is_created_once_and_reused(self, app):
+        app.config['DM_NOTIFY_API_KEY'] = '1111111111' * 8
+        dm_notify.init_app(app)
+
+        assert dm_notify.get_notify_client(app) is dm_notify.get_notify_client(app)
+        app.config['DM_NOTIFY_API_KEY'] = '1111111111' * 8
+        assert dm_notify.get_notify_client(app).client.session is dm_notify.get_notify_client(app).client.session
+
+    def test_client_is_created_when_first_needed_without_init_app(self, app):
+        app.config['DM_NOTIFY_API_KEY'] = '1111111111' * 8
+
+        client = dm_notify.get_notify_client(app)
+
+        assert app.extensions['dmutils_notify_client'] is client
+        assert client.client.base_url == 'https://api.notifications.service.gov.uk'
@@ -0,0 +1,29 @@
+import mock
+
+from dmutils.email.helpers import TokenBucket
+
+
+class TestTokenBucket(object):
+    @mock.patch('dmutils.email.helpers.time.sleep')
+    @mock.patch('dmutils.email.helpers.monotonic')
+    def test_allows_a_burst_then_waits_for_tokens(self, monotonic, sleep):
+        now = [100.0]
+        monotonic.side_effect = lambda: now[0]
+        sleep.side_effect = lambda seconds: now.__setitem__(0, now[0] + seconds)
+        bucket = TokenBucket(rate=2)
+
+        bucket.acquire()
+        bucket.acquire()
+        assert sleep.called is False
+
+        bucket.acquire()
+        sleep.assert_called_once_with(0.5)
+
+    @mock.patch('dmutils.email.helpers.monotonic')
+    def test_tokens_do_not_accumulate_past_capacity(self, monotonic):
+        monotonic.return_value = 100.0
+        bucket = TokenBucket(rate=10, capacity=3)
+        monotonic.return_value = 1000.0
+        bucket.acquire()
+
+        assert bucket._tokens == 2
@@ -0,0 +1,200 @@
+import mock
+import pytest
+import requests
+
+from dmutils.email.exceptions import EmailError
+from dmutils.email.retry import (
+    CircuitBreaker, CircuitOpenError, get_circuit_breaker, get_status_code, RetryPolicy, CLOSED, HALF_OPEN, OPEN,
+)
+from dmutils.prometheus import REGISTRY
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super(StatusError, self).__init__("Status {}".format(status_code))
+        self.status_code = status_code
+
+
+def _sample_value(provider, outcome):
+    for line in REGISTRY.render().splitlines():
+        if line.startswith('email_provider_attempts_total{') and 'provider="{}"'.format(provider) in line and \
+                'outcome="{}"'.format(outcome) in line:
+            return float(line.split()[-1])
+    return 0
+
+
+@pytest.fixture
+def fn():
+    return mock.Mock(__name__="fn")
+
+
+class TestGetStatusCode(object):
+    def test_status_code_attribute(self):
+        assert get_status_code(StatusError(503)) == 503
+
+    def test_response_status_code(self):
+        assert get_status_code(requests.HTTPError(response=mock.Mock(status_code=504))) == 504
+
+    def test_no_status_code(self):
+        assert get_status_code(ValueError()) is None
+        assert get_status_code(requests.RequestException(response=requests.Response())) is None
+
+
+class TestRetryPolicy(object):
+    def test_returns_result_without_retrying(self, fn, retry_sleep):
+        fn.return_value = "result"
+
+        assert RetryPolicy("test").call(fn, 1, b=2) == "result"
+        fn.assert_called_once_with(1, b=2)
+        assert retry_sleep.called is False
+
+    def test_retries_retryable_statuses_with_exponential_backoff(self, fn, retry_sleep):
+        fn.side_effect = [StatusError(429), StatusError(500), StatusError(503), "result"]
+
+        assert RetryPolicy("test", max_attempts=4, backoff=1, jitter=0).call(fn) == "result"
+        assert fn.call_count == 4
+        assert retry_sleep.call_args_list == [mock.call(1), mock.call(2), mock.call(4)]
+
+    def test_backoff_is_capped_and_jittered(self, retry_sleep):
+        policy = RetryPolicy("test", backoff=1, max_backoff=5, jitter=0.5)
+
+        with mock.patch('random.random', return_value=0.5):
+            assert [policy.get_delay(retried) for retried in range(5)] == [0.75, 1.5, 3, 3.75, 3.75]
+
+    def test_retries_retryable_exceptions(self, fn, retry_sleep):
+        fn.side_effect = [requests.ConnectionError(), "result"]
+
+        assert RetryPolicy("test", retry_exceptions=(requests.ConnectionError,)).call(fn) == "result"
+        assert fn.call_count == 2
+
+    def test_does_not_retry_other_errors(self, fn, retry_sleep):
+        fn.side_effect = StatusError(400)
+
+        with pytest.raises(StatusError):
+            RetryPolicy("test").call(fn)
+        assert fn.call_count == 1
+        assert _sample_value("test", "failed") >= 1
+
+    def test_gives_up_after_max_attempts(self, fn, retry_sleep):
+        fn.side_effect = StatusError(502)
+
+        with pytest.raises(StatusError):
+            RetryPolicy("test", max_attempts=3).call(fn)
+        assert fn.call_count == 3
+        assert retry_sleep.call_count == 2
+
+    def test_gives_up_rather_than_wait_past_deadline(self, fn, retry_sleep):
+        fn.side_effect = StatusError(502)
+        clock = [100]
+        retry_sleep.side_effect = lambda delay: clock.__setitem__(0, clock[0] + delay)
+
+        with mock.patch('dmutils.email.retry.monotonic', side_effect=lambda: clock[0]):
+            with pytest.raises(StatusError):
+                RetryPolicy("test", max_attempts=10, backoff=4, jitter=0, deadline=10).call(fn)
+        # waiting another 8 seconds after the first 4 would take us past the deadline
+        assert retry_sleep.call_args_list == [mock.call(4)]
+
+    def test_on_retry_is_called_before_each_retry(self, fn, retry_sleep):
+        fn.side_effect = [StatusError(503), "result"]
+        on_retry = mock.Mock()
+
+        assert RetryPolicy("test", jitter=0).wrap(fn, on_retry=on_retry)() == "result"
+        (error, delay), _ = on_retry.call_args
+        assert (on_retry.call_count, error.status_code, delay) == (1, 503, 1)
+
+    def test_counts_attempts(self, fn, retry_sleep):
+        fn.side_effect = [StatusError(503), "result"]
+        before = _sample_value("counted", "retried"), _sample_value("counted", "success")
+
+        RetryPolicy("counted").call(fn)
+
+        assert (_sample_value("counted", "retried"), _sample_value("counted", "success")) == (
+            before[0] + 1, before[1] + 1
+        )
+
+    def test_replace_shares_circuit_breaker(self):
+        policy = RetryPolicy("test", max_attempts=3, backoff=2)
+        replaced = policy.replace(max_attempts=5)
+
+        assert (replaced.max_attempts, replaced.backoff) == (5, 2)
+        assert replaced.circuit_breaker is policy.circuit_breaker
+
+    def test_policies_for_a_provider_share_a_circuit_breaker(self):
+        assert RetryPolicy("test").circuit_breaker is RetryPolicy("test", max_attempts=1).circuit_breaker
+        assert RetryPolicy("test").circuit_breaker is not RetryPolicy("other").circuit_breaker
+
+
+class TestCircuitBreaker(object):
+    def test_opens_after_consecutive_failures(self, fn, retry_sleep):
+        fn.side_effect = StatusError(503)
+        policy = RetryPolicy("test", max_attempts=1, circuit_breaker=get_circuit_breaker("test", failure_threshold=3))
+
+        for _ in range(3):
+            with pytest.raises(StatusError):
+                policy.call(fn)
+        with pytest.raises(CircuitOpenError):
+            policy.call(fn)
+
+        assert fn.call_count == 3
+        assert policy.circuit_breaker.state == OPEN
+
+    def test_gives_up_retrying_once_open(self, fn, retry_sleep):
+        fn.side_effect = StatusError(503)
+        policy = RetryPolicy("test", max_attempts=5, circuit_breaker=get_circuit_breaker("test", failure_threshold=2))
+
+        with pytest.raises(StatusError):
+            policy.call(fn)
+        assert fn.call_count == 2
+
+    def test_success_and_client_errors_reset_failures(self):
+        breaker = CircuitBreaker("test", failure_threshold=2)
+        policy = RetryPolicy("test", max_attempts=1, circuit_breaker=breaker)
+
+        policy.record_failure(StatusError(503), 0, 0)
+        policy.record_failure(StatusError(400), 0, 0)
+        policy.record_failure(StatusError(503), 0, 0)
+        assert breaker.state == CLOSED
+
+        policy.record_success()
+        policy.record_failure(StatusError(503), 0, 0)
+        assert breaker.state == CLOSED
+
+    def test_lets_one_attempt_through_after_reset_timeout(self):
+        breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=30)
+        with mock.patch('dmutils.email.retry.monotonic', return_value=100):
+            breaker.record_failure()
+        with mock.patch('dmutils.email.retry.monotonic', return_value=120):
+            with pytest.raises(CircuitOpenError) as e:
+                breaker.before_attempt()
+            assert e.value.retry_after == 10
+
+        with mock.patch('dmutils.email.retry.monotonic', return_value=131):
+            breaker.before_attempt()
+            assert breaker.state == HALF_OPEN
+            with pytest.raises(CircuitOpenError):
+                breaker.before_attempt()
+
+    def test_closes_if_trial_attempt_succeeds(self):
+        breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        breaker.before_attempt()
+
+        breaker.record_success()
+
+        assert breaker.state == CLOSED
+        breaker.before_attempt()
+
+    def test_opens_again_if_trial_attempt_fails(self):
+        breaker = CircuitBreaker("test", failure_threshold=5, reset_timeout=30)
+        for _ in range(5):
+            breaker.record_failure()
+        with mock.patch('dmutils.email.retry.monotonic', return_value=breaker._opened_at + 31):
+            breaker.before_attempt()
+            breaker.record_failure()
+
+            assert breaker.state == OPEN
+            with pytest.raises(CircuitOpenError):
+                breaker.before_attempt()
+
+    def test_circuit_open_errors_are_email_errors(self):
+        assert isinstance(CircuitOpenError("test", 10), EmailError)
@@ -8,11 +8,14 @@ from cryptography import fernet
 from freezegun import freeze_time
 
 from dmutils.config import init_app
+from dmutils.email import tokens
 from dmutils.email.tokens import (
     generate_token,
     decode_token,
     decode_invitation_token,
     decode_password_reset_token,
+    get_fernet,
+    get_key_id,
     _parse_fernet_timestamp
 )
 from dmutils.email.helpers import hash_string
@@ -90,13 +93,15 @@ def test_generate_token_does_not_contain_plaintext_email(email_app, data_api_cli
     with email_app.app_context(), freeze_time('2016-01-01T12:00:00.30Z'):
         token = generate_token(password_reset_token, 'Secret', 'PassSalt')
 
-    # a fernet string always starts with the version, which should be 128
-    assert token[:4] == 'gAAA'
+    # the id of the key, then a fernet string, which always starts with the version, which should be 128
+    key_id, fernet_token = token.split('.')
+    assert key_id == get_key_id('Secret', 'PassSalt')
+    assert fernet_token[:4] == 'gAAA'
 
     token = token.encode('utf-8')
 
     # Personally identifiable information should not be readable without secret key
-    assert b'test@example.com' not in base64.urlsafe_b64decode(token)
+    assert b'test@example.com' not in base64.urlsafe_b64decode(fernet_token.encode('utf-8'))
 
     # a fernet string contains the timestamp at which it was encrypted
     assert _parse_fernet_timestamp(token) == datetime(2016, 1, 1, 12)
@@ -189,6 +194,136 @@ def test_decode_invitation_token_returns_an_error_and_role_if_token_expired(emai
         assert decode_invitation_token(token) == {'error': 'token_expired', 'role': 'supplier'}
 
 
+def test_decode_invitation_token_decrypts_expired_tokens_once(email_app):
+    with freeze_time('2015-01-02 03:04:05'):
+        token = generate_token({'role': 'buyer'}, 'Key', 'Salt')
+
+    with email_app.app_context(), mock.patch.object(fernet.Fernet, 'decrypt', wraps=get_fernet('Key', 'Salt').decrypt) \
+            as decrypt:
+        assert decode_invitation_token(token) == {'error': 'token_expired', 'role': 'buyer'}
+    assert decrypt.call_count == 1
+
+
+def test_decode_token_still_rejects_tokens_from_the_future():
+    with freeze_time('2016-01-01T12:05:00Z'):
+        token = generate_token({'key': 'value'}, 'Key', 'Salt')
+
+    with freeze_time('2016-01-01T12:00:00Z'):
+        with pytest.raises(fernet.InvalidToken):
+            decode_token(token, 'Key', 'Salt')
+
+
+def test_key_ids_differ_per_key_and_namespace():
+    assert len(get_key_id('Key', 'Salt')) == 6
+    assert '.' not in get_key_id('Key', 'Salt')
+    assert len({get_key_id('Key', 'Salt'), get_key_id('Key', 'Other salt'), get_key_id('Other key', 'Salt')}) == 3
+
+
+def test_decode_token_with_rotated_keys():
+    old_token = generate_token({'key': 'old'}, 'Old key', 'Salt')
+    new_token = generate_token({'key': 'new'}, ['New key', 'Old key'], 'Salt')
+
+    assert decode_token(old_token, ['New key', 'Old key'], 'Salt')[0] == {'key': 'old'}
+    assert decode_token(new_token, ['New key', 'Old key'], 'Salt')[0] == {'key': 'new'}
+    with pytest.raises(fernet.InvalidToken):
+        decode_token(old_token, ['New key'], 'Salt')
+
+
+def test_decode_token_only_tries_the_key_the_token_was_encrypted_with():
+    token = generate_token({'key': 'value'}, 'Old key', 'Salt')
+
+    with mock.patch.object(fernet.Fernet, 'decrypt', wraps=get_fernet('Old key', 'Salt').decrypt) as decrypt:
+        assert decode_token(token, ['New key', 'Other key', 'Old key'], 'Salt')[0] == {'key': 'value'}
+    assert decrypt.call_count == 1
+
+
+def test_decode_token_rejects_unknown_key_ids_without_decrypting():
+    token = generate_token({'key': 'value'}, 'Key', 'Salt')
+
+    with mock.patch.object(fernet.Fernet, 'decrypt') as decrypt:
+        with pytest.raises(fernet.InvalidToken):
+            decode_token('abcdef' + token[6:], 'Key', 'Salt')
+    assert decrypt.called is False
+
+
+def test_decode_token_tries_every_key_for_tokens_without_a_key_id():
+    # encrypted on 2016-01-01T12:00:00.30Z with secret 'Secret' and namespace 'PassSalt'
+    token = 'gAAAAABWhmpA1ecLpuzdKiIcJ_drdA1Vf4ip07TH3UqZ_fA-pD9yYlGMqSTi-Mpbd58Z-wlZfa5sXGE6FVHPilTpsZWEiMDRLdCBlccvBPbY9IOO5F3uabjkrk87mrlPxaSbMAza5Nku'  # noqa
+
+    with freeze_time('2016-01-01T12:00:00.30Z'):
+        data = decode_token(token, ['New secret', 'Secret'], 'PassSalt')
+
+    assert data == ({'email': 'test@example.com', 'user': 123}, datetime(2016, 1, 1, 12, 0, 0))
+
+
+def test_decode_invitation_token_accepts_tokens_from_old_keys(email_app):
+    email_app.config['SHARED_EMAIL_OLD_KEYS'] = ['Old key']
+    token = generate_token({'role': 'buyer'}, 'Old key', 'Salt')
+
+    with email_app.app_context():
+        assert decode_invitation_token(token) == {'role': 'buyer'}
+
+
+def test_decode_invitation_token_accepts_an_old_key_given_in_the_environment_undeclared(email_app, os_environ):
+    email_app.config['SHARED_EMAIL_OLD_KEYS'] = []
+    os_environ.update({'SHARED_EMAIL_OLD_KEYS': 'Old key'})
+    init_app(email_app)
+    token = generate_token({'role': 'buyer'}, 'Old key', 'Salt')
+
+    with email_app.app_context():
+        assert decode_invitation_token(token) == {'role': 'buyer'}
+
+
+def test_init_app_declares_old_keys_comma_separated_in_the_environment(email_app, os_environ):
+    os_environ.update({'SHARED_EMAIL_OLD_KEYS': 'Old key, Older key'})
+    tokens.init_app(email_app)
+    token = generate_token({'role': 'buyer'}, 'Older key', 'Salt')
+
+    assert email_app.config['SHARED_EMAIL_OLD_KEYS'] == ('Old key', 'Older key')
+    with email_app.app_context():
+        assert decode_invitation_token(token) == {'role': 'buyer'}
+
+
+def test_init_app_defaults_to_no_old_keys(email_app, os_environ):
+    tokens.init_app(email_app)
+
+    assert email_app.config['SHARED_EMAIL_OLD_KEYS'] == ()
+
+
+@pytest.mark.parametrize('secret_key', ([], ()))
+def test_generate_and_decode_token_need_at_least_one_key(secret_key):
+    token = generate_token({'key': 'value'}, 'Key', 'Salt')
+
+    with pytest.raises(ValueError):
+        generate_token({'key': 'value'}, secret_key, 'Salt')
+    with pytest.raises(ValueError):
+        decode_token(token, secret_key, 'Salt')
+
+
+def test_generate_token_treats_anything_but_a_list_or_tuple_as_one_key():
+    secret_key = mock.MagicMock()
+    secret_key.__add__.return_value = 'KeySalt'
+
+    assert decode_token(generate_token({'key': 'value'}, secret_key, 'Salt'), 'Key', 'Salt')[0] == {'key': 'value'}
+
+
+def test_get_fernet_is_cached_per_key_and_namespace():
+    assert get_fernet('Key', 'Salt') is get_fernet('Key', 'Salt')
+    assert get_fernet('Key', 'Salt') is not get_fernet('Key', 'Other salt')
+    assert get_fernet('Key', 'Salt') is not get_fernet('Other key', 'Salt')
+
+
+def test_get_fernet_evicts_least_recently_used():
+    with mock.patch('dmutils.email.tokens.FERNET_CACHE_SIZE', 2), \
+            mock.patch.dict('dmutils.email.tokens._fernets', clear=True):
+        first, second = get_fernet('Key', 'first'), get_fernet('Key', 'second')
+        assert get_fernet('Key', 'first') is first
+        get_fernet('Key', 'third')
+
+        assert get_fernet('Key', 'first') is first
+        assert get_fernet('Key', 'second') is not second
+
+
 def test_decode_invitation_token_adds_the_role_key_to_expired_old_style_buyer_tokens(email_app):
     with freeze_time('2015-01-02 03:04:05'):
         data = {'email_address': 'test-user@email.com'}
@@ -22,14 +22,14 @@ def email_app(app):
 class TestSendUserAccountEmail():
 
     @mock.patch('dmutils.email.user_account_email.generate_token')
-    @mock.patch('dmutils.email.user_account_email.DMNotifyClient')
+    @mock.patch('dmutils.email.user_account_email.get_notify_client')
     def test_correctly_calls_notify_client_for_buyer(
-        self, DMNotifyClient, generate_token, email_app
+        self, get_notify_client, generate_token, email_app
     ):
         with email_app.test_request_context():
             generate_token.return_value = 'mocked-token'
             notify_client_mock = mock.Mock()
-            DMNotifyClient.return_value = notify_client_mock
+            get_notify_client.return_value = notify_client_mock
 
             send_user_account_email(
                 'buyer',
@@ -48,14 +48,14 @@ class TestSendUserAccountEmail():
             assert session['email_sent_to'] == 'test@example.gov.uk'
 
     @mock.patch('dmutils.email.user_account_email.generate_token')
-    @mock.patch('dmutils.email.user_account_email.DMNotifyClient')
+    @mock.patch('dmutils.email.user_account_email.get_notify_client')
     def test_correctly_calls_notify_client_for_supplier(
-        self, DMNotifyClient, generate_token, email_app
+        self, get_notify_client, generate_token, email_app
     ):
         with email_app.test_request_context():
             generate_token.return_value = 'mocked-token'
             notify_client_mock = mock.Mock()
-            DMNotifyClient.return_value = notify_client_mock
+            get_notify_client.return_value = notify_client_mock
 
             send_user_account_email(
                 'supplier',
@@ -85,12 +85,14 @@ class TestSendUserAccountEmail():
 
     @mock.patch('dmutils.email.user_account_email.current_app')
     @mock.patch('dmutils.email.user_account_email.abort')
-    @mock.patch('dmutils.email.user_account_email.DMNotifyClient')
-    def test_abort_with_503_if_send_email_fails_with_EmailError(self, DMNotifyClient, abort, current_app, email_app):
+    @mock.patch('dmutils.email.user_account_email.get_notify_client')
+    def test_abort_with_503_if_send_email_fails_with_EmailError(
+        self, get_notify_client, abort, current_app, email_app
+    ):
         with email_app.test_request_context():
             notify_client_mock = mock.Mock()
             notify_client_mock.send_email.side_effect = EmailError('OMG!')
-            DMNotifyClient.return_value = notify_client_mock
+            get_notify_client.return_value = notify_client_mock
 
             send_user_account_email(
                 'buyer',
@@ -1,77 +1,76 @@
 # coding=utf-8
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import tempfile
+import time
+
 import mock
+import pytest
 
-from dmutils.asset_fingerprint import AssetFingerprinter
+from dmutils.asset_fingerprint import (
+    AssetFingerprinter, CACHE_LAZY, CACHE_PRECOMPUTED, CACHE_STAT, _cache_lookups, generate_manifest, hash_asset_file,
+    load_manifest, main,
+)
+from dmutils.prometheus import REGISTRY
 
 
-@mock.patch(
-    'dmutils.asset_fingerprint.AssetFingerprinter.get_asset_file_contents'
-)
-class TestAssetFingerprint(object):
-    def test_url_format(self, get_file_content_mock):
-        get_file_content_mock.return_value = """
+CSS_CONTENTS = b"""
             body {
                 font-family: nta;
             }
         """
+
+
+class TestAssetFingerprint(object):
+    def test_url_format(self, static_directory):
+        _write(os.path.join(static_directory, "application.css"), CSS_CONTENTS)
+        _write(os.path.join(static_directory, "application-ie6.css"), CSS_CONTENTS)
+        fingerprint = hash_asset_file(os.path.join(static_directory, "application.css"))
         asset_fingerprinter = AssetFingerprinter(
-            asset_root='/suppliers/static/'
+            asset_root='/suppliers/static/',
+            filesystem_path=static_directory + "/",
         )
         assert (
             asset_fingerprinter.get_url('application.css') ==
-            '/suppliers/static/application.css?418e6f4a6cdf1142e45c072ed3e1c90a'  # noqa
+            '/suppliers/static/application.css?' + fingerprint
         )
         assert (
             asset_fingerprinter.get_url('application-ie6.css') ==
-            '/suppliers/static/application-ie6.css?418e6f4a6cdf1142e45c072ed3e1c90a'  # noqa
+            '/suppliers/static/application-ie6.css?' + fingerprint
         )
 
-    def test_building_file_path(self, get_file_content_mock):
-        get_file_content_mock.return_value = """
-            document.write('Hello world!');
-        """
+    @mock.patch('dmutils.asset_fingerprint.hash_asset_file', return_value='abc123')
+    def test_building_file_path(self, hash_asset_file_mock):
         fingerprinter = AssetFingerprinter()
         fingerprinter.get_url('javascripts/application.js')
-        fingerprinter.get_asset_file_contents.assert_called_with(
+        hash_asset_file_mock.assert_called_with(
             'app/static/javascripts/application.js'
         )
 
-    def test_hashes_are_consistent(self, get_file_content_mock):
-        get_file_content_mock.return_value = """
-            body {
-                font-family: nta;
-            }
-        """
+    def test_hashes_are_consistent(self, static_directory):
+        _write(os.path.join(static_directory, "application.css"), CSS_CONTENTS)
+        _write(os.path.join(static_directory, "same_contents.css"), CSS_CONTENTS)
         asset_fingerprinter = AssetFingerprinter()
         assert (
-            asset_fingerprinter.get_asset_fingerprint('application.css') ==
-            asset_fingerprinter.get_asset_fingerprint('same_contents.css')
+            asset_fingerprinter.get_asset_fingerprint(os.path.join(static_directory, 'application.css')) ==
+            asset_fingerprinter.get_asset_fingerprint(os.path.join(static_directory, 'same_contents.css'))
         )
 
-    def test_hashes_are_different_for_different_files(
-        self, get_file_content_mock
-    ):
-        asset_fingerprinter = AssetFingerprinter()
-        get_file_content_mock.return_value = """
-            body {
-                font-family: nta;
-            }
-        """
-        css_hash = asset_fingerprinter.get_asset_fingerprint('application.css')
-        get_file_content_mock.return_value = """
+    def test_hashes_are_different_for_different_files(self, static_directory):
+        _write(os.path.join(static_directory, "application.css"), CSS_CONTENTS)
+        _write(os.path.join(static_directory, "application.js"), b"""
             document.write('Hello world!');
-        """
-        js_hash = asset_fingerprinter.get_asset_fingerprint('application.js')
+        """)
+        asset_fingerprinter = AssetFingerprinter()
+        css_hash = asset_fingerprinter.get_asset_fingerprint(os.path.join(static_directory, 'application.css'))
+        js_hash = asset_fingerprinter.get_asset_fingerprint(os.path.join(static_directory, 'application.js'))
         assert (
             js_hash != css_hash
         )
 
-    def test_hash_gets_cached(self, get_file_content_mock):
-        get_file_content_mock.return_value = """
-            body {
-                font-family: nta;
-            }
-        """
+    @mock.patch('dmutils.asset_fingerprint.hash_asset_file', return_value='418e6f4a6cdf1142e45c072ed3e1c90a')
+    def test_hash_gets_cached(self, hash_asset_file_mock):
         fingerprinter = AssetFingerprinter()
         assert (
             fingerprinter.get_url('application.css') ==
@@ -84,12 +83,191 @@ class TestAssetFingerprint(object):
             fingerprinter.get_url('application.css') ==
             'a1a1a1'
         )
-        fingerprinter.get_asset_file_contents.assert_called_once_with(
+        hash_asset_file_mock.assert_called_once_with(
             'app/static/application.css'
         )
 
+    def test_fingerprint_is_the_same_as_in_a_manifest(self, static_directory):
+        manifest = generate_manifest(static_directory)
+        fingerprinter = AssetFingerprinter(filesystem_path=static_directory + "/")
+
+        assert fingerprinter.get_url('logo.png') == '/static/logo.png?' + manifest['logo.png']
+
 
 class TestAssetFingerprintWithUnicode(object):
     def test_can_read_self(self):
         """This string must contain Ralph’s apostrophe. We then try to load this file with the asset fingerprinter."""
         AssetFingerprinter(filesystem_path='tests/').get_url('test_asset_fingerprint.py')
+
+
+PNG_CONTENTS = b"\x89PNG\r\n\x1a\n\xff\xfe"
+
+
+def _write(path, content):
+    with open(path, "wb") as f:
+        f.write(content)
+    # make sure the change is visible to filesystems with coarse modification times
+    os.utime(path, (time.time() + 10, time.time() + 10))
+
+
+@pytest.yield_fixture
+def static_directory():
+    directory = tempfile.mkdtemp()
+    os.makedirs(os.path.join(directory, "stylesheets"))
+    with open(os.path.join(directory, "stylesheets", "application.css"), "wb") as f:
+        f.write(b"body { font-family: nta; }")
+    with open(os.path.join(directory, "logo.png"), "wb") as f:
+        f.write(PNG_CONTENTS)
+    yield directory
+    shutil.rmtree(directory)
+
+
+class TestAssetFingerprintWithBinaryFiles(object):
+    def test_can_fingerprint_binary_file(self, static_directory):
+        fingerprinter = AssetFingerprinter(filesystem_path=static_directory + "/")
+
+        assert fingerprinter.get_url('logo.png') == '/static/logo.png?' + hash_asset_file(
+            os.path.join(static_directory, "logo.png")
+        )
+
+
+class TestManifest(object):
+    def test_hash_asset_file_reads_in_chunks(self, static_directory):
+        path = os.path.join(static_directory, "stylesheets", "application.css")
+
+        assert hash_asset_file(path, chunk_size=3) == hash_asset_file(path)
+
+    def test_generate_manifest(self, static_directory):
+        manifest_path = os.path.join(static_directory, "manifest.json")
+        manifest = generate_manifest(static_directory, manifest_path, threads=2)
+
+        assert manifest == {
+            "logo.png": hash_asset_file(os.path.join(static_directory, "logo.png")),
+            "stylesheets/application.css": hash_asset_file(
+                os.path.join(static_directory, "stylesheets", "application.css")
+            ),
+        }
+        assert load_manifest(manifest_path) == manifest
+
+    def test_fingerprinter_uses_manifest_without_reading_assets(self, static_directory):
+        manifest_path = os.path.join(static_directory, "manifest.json")
+        manifest = generate_manifest(static_directory, manifest_path)
+        fingerprinter = AssetFingerprinter(filesystem_path=static_directory + "/", manifest_path=manifest_path)
+
+        with mock.patch('dmutils.asset_fingerprint.hash_asset_file') as hash_asset_file_mock:
+            assert fingerprinter.get_url('stylesheets/application.css') == (
+                '/static/stylesheets/application.css?' + manifest['stylesheets/application.css']
+            )
+        assert hash_asset_file_mock.called is False
+
+    def test_fingerprinter_falls_back_for_assets_not_in_manifest(self, static_directory):
+        manifest_path = os.path.join(static_directory, "manifest.json")
+        with open(manifest_path, "w") as f:
+            f.write('{"fingerprints": {}}')
+        fingerprinter = AssetFingerprinter(filesystem_path=static_directory + "/", manifest_path=manifest_path)
+
+        assert fingerprinter.get_url('logo.png') == '/static/logo.png?' + hash_asset_file(
+            os.path.join(static_directory, "logo.png")
+        )
+
+    def test_main(self, static_directory):
+        manifest_path = os.path.join(static_directory, "manifest.json")
+
+        assert main([static_directory, manifest_path]) == 0
+        assert sorted(load_manifest(manifest_path)) == ["logo.png", "stylesheets/application.css"]
+        assert main([]) == 2
+
+
+def _lookups(result):
+    return REGISTRY._values.snapshot().get(_cache_lookups.labels(result=result)._key, 0)
+
+
+class TestCacheModes(object):
+    def test_unknown_cache_mode(self):
+        with pytest.raises(ValueError):
+            AssetFingerprinter(cache_mode="sometimes")
+
+    def test_precomputed_mode_needs_a_manifest(self, static_directory):
+        with pytest.raises(ValueError):
+            AssetFingerprinter(cache_mode=CACHE_PRECOMPUTED)
+        with pytest.raises(ValueError):
+            AssetFingerprinter(cache_mode=CACHE_LAZY, manifest_path=os.path.join(static_directory, "manifest.json"))
+
+    def test_lazy_cache_is_bounded(self, static_directory):
+        fingerprinter = AssetFingerprinter(filesystem_path=static_directory + "/", max_cache_size=1)
+        fingerprinter.get_url('logo.png')
+        fingerprinter.get_url('stylesheets/application.css')
+
+        assert list(fingerprinter._cache) == ['stylesheets/application.css']
+
+    def test_lazy_cache_is_not_invalidated(self, static_directory):
+        fingerprinter = AssetFingerprinter(filesystem_path=static_directory + "/")
+        url = fingerprinter.get_url('logo.png')
+        _write(os.path.join(static_directory, "logo.png"), b"new logo")
+
+        assert fingerprinter.get_url('logo.png') == url
+
+    def test_stat_mode_notices_changes(self, static_directory):
+        fingerprinter = AssetFingerprinter(
+            filesystem_path=static_directory + "/", cache_mode=CACHE_STAT, stat_interval=0
+        )
+        url = fingerprinter.get_url('logo.png')
+        _write(os.path.join(static_directory, "logo.png"), b"new logo")
+
+        assert fingerprinter.get_url('logo.png') == '/static/logo.png?' + hash_asset_file(
+            os.path.join(static_directory, "logo.png")
+        )
+        assert fingerprinter.get_url('logo.png') != url
+
+    def test_stat_mode_checks_are_rate_limited(self, static_directory):
+        fingerprinter = AssetFingerprinter(filesystem_path=static_directory + "/", cache_mode=CACHE_STAT)
+        fingerprinter.get_url('logo.png')
+
+        with mock.patch('os.stat') as stat:
+            fingerprinter.get_url('logo.png')
+        assert stat.called is False
+
+    def test_stat_mode_does_not_refingerprint_unchanged_files(self, static_directory):
+        fingerprinter = AssetFingerprinter(
+            filesystem_path=static_directory + "/", cache_mode=CACHE_STAT, stat_interval=0
+        )
+        fingerprinter.get_url('logo.png')
+
+        with mock.patch('dmutils.asset_fingerprint.hash_asset_file') as hash_asset_file_mock:
+            fingerprinter.get_url('logo.png')
+        assert hash_asset_file_mock.called is False
+
+    def test_precomputed_mode_logs_assets_missing_from_manifest(self, static_directory):
+        manifest_path = os.path.join(static_directory, "manifest.json")
+        with open(manifest_path, "w") as f:
+            f.write('{"fingerprints": {}}')
+        fingerprinter = AssetFingerprinter(filesystem_path=static_directory + "/", manifest_path=manifest_path)
+
+        with mock.patch('dmutils.asset_fingerprint.logger') as logger:
+            fingerprinter.get_url('logo.png')
+            fingerprinter.get_url('logo.png')
+        logger.warning.assert_called_once_with(
+            "Asset {asset_path} is not in the manifest", extra={'asset_path': 'logo.png'}
+        )
+
+    def test_cache_lookups_are_counted(self, static_directory):
+        hits, misses = _lookups("hit"), _lookups("miss")
+        fingerprinter = AssetFingerprinter(filesystem_path=static_directory + "/")
+        fingerprinter.get_url('logo.png')
+        fingerprinter.get_url('logo.png')
+        fingerprinter.get_url('logo.png')
+
+        assert (_lookups("hit") - hits, _lookups("miss") - misses) == (2, 1)
+        assert "asset_fingerprint_duration_seconds_count" in REGISTRY.render()
+
+    def test_concurrent_lookups(self, static_directory):
+        fingerprinter = AssetFingerprinter(filesystem_path=static_directory + "/", max_cache_size=1)
+        asset_paths = ['logo.png', 'stylesheets/application.css'] * 50
+        pool = ThreadPool(8)
+        try:
+            urls = pool.map(fingerprinter.get_url, asset_paths)
+        finally:
+            pool.close()
+
+        assert urls == [AssetFingerprinter(filesystem_path=static_directory + "/").get_url(p) for p in asset_paths]
+        assert len(fingerprinter._cache) == 1
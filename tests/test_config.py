@@ -1,5 +1,5 @@
 import pytest
-from dmutils.config import init_app
+from dmutils.config import declare_settings, freeze_config, get_config_snapshot, init_app, Setting
 
 
 def test_init_app_updates_known_config_options(app, os_environ):
@@ -57,3 +57,108 @@ def test_init_app_fails_if_integer_field_is_not_inty(app, os_environ):
 
         with pytest.raises(ValueError):
             init_app(app)
+
+
+class TestDeclareSettings(object):
+    def test_sets_defaults(self, app, os_environ):
+        declare_settings(app, {'DM_THINGS': Setting(int, 3), 'DM_OPTIONAL_THING': Setting(str)})
+
+        assert app.config['DM_THINGS'] == 3
+        assert app.config['DM_OPTIONAL_THING'] is None
+
+    def test_keeps_existing_values(self, app, os_environ):
+        app.config['DM_THINGS'] = 5
+        declare_settings(app, {'DM_THINGS': Setting(int, 3)})
+
+        assert app.config['DM_THINGS'] == 5
+
+    @pytest.mark.parametrize(("setting", "environ_value", "expected"), (
+        (Setting(bool, False), "on", True),
+        (Setting(int, 3), "4", 4),
+        (Setting(float, 3), "4.5", 4.5),
+        (Setting(float, 3), "4", 4.0),
+        (Setting(str), "thing", "thing"),
+        (Setting(tuple, ()), "X-One, X-Two", ("X-One", "X-Two")),
+    ))
+    def test_takes_values_from_environ(self, app, os_environ, setting, environ_value, expected):
+        os_environ.update({'DM_THING': environ_value})
+        declare_settings(app, {'DM_THING': setting})
+
+        assert app.config['DM_THING'] == expected
+        assert type(app.config['DM_THING']) is type(expected)
+
+    def test_config_init_app_converts_declared_settings_from_environ(self, app, os_environ):
+        declare_settings(app, {'DM_THING': Setting(tuple, ())})
+        os_environ.update({'DM_THING': "a,b"})
+
+        init_app(app)
+
+        assert app.config['DM_THING'] == ("a", "b")
+
+    @pytest.mark.parametrize(("setting", "value"), (
+        (Setting(bool, False), "yes"),
+        (Setting(int, 3), True),
+        (Setting(int, 3), "3"),
+        (Setting(float, 3), "3"),
+        (Setting(str, "thing"), 3),
+        (Setting(tuple, ()), "X-One"),
+    ))
+    def test_rejects_values_of_the_wrong_type(self, app, os_environ, setting, value):
+        app.config['DM_THING'] = value
+        with pytest.raises(ValueError):
+            declare_settings(app, {'DM_THING': setting})
+
+    def test_rejects_bad_values_from_environ(self, app, os_environ):
+        os_environ.update({'DM_THING': "many"})
+        with pytest.raises(ValueError):
+            declare_settings(app, {'DM_THING': Setting(int, 3)})
+
+    def test_rejects_unsupported_types(self):
+        with pytest.raises(ValueError):
+            Setting(dict, {})
+
+
+class TestConfigSnapshot(object):
+    def test_snapshot_has_declared_settings(self, app, os_environ):
+        app.config['NOT_DECLARED'] = "thing"
+        declare_settings(app, {'DM_THINGS': Setting(int, 3)})
+
+        snapshot = freeze_config(app)
+
+        assert snapshot.DM_THINGS == snapshot['DM_THINGS'] == 3
+        assert 'NOT_DECLARED' not in snapshot
+        with pytest.raises(AttributeError):
+            snapshot.NOT_DECLARED
+
+    def test_snapshot_is_read_only(self, app, os_environ):
+        declare_settings(app, {'DM_THINGS': Setting(int, 3)})
+        snapshot = freeze_config(app)
+
+        with pytest.raises(AttributeError):
+            snapshot.DM_THINGS = 4
+        with pytest.raises(TypeError):
+            snapshot['DM_THINGS'] = 4
+
+    def test_freezing_validates_again(self, app, os_environ):
+        declare_settings(app, {'DM_THINGS': Setting(int, 3)})
+        app.config['DM_THINGS'] = "lots"
+
+        with pytest.raises(ValueError):
+            freeze_config(app)
+
+    def test_get_config_snapshot_freezes_once(self, app, os_environ):
+        declare_settings(app, {'DM_THINGS': Setting(int, 3)})
+        with app.app_context():
+            snapshot = get_config_snapshot()
+            app.config['DM_THINGS'] = 4
+
+            assert get_config_snapshot() is snapshot
+            assert get_config_snapshot().DM_THINGS == 3
+
+    def test_declaring_more_settings_discards_snapshot(self, app, os_environ):
+        declare_settings(app, {'DM_THINGS': Setting(int, 3)})
+        snapshot = get_config_snapshot(app)
+        declare_settings(app, {'DM_OTHER_THINGS': Setting(int, 4)})
+
+        assert get_config_snapshot(app) is not snapshot
+        assert get_config_snapshot(app).DM_OTHER_THINGS == 4
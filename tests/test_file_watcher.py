@@ -0,0 +1,156 @@
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+import pytest
+
+from dmutils import file_watcher
+from dmutils.flask_init import get_extra_files, init_manager
+
+
+@pytest.yield_fixture
+def tree():
+    directory = tempfile.mkdtemp()
+    for path in ("app.js", "styles/main.scss", "styles/main.css.map", "node_modules/dep/index.js", "images/logo.png"):
+        path = os.path.join(directory, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write("content")
+    yield directory
+    shutil.rmtree(directory)
+
+
+def _relative(paths, directory):
+    return sorted(os.path.relpath(path, directory) for path in paths)
+
+
+def _write(path, content="changed"):
+    with open(path, "w") as f:
+        f.write(content)
+    # make sure the change is visible to filesystems with coarse modification times
+    os.utime(path, (time.time() + 10, time.time() + 10))
+
+
+class TestIterFiles(object):
+    def test_skips_excluded_directories(self, tree):
+        assert _relative(file_watcher.iter_files([tree]), tree) == [
+            "app.js", "images/logo.png", "styles/main.css.map", "styles/main.scss",
+        ]
+
+    def test_include_and_exclude_patterns(self, tree):
+        files = file_watcher.iter_files([tree], include=("*.scss", "*.js", "*.map"), exclude=("styles/*.map",))
+
+        assert _relative(files, tree) == ["app.js", "node_modules/dep/index.js", "styles/main.scss"]
+
+    def test_excluded_directories_are_not_looked_inside(self, tree):
+        with mock.patch('dmutils.file_watcher._scandir', wraps=file_watcher._scandir) as scandir:
+            list(file_watcher.iter_files([tree]))
+
+        assert os.path.join(tree, "node_modules") not in [call[0][0] for call in scandir.call_args_list]
+
+    def test_works_without_scandir(self, tree):
+        with mock.patch('dmutils.file_watcher.scandir', None):
+            assert len(list(file_watcher.iter_files([tree]))) == 4
+
+
+class _WatcherTests(object):
+    def _watcher(self, tree, **kwargs):
+        raise NotImplementedError
+
+    def test_no_change(self, tree):
+        assert self._watcher(tree).wait_for_change(timeout=0.1) is None
+
+    def test_modified_file(self, tree):
+        watcher = self._watcher(tree)
+        _write(os.path.join(tree, "styles", "main.scss"))
+
+        assert watcher.wait_for_change(timeout=2) is not None
+
+    def test_new_file(self, tree):
+        watcher = self._watcher(tree)
+        _write(os.path.join(tree, "images", "new.png"))
+
+        assert watcher.wait_for_change(timeout=2) is not None
+
+    def test_deleted_file(self, tree):
+        watcher = self._watcher(tree)
+        os.remove(os.path.join(tree, "app.js"))
+
+        assert watcher.wait_for_change(timeout=2) is not None
+
+    def test_excluded_file_is_ignored(self, tree):
+        watcher = self._watcher(tree)
+        _write(os.path.join(tree, "node_modules", "dep", "index.js"))
+        _write(os.path.join(tree, "app.pyc"))
+
+        assert watcher.wait_for_change(timeout=0.2) is None
+
+
+class TestPollingWatcher(_WatcherTests):
+    def _watcher(self, tree, **kwargs):
+        return file_watcher.PollingWatcher([tree], interval=0.05, **kwargs)
+
+    def test_returns_directory_with_change(self, tree):
+        watcher = self._watcher(tree)
+        _write(os.path.join(tree, "app.js"))
+
+        assert watcher.wait_for_change(timeout=2) == tree
+
+
+@pytest.mark.skipif(not file_watcher.InotifyWatcher.available(), reason="needs inotify")
+class TestInotifyWatcher(_WatcherTests):
+    def _watcher(self, tree, **kwargs):
+        return file_watcher.InotifyWatcher([tree], **kwargs)
+
+    def test_returns_changed_path(self, tree):
+        watcher = self._watcher(tree)
+        _write(os.path.join(tree, "styles", "main.scss"))
+
+        assert watcher.wait_for_change(timeout=2) == os.path.join(tree, "styles", "main.scss")
+
+    def test_watches_new_directories(self, tree):
+        watcher = self._watcher(tree)
+        os.mkdir(os.path.join(tree, "fonts"))
+        assert watcher.wait_for_change(timeout=2) == os.path.join(tree, "fonts")
+
+        _write(os.path.join(tree, "fonts", "font.woff"))
+        assert watcher.wait_for_change(timeout=2) == os.path.join(tree, "fonts", "font.woff")
+
+    def test_relative_path_patterns(self, tree):
+        watcher = self._watcher(tree, exclude=("styles/*.map",))
+        _write(os.path.join(tree, "styles", "main.css.map"))
+        assert watcher.wait_for_change(timeout=0.2) is None
+
+        _write(os.path.join(tree, "styles", "main.scss"))
+        assert watcher.wait_for_change(timeout=2) == os.path.join(tree, "styles", "main.scss")
+
+    def test_watch_falls_back_to_polling_if_inotify_fails(self, tree):
+        with mock.patch.object(file_watcher.InotifyWatcher, '_add_watch', side_effect=OSError(28, "No space")):
+            assert isinstance(file_watcher.watch([tree]), file_watcher.PollingWatcher)
+
+
+def test_get_extra_files_lists_every_file(tree):
+    assert _relative(get_extra_files([tree]), tree) == [
+        "app.js", "images/logo.png", "node_modules/dep/index.js", "styles/main.css.map", "styles/main.scss",
+    ]
+
+
+class TestInitManager(object):
+    # the manager itself isn't what's being tested here
+    @mock.patch('flask_script.Manager')
+    @mock.patch('dmutils.file_watcher.exit_on_change')
+    def test_watches_extra_directories_in_reloader_child(self, exit_on_change, Manager, app, os_environ):
+        os_environ.update({"WERKZEUG_RUN_MAIN": "true"})
+        init_manager(app, 5000, ["app/assets"], exclude=("*.map",))
+
+        exit_on_change.assert_called_once_with(["app/assets"], include=("*",), exclude=("*.map",))
+
+    @mock.patch('flask_script.Manager')
+    @mock.patch('dmutils.file_watcher.exit_on_change')
+    def test_does_not_watch_outside_reloader_child(self, exit_on_change, Manager, app, os_environ):
+        init_manager(app, 5000, ["app/assets"])
+
+        assert exit_on_change.called is False
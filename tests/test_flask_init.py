@@ -1,6 +1,8 @@
-from dmutils.flask_init import pluralize
+import mock
 import pytest
 
+from dmutils.flask_init import init_app, pluralize
+
 
 @pytest.mark.parametrize("count,singular,plural,output", [
     (0, "person", "people", "people"),
@@ -9,3 +11,26 @@ import pytest
 ])
 def test_pluralize(count, singular, plural, output):
     assert pluralize(count, singular, plural) == output
+
+
+class ConfigObject(object):
+    BASE_TEMPLATE_DATA = {}
+
+
+@pytest.mark.parametrize("config,environ,tracing_initialised,prometheus_initialised", [
+    ({}, {}, False, False),
+    ({"DM_TRACING_ENABLED": True}, {}, True, False),
+    ({}, {"DM_METRICS_ENDPOINT_ENABLED": "true"}, False, True),
+])
+@mock.patch('dmutils.prometheus.init_app')
+@mock.patch('dmutils.tracing.init_app')
+def test_init_app_only_initialises_opt_in_modules_that_might_be_enabled(
+    tracing_init_app, prometheus_init_app, app, os_environ, config, environ, tracing_initialised,
+    prometheus_initialised,
+):
+    app.config.update(config)
+    os_environ.update(environ)
+    init_app(app, ConfigObject)
+
+    assert tracing_init_app.called is tracing_initialised
+    assert prometheus_init_app.called is prometheus_initialised
@@ -0,0 +1,127 @@
+import os
+import weakref
+
+import mock
+import pytest
+
+from dmutils import fork_hooks, metrics, prometheus, tracing
+from dmutils.s3 import S3
+
+
+@pytest.yield_fixture
+def hooks():
+    with mock.patch.object(fork_hooks, '_hooks', []) as hooks:
+        with mock.patch.object(fork_hooks, '_pid', os.getpid()):
+            yield hooks
+
+
+def test_hooks_only_run_in_a_new_process(hooks):
+    hook = fork_hooks.register_after_fork(mock.Mock(__name__="hook"))
+
+    fork_hooks.run_after_fork_hooks()
+    assert hook.called is False
+
+    with mock.patch('os.getpid', return_value=-1):
+        fork_hooks.run_after_fork_hooks()
+        fork_hooks.run_after_fork_hooks()
+    assert hook.call_count == 1
+
+
+def test_failing_hook_is_logged_and_others_still_run(hooks):
+    fork_hooks.register_after_fork(mock.Mock(__name__="bad_hook", side_effect=ValueError))
+    good_hook = fork_hooks.register_after_fork(mock.Mock(__name__="good_hook"))
+
+    with mock.patch('os.getpid', return_value=-1), mock.patch('dmutils.fork_hooks.logger') as logger:
+        fork_hooks.run_after_fork_hooks()
+
+    logger.exception.assert_called_once_with("After fork hook {hook} failed", extra={'hook': "bad_hook"})
+    assert good_hook.called is True
+
+
+@mock.patch('dmutils.metrics._cloudwatch_clients', {})
+@mock.patch('boto3.session.Session')
+def test_metrics_clients_are_reset(Session):
+    Session.return_value.client.side_effect = lambda service, region_name: mock.Mock()
+    buffered_client = metrics.buffered_client("myregion", "mynamespace")
+    with mock.patch.object(buffered_client, '_start_thread'):
+        buffered_client._put_metric("foo", 1)
+    buffered_client._thread = mock.Mock()
+    old_conn = buffered_client.client._conn
+
+    with mock.patch('os.getpid', return_value=-1):
+        metrics._reset_after_fork()
+        assert buffered_client.client._conn is not old_conn
+    assert buffered_client._buffer == {}
+    assert buffered_client._thread is None
+
+
+@mock.patch('boto3.resource')
+def test_s3_reconnects_on_first_use_in_a_forked_process(resource):
+    resource.side_effect = lambda service, region_name: mock.Mock()
+    s3 = S3("my-bucket")
+    old_bucket = s3._bucket
+
+    with mock.patch('os.getpid', return_value=-1):
+        # not until it's used
+        assert resource.call_count == 1
+        new_bucket = s3._bucket
+        assert new_bucket is not old_bucket
+        assert s3._bucket is new_bucket
+    assert resource.call_count == 2
+    assert s3.bucket_name == "my-bucket"
+
+
+def test_tracer_is_reset():
+    tracer = tracing.Tracer(mock.Mock(), "my-app")
+    with mock.patch.object(tracer, '_start_thread'):
+        tracer.start_span("trace-id").finish()
+    tracer._thread = mock.Mock()
+
+    tracing._reset_after_fork()
+
+    assert tracer._queue == []
+    assert tracer._thread is None
+
+
+def test_zipkin_sink_gets_a_new_session():
+    sink = tracing.ZipkinSink("http://zipkin:9411/api/v2/spans")
+    old_session = sink._session
+
+    tracing._reset_after_fork()
+
+    assert sink._session is not old_session
+
+
+def test_tracing_reset_does_not_import_requests_without_a_zipkin_sink():
+    with mock.patch('dmutils.tracing._zipkin_sink_instances', weakref.WeakSet()), \
+            mock.patch.dict('sys.modules', {'requests': None}):
+        tracing._reset_after_fork()
+
+
+def test_prometheus_registry_locks_are_replaced():
+    registry = prometheus.Registry()
+    registry._lock.acquire()
+    registry._values._lock.acquire()
+
+    prometheus._reset_after_fork()
+
+    registry.counter("things_total", "Things").inc()
+    assert "things_total 1.0\n" in registry.render()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+def test_hooks_run_in_forked_child():
+    tracer = tracing.Tracer(mock.Mock(), "my-app", flush_interval=60)
+    tracer.start_span("trace-id").finish()
+    assert tracer._thread is not None
+
+    pid = os.fork()
+    if pid == 0:
+        # run explicitly too, as they'd be on a python without os.register_at_fork via gunicorn's post_fork
+        fork_hooks.run_after_fork_hooks()
+        os._exit(0 if tracer._thread is None and tracer._queue == [] else 1)
+
+    _, status = os.waitpid(pid, 0)
+    tracer.close()
+    assert os.WEXITSTATUS(status) == 0
+    assert len(tracer.sink.send.call_args[0][0]) == 1
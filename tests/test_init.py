@@ -0,0 +1,24 @@
+import pytest
+
+import dmutils
+import dmutils.email
+from dmutils.email.exceptions import EmailError
+from dmutils.flask_init import init_app
+
+
+def test_package_attributes_are_available():
+    assert dmutils.init_app is init_app
+    assert dmutils.request_id.init_app is not None
+    assert {"config", "init_app", "init_manager", "logging", "request_id"} <= set(dir(dmutils))
+
+
+def test_email_package_attributes_are_available():
+    assert dmutils.email.EmailError is EmailError
+    assert "send_user_account_email" in dir(dmutils.email)
+
+
+def test_unknown_attributes_raise_attribute_error():
+    with pytest.raises(AttributeError):
+        dmutils.not_a_thing
+    with pytest.raises(AttributeError):
+        dmutils.email.not_a_thing
@@ -10,6 +10,7 @@ import json
 import mock
 
 from dmutils import request_id
+from dmutils.trace_context import trace_context
 from dmutils.logging import init_app, RequestIdFilter, JSONFormatter, CustomLogFormatter
 from dmutils.logging import LOG_FORMAT
 
@@ -18,6 +19,11 @@ def test_request_id_filter_not_in_app_context():
     assert RequestIdFilter().request_id == 'no-request-id'
 
 
+def test_request_id_filter_falls_back_to_trace_context():
+    with trace_context('from-context'):
+        assert RequestIdFilter().request_id == 'from-context'
+
+
 def test_formatter_request_id(app):
     headers = {'DM-Request-Id': 'generated'}
     request_id.init_app(app)  # set CustomRequest class
@@ -1,17 +1,45 @@
+from datetime import datetime
+import gc
+import json
+import logging
 import time
 
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 import mock
+import pytest
 
 from dmutils import metrics
+from dmutils.config import freeze_config
+from dmutils.logging import configure_handler, JSONFormatter, LOG_FORMAT
 from helpers import IsDatetime
 
 
-@mock.patch('dmutils.metrics.connect_to_region')
-def test_client_connects_to_region(connect_to_region):
-    connect_to_region.return_value = "myconn"
+@mock.patch('dmutils.metrics.get_cloudwatch_client')
+def test_client_connects_to_region(get_cloudwatch_client):
+    get_cloudwatch_client.return_value = "myconn"
     metrics.client("myregion", "mynamespace")
 
-    connect_to_region.assert_called_with("myregion")
+    get_cloudwatch_client.assert_called_with("myregion")
+
+
+@mock.patch('dmutils.metrics._cloudwatch_clients', {})
+@mock.patch('boto3.session.Session')
+def test_cloudwatch_clients_are_shared_per_region(Session):
+    Session.return_value.client.side_effect = lambda service, region_name: mock.Mock(region=region_name)
+
+    first = metrics.get_cloudwatch_client("myregion")
+    assert metrics.get_cloudwatch_client("myregion") is first
+    assert metrics.client("myregion", "mynamespace")._conn is first
+    assert metrics.get_cloudwatch_client("otherregion").region == "otherregion"
+
+    assert Session.return_value.client.call_args_list == [
+        mock.call("cloudwatch", region_name="myregion"),
+        mock.call("cloudwatch", region_name="otherregion"),
+    ]
 
 
 def test_client_default_dimensions_defaults_to_dict(cloudwatch):
@@ -25,13 +53,45 @@ def test_put_metric(cloudwatch):
     client._put_metric("foo", 1, unit="Count")
 
     cloudwatch.put_metric_data.assert_called_with(
-        namespace="mynamespace",
-        name="foo",
-        value=1,
-        timestamp=IsDatetime(),
-        unit="Count",
-        dimensions=dict(),
-        statistics=None)
+        Namespace="mynamespace",
+        MetricData=[{
+            "MetricName": "foo",
+            "Value": 1,
+            "Timestamp": IsDatetime(),
+            "Unit": "Count",
+            "Dimensions": [],
+        }])
+
+
+def test_put_metric_merges_dimensions(cloudwatch):
+    client = metrics.client("myregion", "mynamespace", {"app": "myapp", "page": "default"})
+    client._put_metric("foo", 1, dimensions={"page": "home"})
+
+    kwargs = cloudwatch.put_metric_data.call_args[1]
+    assert kwargs["MetricData"][0]["Dimensions"] == [
+        {"Name": "app", "Value": "myapp"},
+        {"Name": "page", "Value": "home"},
+    ]
+
+
+def test_put_metric_dimension_values_are_strings(cloudwatch):
+    client = metrics.client("myregion", "mynamespace", {"app": "myapp"})
+    client._put_metric("foo", 1, dimensions={"status": 404})
+
+    kwargs = cloudwatch.put_metric_data.call_args[1]
+    assert kwargs["MetricData"][0]["Dimensions"] == [
+        {"Name": "app", "Value": "myapp"},
+        {"Name": "status", "Value": "404"},
+    ]
+
+
+def test_put_metric_with_statistics(cloudwatch):
+    client = metrics.client("myregion", "mynamespace")
+    client._put_metric("foo", statistics={'samplecount': 3, 'sum': 12, 'minimum': 1, 'maximum': 8})
+
+    kwargs = cloudwatch.put_metric_data.call_args[1]
+    assert kwargs["MetricData"][0]["StatisticValues"] == {"SampleCount": 3, "Sum": 12, "Minimum": 1, "Maximum": 8}
+    assert "Value" not in kwargs["MetricData"][0]
 
 
 def test_timer(cloudwatch):
@@ -42,8 +102,21 @@ def test_timer(cloudwatch):
     cloudwatch.put_metric_data.assert_called()
     args, kwargs = cloudwatch.put_metric_data.call_args
 
-    assert 0 < kwargs['value'] < 150
-    assert kwargs['unit'] == "Milliseconds"
+    assert 0 < kwargs['MetricData'][0]['Value'] < 150
+    assert kwargs['MetricData'][0]['Unit'] == "Milliseconds"
+
+
+def test_timer_with_dimensions(cloudwatch):
+    client = metrics.client("myregion", "mynamespace")
+
+    @client.timer("mytimer", dimensions={"endpoint": "main.index"})
+    def timed():
+        pass
+
+    timed()
+
+    kwargs = cloudwatch.put_metric_data.call_args[1]
+    assert kwargs['MetricData'][0]['Dimensions'] == [{"Name": "endpoint", "Value": "main.index"}]
 
 
 def test_flask_client_returns_none_before_init():
@@ -85,3 +158,302 @@ def test_flask_client_merges_configured_dimensions(app, cloudwatch):
         "applicationName": "none",
         "customDimension": "value",
     }
+
+
+def test_flask_client_reads_settings_from_the_config_snapshot(app, cloudwatch):
+    client = metrics.flask_client()
+    client.init_app(app)
+    freeze_config(app)
+    # not declared again, so not seen
+    app.config['DM_METRICS_BACKEND'] = 'emf'
+
+    with app.app_context():
+        assert isinstance(client.client, metrics.CloudWatchClient)
+
+
+def test_flask_client_returns_same_buffered_client_across_app_contexts(app, cloudwatch):
+    client = metrics.flask_client()
+    app.config['DM_METRICS_BUFFERED'] = True
+    client.init_app(app)
+
+    with app.app_context():
+        buffered = client.client
+    with app.app_context():
+        assert client.client is buffered
+
+    assert isinstance(buffered, metrics.BufferedClient)
+    assert buffered.client.default_dimensions == {'applicationName': 'none'}
+
+
+class TestBufferedClient(object):
+    def test_put_metric_does_not_send_immediately(self, cloudwatch):
+        client = metrics.buffered_client("myregion", "mynamespace", flush_interval=3600)
+        client._put_metric("foo", 1, unit="Count")
+
+        assert cloudwatch.put_metric_data.called is False
+        client.close()
+
+    def test_datapoints_are_aggregated_into_statistic_sets(self, cloudwatch):
+        client = metrics.buffered_client("myregion", "mynamespace", {"app": "myapp"}, flush_interval=3600)
+        for value in (3, 1, 8):
+            client._put_metric("foo", value, unit="Milliseconds")
+        client._put_metric("foo", 5, unit="Milliseconds", dimensions={"page": "home"})
+        client.flush()
+
+        cloudwatch.put_metric_data.assert_called_once_with(Namespace="mynamespace", MetricData=mock.ANY)
+        metric_data = sorted(
+            cloudwatch.put_metric_data.call_args[1]['MetricData'],
+            key=lambda datum: len(datum['Dimensions']),
+        )
+        assert metric_data == [
+            {
+                "MetricName": "foo",
+                "Timestamp": IsDatetime(),
+                "Unit": "Milliseconds",
+                "Dimensions": [{"Name": "app", "Value": "myapp"}],
+                "StatisticValues": {"SampleCount": 3, "Sum": 12, "Minimum": 1, "Maximum": 8},
+            },
+            {
+                "MetricName": "foo",
+                "Timestamp": IsDatetime(),
+                "Unit": "Milliseconds",
+                "Dimensions": [{"Name": "app", "Value": "myapp"}, {"Name": "page", "Value": "home"}],
+                "StatisticValues": {"SampleCount": 1, "Sum": 5, "Minimum": 5, "Maximum": 5},
+            },
+        ]
+        client.close()
+
+    def test_flush_sends_batches_of_at_most_20(self, cloudwatch):
+        client = metrics.buffered_client("myregion", "mynamespace", flush_interval=3600, max_buffer_size=100)
+        for i in range(45):
+            client._put_metric("foo{}".format(i), i)
+        client.flush()
+
+        assert [len(c[1]['MetricData']) for c in cloudwatch.put_metric_data.call_args_list] == [20, 20, 5]
+        client.close()
+
+    def test_flush_empties_the_buffer(self, cloudwatch):
+        client = metrics.buffered_client("myregion", "mynamespace", flush_interval=3600)
+        client._put_metric("foo", 1)
+        client.flush()
+        client.flush()
+
+        assert cloudwatch.put_metric_data.call_count == 1
+        client.close()
+
+    def test_new_series_are_dropped_when_buffer_is_full(self, cloudwatch):
+        client = metrics.buffered_client("myregion", "mynamespace", flush_interval=3600, max_buffer_size=2)
+        # stop the background thread flushing the full buffer before we've had a chance to overfill it
+        client._thread = mock.Mock()
+        client._put_metric("foo", 1)
+        client._put_metric("bar", 1)
+        client._put_metric("baz", 1)
+        client._put_metric("foo", 2)
+
+        assert client.dropped == 1
+        client.flush()
+        metric_data = cloudwatch.put_metric_data.call_args[1]['MetricData']
+        assert sorted(datum['MetricName'] for datum in metric_data) == ["bar", "foo"]
+
+    def test_full_buffer_is_flushed_in_the_background(self, cloudwatch):
+        client = metrics.buffered_client("myregion", "mynamespace", flush_interval=3600, max_buffer_size=2)
+        client._put_metric("foo", 1)
+        client._put_metric("bar", 1)
+
+        for _ in range(50):
+            if cloudwatch.put_metric_data.called:
+                break
+            time.sleep(0.01)
+        assert cloudwatch.put_metric_data.called
+        client.close()
+
+    def test_close_flushes_remaining_metrics(self, cloudwatch):
+        client = metrics.buffered_client("myregion", "mynamespace", flush_interval=3600)
+        client._put_metric("foo", 1)
+        client.close()
+
+        assert cloudwatch.put_metric_data.call_count == 1
+        assert not client._thread.is_alive()
+
+    def test_clients_still_in_use_are_closed_at_exit(self, cloudwatch):
+        client = metrics.buffered_client("myregion", "mynamespace", flush_interval=3600)
+        client._put_metric("foo", 1)
+
+        metrics._close_buffered_clients()
+
+        assert cloudwatch.put_metric_data.call_count == 1
+        assert client._closed.is_set()
+
+    def test_discarded_clients_are_garbage_collected_and_their_threads_stop(self, cloudwatch):
+        client = metrics.buffered_client("myregion", "discarded", flush_interval=0.01)
+        client._put_metric("foo", 1)
+        thread = client._thread
+        del client
+        gc.collect()
+
+        thread.join(1)
+        assert not thread.is_alive()
+        assert not [c for c in metrics._buffered_client_instances if c.namespace == "discarded"]
+
+    def test_failed_flush_is_logged_and_not_raised(self, cloudwatch):
+        cloudwatch.put_metric_data.side_effect = Exception("AWS is down")
+        client = metrics.buffered_client("myregion", "mynamespace", flush_interval=3600)
+        client._put_metric("foo", 1)
+
+        with mock.patch('dmutils.metrics.logger') as logger:
+            client.close()
+
+        logger.exception.assert_called_once_with("Failed to send {count} buffered metrics", extra={'count': 1})
+
+    def test_timer(self, cloudwatch):
+        client = metrics.buffered_client("myregion", "mynamespace", flush_interval=3600)
+        with client.timer("mytimer"):
+            time.sleep(0.01)
+        client.flush()
+
+        metric_data = cloudwatch.put_metric_data.call_args[1]['MetricData']
+        assert [datum['MetricName'] for datum in metric_data] == [
+            "mytimer", "mytimer.p50", "mytimer.p90", "mytimer.p99",
+        ]
+        assert metric_data[0]['Unit'] == "Milliseconds"
+        assert metric_data[0]['StatisticValues']['SampleCount'] == 1
+        # timings aren't truncated to whole milliseconds any more
+        assert metric_data[0]['StatisticValues']['Sum'] != int(metric_data[0]['StatisticValues']['Sum'])
+        client.close()
+
+    def test_timings_are_published_as_count_and_percentiles(self, cloudwatch):
+        client = metrics.buffered_client("myregion", "mynamespace", flush_interval=3600)
+        for value in range(1, 101):
+            client.timing("mytimer", value, dimensions={"endpoint": "main.index"})
+        client.timing("mytimer", 1000, dimensions={"endpoint": "main.other"})
+        client.flush()
+
+        metric_data = cloudwatch.put_metric_data.call_args[1]['MetricData']
+        index_metrics = {
+            datum['MetricName']: datum['StatisticValues']
+            for datum in metric_data
+            if datum['Dimensions'] == [{"Name": "endpoint", "Value": "main.index"}]
+        }
+        assert index_metrics["mytimer"] == {"SampleCount": 100, "Sum": 5050, "Minimum": 1, "Maximum": 100}
+        for name, expected in (("mytimer.p50", 50), ("mytimer.p90", 90), ("mytimer.p99", 99)):
+            assert index_metrics[name]["SampleCount"] == 1
+            assert expected <= index_metrics[name]["Sum"] <= expected * metrics.Histogram.GROWTH
+        assert len(metric_data) == 8
+        client.close()
+
+    def test_timings_count_towards_buffer_size(self, cloudwatch):
+        client = metrics.buffered_client("myregion", "mynamespace", flush_interval=3600, max_buffer_size=2)
+        client._thread = mock.Mock()
+        client._put_metric("foo", 1)
+        client.timing("bar", 1)
+        client.timing("baz", 1)
+
+        assert client.dropped == 1
+
+
+class TestHistogram(object):
+    def test_empty_histogram_has_no_percentiles(self):
+        assert metrics.Histogram().percentile(50) is None
+
+    def test_percentiles_are_within_bucket_accuracy(self):
+        histogram = metrics.Histogram()
+        for value in range(1, 1001):
+            histogram.record(value * 0.5)
+
+        for percentile in (50, 90, 99):
+            expected = percentile * 5
+            assert expected <= histogram.percentile(percentile) <= expected * metrics.Histogram.GROWTH
+
+    def test_percentiles_are_clamped_to_recorded_range(self):
+        histogram = metrics.Histogram()
+        histogram.record(7.0)
+
+        assert histogram.percentile(50) == histogram.percentile(99) == 7.0
+
+    def test_keeps_exact_summary(self):
+        histogram = metrics.Histogram()
+        for value in (0, 2.5, 10):
+            histogram.record(value)
+
+        assert (histogram.count, histogram.sum, histogram.minimum, histogram.maximum) == (3, 12.5, 0, 10)
+        assert histogram.percentile(1) <= metrics.Histogram.MIN_VALUE * metrics.Histogram.GROWTH
+
+    def test_buckets_are_sparse(self):
+        histogram = metrics.Histogram()
+        for _ in range(1000):
+            histogram.record(12.0)
+        histogram.record(120000.0)
+
+        assert len(histogram.buckets) == 2
+
+
+def test_flask_client_returns_emf_client_when_configured(app):
+    client = metrics.flask_client()
+    app.config['DM_METRICS_BACKEND'] = 'emf'
+    client.init_app(app)
+
+    with app.app_context():
+        assert isinstance(client.client, metrics.EMFClient)
+        assert client.client.default_dimensions == {'applicationName': 'none'}
+
+
+class TestEMFClient(object):
+    @pytest.yield_fixture
+    def log_lines(self, app):
+        buffer = StringIO()
+        handler = configure_handler(logging.StreamHandler(buffer), app, JSONFormatter(LOG_FORMAT))
+        metrics.logger.addHandler(handler)
+        metrics.logger.setLevel(logging.INFO)
+
+        yield lambda: [json.loads(line) for line in buffer.getvalue().splitlines()]
+
+        metrics.logger.removeHandler(handler)
+
+    def test_put_metric_writes_embedded_metric_format(self, log_lines):
+        client = metrics.emf_client("mynamespace", {"applicationName": "myapp"})
+        client._put_metric("foo", 3, unit="Count", dimensions={"page": "home"}, timestamp=datetime(2017, 1, 2, 3, 4, 5))
+
+        [line] = log_lines()
+        assert line["_aws"] == {
+            "Timestamp": 1483326245000,
+            "CloudWatchMetrics": [{
+                "Namespace": "mynamespace",
+                "Dimensions": [["applicationName", "page"]],
+                "Metrics": [{"Name": "foo", "Unit": "Count"}],
+            }],
+        }
+        assert line["foo"] == 3
+        assert line["applicationName"] == "myapp"
+        assert line["page"] == "home"
+        assert line["message"] == "Embedded metrics"
+
+    def test_dimension_values_are_strings(self, log_lines):
+        client = metrics.emf_client("mynamespace")
+        client._put_metric("foo", 1, dimensions={"status": 404})
+
+        [line] = log_lines()
+        assert line["status"] == "404"
+
+    def test_timer_logs_fractional_milliseconds(self, log_lines):
+        client = metrics.emf_client("mynamespace")
+        with client.timer("mytimer", dimensions={"endpoint": "main.index"}):
+            time.sleep(0.01)
+
+        [line] = log_lines()
+        assert line["_aws"]["CloudWatchMetrics"][0]["Metrics"] == [{"Name": "mytimer", "Unit": "Milliseconds"}]
+        assert 10 <= line["mytimer"] < 150
+        assert line["endpoint"] == "main.index"
+
+    def test_statistics_are_not_supported(self):
+        client = metrics.emf_client("mynamespace")
+        with pytest.raises(ValueError):
+            client._put_metric("foo", statistics={'samplecount': 1, 'sum': 1, 'minimum': 1, 'maximum': 1})
+
+    @pytest.mark.parametrize("name, dimensions", (
+        ("message", None),
+        ("foo", {"levelname": "x"}),
+    ))
+    def test_names_clashing_with_log_record_attributes_are_rejected(self, name, dimensions):
+        client = metrics.emf_client("mynamespace")
+        with pytest.raises(ValueError):
+            client._put_metric(name, 1, dimensions=dimensions)
@@ -0,0 +1,207 @@
+import os
+import shutil
+import tempfile
+import threading
+
+import mock
+import pytest
+
+from dmutils import prometheus
+
+
+@pytest.fixture
+def registry():
+    return prometheus.Registry()
+
+
+@pytest.yield_fixture
+def multiprocess_dir():
+    directory = tempfile.mkdtemp()
+    yield directory
+    shutil.rmtree(directory)
+
+
+@pytest.yield_fixture
+def metrics_app(app):
+    app.config['DM_METRICS_ENDPOINT_ENABLED'] = True
+    with mock.patch('dmutils.prometheus.REGISTRY', prometheus.Registry()):
+        prometheus.init_app(app)
+
+        @app.route('/hello')
+        def hello():
+            return 'hello'
+
+        yield app
+
+
+def test_counter(registry):
+    counter = registry.counter("things_total", "Things")
+    counter.inc()
+    counter.inc(2)
+
+    assert registry.render() == "# HELP things_total Things\n# TYPE things_total counter\nthings_total 3.0\n"
+
+
+def test_unused_unlabelled_counter_renders_zero(registry):
+    registry.counter("things_total", "Things")
+
+    assert "things_total 0.0\n" in registry.render()
+
+
+def test_counter_cannot_be_decreased(registry):
+    with pytest.raises(ValueError):
+        registry.counter("things_total", "Things").inc(-1)
+
+
+def test_labelled_counter(registry):
+    counter = registry.counter("things_total", "Things", ("colour",))
+    counter.labels(colour="red").inc()
+    counter.labels(colour="blue").inc(5)
+    counter.labels(colour='say "hi"\n').inc()
+
+    assert registry.render().splitlines()[2:] == [
+        'things_total{colour="blue"} 5.0',
+        'things_total{colour="red"} 1.0',
+        'things_total{colour="say \\"hi\\"\\n"} 1.0',
+    ]
+
+
+def test_labels_must_match_labelnames(registry):
+    counter = registry.counter("things_total", "Things", ("colour",))
+    with pytest.raises(ValueError):
+        counter.labels(shape="square")
+
+
+def test_gauge(registry):
+    gauge = registry.gauge("temperature", "Temperature")
+    gauge.set(10)
+    gauge.inc(3)
+    gauge.dec()
+
+    assert "# TYPE temperature gauge\ntemperature 12.0\n" in registry.render()
+
+
+def test_histogram(registry):
+    histogram = registry.histogram("duration_seconds", "Durations", ("endpoint",), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.labels(endpoint="index").observe(value)
+
+    assert registry.render().splitlines()[2:] == [
+        'duration_seconds_bucket{endpoint="index",le="0.1"} 1.0',
+        'duration_seconds_bucket{endpoint="index",le="1.0"} 3.0',
+        'duration_seconds_bucket{endpoint="index",le="+Inf"} 4.0',
+        'duration_seconds_sum{endpoint="index"} 6.05',
+        'duration_seconds_count{endpoint="index"} 4.0',
+    ]
+
+
+def test_asking_for_existing_metric_returns_it(registry):
+    assert registry.counter("things_total", "Things") is registry.counter("things_total", "Things")
+
+
+def test_asking_for_existing_metric_with_different_type_fails(registry):
+    registry.counter("things", "Things")
+    with pytest.raises(ValueError):
+        registry.gauge("things", "Things")
+
+
+def test_counter_is_thread_safe(registry):
+    counter = registry.counter("things_total", "Things")
+
+    def increment():
+        for _ in range(1000):
+            counter.inc()
+
+    threads = [threading.Thread(target=increment) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert "things_total 8000.0\n" in registry.render()
+
+
+class TestMultiprocess(object):
+    def test_values_are_written_to_a_file_per_process(self, multiprocess_dir):
+        registry = prometheus.Registry(multiprocess_dir)
+        registry.counter("things_total", "Things").inc()
+
+        assert os.listdir(multiprocess_dir) == ["{}.db".format(os.getpid())]
+        assert "things_total 1.0\n" in registry.render()
+
+    def test_values_are_summed_across_processes(self, multiprocess_dir):
+        registry = prometheus.Registry(multiprocess_dir)
+        counter = registry.counter("things_total", "Things", ("colour",))
+        histogram = registry.histogram("duration_seconds", "Durations", buckets=(1,))
+
+        counter.labels(colour="red").inc()
+        histogram.observe(0.5)
+        with mock.patch('os.getpid', return_value=-1):
+            counter.labels(colour="red").inc(2)
+            counter.labels(colour="blue").inc()
+            histogram.observe(2)
+
+        assert sorted(os.listdir(multiprocess_dir)) == sorted(["{}.db".format(os.getpid()), "-1.db"])
+        assert registry.render().splitlines()[2:] == [
+            'things_total{colour="blue"} 1.0',
+            'things_total{colour="red"} 3.0',
+            '# HELP duration_seconds Durations',
+            '# TYPE duration_seconds histogram',
+            'duration_seconds_bucket{le="1.0"} 1.0',
+            'duration_seconds_bucket{le="+Inf"} 2.0',
+            'duration_seconds_sum 2.5',
+            'duration_seconds_count 2.0',
+        ]
+
+    def test_existing_file_is_reused(self, multiprocess_dir):
+        prometheus.Registry(multiprocess_dir).counter("things_total", "Things").inc(3)
+
+        registry = prometheus.Registry(multiprocess_dir)
+        registry.counter("things_total", "Things").inc()
+
+        assert "things_total 4.0\n" in registry.render()
+        assert len(os.listdir(multiprocess_dir)) == 1
+
+    def test_file_grows_when_full(self, multiprocess_dir):
+        registry = prometheus.Registry(multiprocess_dir)
+        counter = registry.counter("things_total", "Things", ("thing",))
+        for i in range(2000):
+            counter.labels(thing="thing-number-{}".format(i)).inc(i)
+
+        [filename] = os.listdir(multiprocess_dir)
+        assert os.path.getsize(os.path.join(multiprocess_dir, filename)) > prometheus._MmapDict._INITIAL_SIZE
+        assert 'things_total{thing="thing-number-1999"} 1999.0' in registry.render()
+
+
+class TestInitApp(object):
+    def test_disabled_by_default(self, app):
+        prometheus.init_app(app)
+
+        assert app.test_client().get('/_metrics').status_code == 404
+
+    def test_exposes_metrics(self, metrics_app):
+        response = metrics_app.test_client().get('/_metrics')
+
+        assert response.status_code == 200
+        assert response.headers['Content-Type'] == prometheus.CONTENT_TYPE
+        assert "# TYPE http_requests_total counter" in response.get_data(as_text=True)
+
+    def test_records_requests_by_endpoint(self, metrics_app):
+        client = metrics_app.test_client()
+        client.get('/hello')
+        client.get('/hello')
+        client.get('/nowhere')
+
+        rendered = prometheus.REGISTRY.render()
+        assert 'http_requests_total{app="none",endpoint="hello",method="GET",status="200"} 2.0' in rendered
+        assert 'http_requests_total{app="none",endpoint="none",method="GET",status="404"} 1.0' in rendered
+        assert 'http_request_duration_seconds_count{app="none",endpoint="hello",method="GET"} 2.0' in rendered
+
+    def test_uses_multiprocess_dir(self, app, multiprocess_dir):
+        app.config['DM_METRICS_ENDPOINT_ENABLED'] = True
+        app.config['DM_METRICS_MULTIPROCESS_DIR'] = multiprocess_dir
+        with mock.patch('dmutils.prometheus.REGISTRY', prometheus.Registry()):
+            prometheus.init_app(app)
+            app.test_client().get('/_metrics')
+
+        assert os.listdir(multiprocess_dir) == ["{}.db".format(os.getpid())]
@@ -1,9 +1,19 @@
 from flask import request
 from itertools import chain, product
+import re
+
+from flask import Request
 import mock
 import pytest
 
-from dmutils.request_id import init_app as request_id_init_app
+from dmutils.request_id import (
+    init_app as request_id_init_app,
+    generate_span_id,
+    generate_trace_id,
+    RequestIdRequestMixin,
+    ResponseHeaderMiddleware,
+    TRACE_ID_ENVIRON_KEY,
+)
 
 
 _GENERATED_TRACE_VALUE = "d15ea5e5deadbeefbaadf00dabadcafe"
@@ -23,7 +33,7 @@ _trace_id_related_params = (
         ),
         # expected_trace_id
         "from-header",
-        # expect_uuid_call
+        # expect_id_generation
         False,
         # expected_onwards_req_headers
         {
@@ -74,7 +84,7 @@ _trace_id_related_params = (
         (),
         # expected_trace_id
         _GENERATED_TRACE_VALUE,
-        # expect_uuid_call
+        # expect_id_generation
         True,
         # expected_onwards_req_headers
         {
@@ -99,7 +109,7 @@ _trace_id_related_params = (
         (),
         # expected_trace_id
         _GENERATED_TRACE_VALUE,
-        # expect_uuid_call
+        # expect_id_generation
         True,
         # expected_onwards_req_headers
         {
@@ -126,7 +136,7 @@ _trace_id_related_params = (
         ),
         # expected_trace_id
         _GENERATED_TRACE_VALUE,
-        # expect_uuid_call
+        # expect_id_generation
         True,
         # expected_onwards_req_headers
         {
@@ -156,7 +166,7 @@ _trace_id_related_params = (
         ),
         # expected_trace_id
         _GENERATED_TRACE_VALUE,
-        # expect_uuid_call
+        # expect_id_generation
         True,
         # expected_onwards_req_headers
         {
@@ -183,7 +193,7 @@ _trace_id_related_params = (
         ),
         # expected_trace_id
         "tommy-header-value",
-        # expect_uuid_call
+        # expect_id_generation
         False,
         # expected_onwards_req_headers
         {
@@ -211,7 +221,7 @@ _trace_id_related_params = (
         ),
         # expected_trace_id
         "Grilled Mutton",
-        # expect_uuid_call
+        # expect_id_generation
         False,
         # expected_onwards_req_headers
         {
@@ -318,7 +328,7 @@ _param_combinations = tuple(
         # extra_req_headers
         tuple(chain(t_extra_req_headers, s_extra_req_headers, p_extra_req_headers)),
         expected_trace_id,
-        expect_uuid_call,
+        expect_id_generation,
         expected_span_id,
         expected_parent_span_id,
         # expected_onwards_req_headers
@@ -329,7 +339,7 @@ _param_combinations = tuple(
         t_extra_config,
         t_extra_req_headers,
         expected_trace_id,
-        expect_uuid_call,
+        expect_id_generation,
         t_expected_onwards_req_headers,
         # so far only the trace_id should affect the response headers
         expected_resp_headers,
@@ -352,7 +362,7 @@ _param_combinations = tuple(
         "extra_config",
         "extra_req_headers",
         "expected_trace_id",
-        "expect_uuid_call",
+        "expect_id_generation",
         "expected_span_id",
         "expected_parent_span_id",
         "expected_onwards_req_headers",
@@ -361,14 +371,14 @@ _param_combinations = tuple(
     ),
     _param_combinations,
 )
-@mock.patch('dmutils.request_id.uuid.uuid4', autospec=True)
+@mock.patch('dmutils.request_id.generate_trace_id', autospec=True)
 def test_request_header(
-    uuid4_mock,
+    generate_trace_id_mock,
     app,
     extra_config,
     extra_req_headers,
     expected_trace_id,
-    expect_uuid_call,
+    expect_id_generation,
     expected_span_id,
     expected_parent_span_id,
     expected_onwards_req_headers,
@@ -380,7 +390,7 @@ def test_request_header(
 
     assert app.config.get("DM_REQUEST_ID_HEADER") == expected_dm_request_id_header_final_value
 
-    uuid4_mock.return_value = mock.Mock(hex=_GENERATED_TRACE_VALUE)
+    generate_trace_id_mock.return_value = _GENERATED_TRACE_VALUE
 
     with app.test_request_context(headers=extra_req_headers):
         assert request.request_id == request.trace_id == expected_trace_id
@@ -389,7 +399,7 @@ def test_request_header(
         assert request.get_onwards_request_headers() == expected_onwards_req_headers
         assert app.config.get("DM_REQUEST_ID_HEADER") == expected_dm_request_id_header_final_value
 
-    assert uuid4_mock.called is expect_uuid_call
+    assert generate_trace_id_mock.called is expect_id_generation
 
 
 @pytest.mark.parametrize(
@@ -397,7 +407,7 @@ def test_request_header(
         "extra_config",
         "extra_req_headers",
         "expected_trace_id",
-        "expect_uuid_call",
+        "expect_id_generation",
         "expected_span_id",
         "expected_parent_span_id",
         "expected_onwards_req_headers",
@@ -406,14 +416,14 @@ def test_request_header(
     ),
     _param_combinations,
 )
-@mock.patch('dmutils.request_id.uuid.uuid4', autospec=True)
+@mock.patch('dmutils.request_id.generate_trace_id', autospec=True)
 def test_response_headers_regular_response(
-    uuid4_mock,
+    generate_trace_id_mock,
     app,
     extra_config,
     extra_req_headers,
     expected_trace_id,  # unused here
-    expect_uuid_call,
+    expect_id_generation,
     expected_span_id,  # unused here
     expected_parent_span_id,  # unused here
     expected_onwards_req_headers,  # unused here
@@ -424,14 +434,14 @@ def test_response_headers_regular_response(
     request_id_init_app(app)
     client = app.test_client()
 
-    uuid4_mock.return_value = mock.Mock(hex=_GENERATED_TRACE_VALUE)
+    generate_trace_id_mock.return_value = _GENERATED_TRACE_VALUE
 
     with app.app_context():
         response = client.get('/', headers=extra_req_headers)
         # note using these mechanisms we're not able to test for the *absence* of a header
         assert {k: v for k, v in response.headers.items() if k in expected_onwards_req_headers} == expected_resp_headers
 
-    assert uuid4_mock.called is expect_uuid_call
+    assert generate_trace_id_mock.called is expect_id_generation
 
 
 @pytest.mark.parametrize(
@@ -439,7 +449,7 @@ def test_response_headers_regular_response(
         "extra_config",
         "extra_req_headers",
         "expected_trace_id",
-        "expect_uuid_call",
+        "expect_id_generation",
         "expected_span_id",
         "expected_parent_span_id",
         "expected_onwards_req_headers",
@@ -448,14 +458,14 @@ def test_response_headers_regular_response(
     ),
     _param_combinations,
 )
-@mock.patch('dmutils.request_id.uuid.uuid4', autospec=True)
+@mock.patch('dmutils.request_id.generate_trace_id', autospec=True)
 def test_response_headers_error_response(
-    uuid4_mock,
+    generate_trace_id_mock,
     app,
     extra_config,
     extra_req_headers,
     expected_trace_id,  # unused here
-    expect_uuid_call,
+    expect_id_generation,
     expected_span_id,  # unused here
     expected_parent_span_id,  # unused here
     expected_onwards_req_headers,  # unused here
@@ -466,7 +476,7 @@ def test_response_headers_error_response(
     request_id_init_app(app)
     client = app.test_client()
 
-    uuid4_mock.return_value = mock.Mock(hex=_GENERATED_TRACE_VALUE)
+    generate_trace_id_mock.return_value = _GENERATED_TRACE_VALUE
 
     @app.route('/')
     def error_route():
@@ -477,4 +487,123 @@ def test_response_headers_error_response(
         assert response.status_code == 500
         assert {k: v for k, v in response.headers.items() if k in expected_onwards_req_headers} == expected_resp_headers
 
-    assert uuid4_mock.called is expect_uuid_call
+    assert generate_trace_id_mock.called is expect_id_generation
+
+
+class TestResponseHeaderMiddleware(object):
+    @staticmethod
+    def _call(app, environ=None):
+        start_response = mock.Mock()
+        middleware = ResponseHeaderMiddleware(app, ("DM-Request-ID", "X-B3-TraceId"))
+        middleware({} if environ is None else environ, start_response)
+        return start_response.call_args[0][1]
+
+    @staticmethod
+    def _wsgi_app(headers):
+        def wsgi_app(environ, start_response):
+            start_response("200 OK", list(headers))
+            return [b""]
+        return wsgi_app
+
+    def test_adds_trace_id_from_request_header_without_flask(self):
+        headers = self._call(self._wsgi_app([("Content-Type", "text/plain")]), {"HTTP_X_B3_TRACEID": "from-header"})
+
+        assert headers == [
+            ("Content-Type", "text/plain"),
+            ("DM-Request-ID", "from-header"),
+            ("X-B3-TraceId", "from-header"),
+        ]
+
+    def test_prefers_trace_id_already_in_environ(self):
+        headers = self._call(
+            self._wsgi_app([]),
+            {"HTTP_DM_REQUEST_ID": "from-header", TRACE_ID_ENVIRON_KEY: "from-environ"},
+        )
+
+        assert headers == [("DM-Request-ID", "from-environ"), ("X-B3-TraceId", "from-environ")]
+
+    @mock.patch('dmutils.request_id.generate_trace_id', autospec=True)
+    def test_generates_trace_id_once_and_stores_it(self, generate_trace_id_mock):
+        generate_trace_id_mock.return_value = _GENERATED_TRACE_VALUE
+        environ = {}
+        headers = self._call(self._wsgi_app([]), environ)
+
+        assert headers == [("DM-Request-ID", _GENERATED_TRACE_VALUE), ("X-B3-TraceId", _GENERATED_TRACE_VALUE)]
+        assert environ[TRACE_ID_ENVIRON_KEY] == _GENERATED_TRACE_VALUE
+        assert generate_trace_id_mock.call_count == 1
+
+    def test_headers_set_by_app_are_kept_regardless_of_case(self):
+        headers = self._call(
+            self._wsgi_app([("x-b3-traceid", "set-by-app")]),
+            {"HTTP_DM_REQUEST_ID": "from-header"},
+        )
+
+        assert headers == [("x-b3-traceid", "set-by-app"), ("DM-Request-ID", "from-header")]
+
+    @mock.patch('dmutils.request_id.generate_trace_id', autospec=True)
+    def test_headers_all_set_by_app_need_no_trace_id(self, generate_trace_id_mock):
+        headers = self._call(self._wsgi_app([("DM-Request-ID", "a"), ("X-B3-TraceId", "b")]))
+
+        assert headers == [("DM-Request-ID", "a"), ("X-B3-TraceId", "b")]
+        assert generate_trace_id_mock.called is False
+
+    def test_headers_list_reused_by_app_is_left_alone(self):
+        reused_headers = [("Content-Type", "text/plain")]
+
+        def wsgi_app(environ, start_response):
+            start_response("200 OK", reused_headers)
+            return [b""]
+
+        first = self._call(wsgi_app, {"HTTP_X_B3_TRACEID": "first"})
+        second = self._call(wsgi_app, {"HTTP_X_B3_TRACEID": "second"})
+
+        assert reused_headers == [("Content-Type", "text/plain")]
+        assert first == [("Content-Type", "text/plain"), ("DM-Request-ID", "first"), ("X-B3-TraceId", "first")]
+        assert second == [("Content-Type", "text/plain"), ("DM-Request-ID", "second"), ("X-B3-TraceId", "second")]
+
+    def test_flask_request_and_response_agree_on_generated_trace_id(self, app):
+        request_id_init_app(app)
+
+        @app.route('/')
+        def index():
+            return request.trace_id
+
+        response = app.test_client().get('/')
+        assert response.headers["DM-Request-ID"] == response.get_data(as_text=True)
+
+
+@pytest.mark.parametrize(("bits", "length"), ((128, 32), (64, 16)))
+def test_generate_trace_id(bits, length):
+    trace_id = generate_trace_id(bits)
+
+    assert re.match(r"^[0-9a-f]{%d}$" % length, trace_id)
+    assert trace_id != generate_trace_id(bits)
+
+
+def test_generate_span_id():
+    assert re.match(r"^[0-9a-f]{16}$", generate_span_id())
+
+
+def test_64_bit_trace_ids_can_be_configured(app):
+    app.config["DM_TRACE_ID_BITS"] = 64
+    request_id_init_app(app)
+
+    @app.route('/')
+    def index():
+        return request.trace_id
+
+    response = app.test_client().get('/')
+    assert len(response.get_data(as_text=True)) == 16
+    assert response.headers["DM-Request-ID"] == response.get_data(as_text=True)
+
+
+def test_mixin_without_init_app_reads_header_names_from_config(app):
+    class _Request(RequestIdRequestMixin, Request):
+        pass
+
+    app.request_class = _Request
+    app.config["DM_TRACE_ID_HEADERS"] = ("My-Trace-Id",)
+    app.config["DM_SPAN_ID_HEADERS"] = ("My-Span-Id",)
+    with app.test_request_context(headers={"My-Trace-Id": "trace-id", "My-Span-Id": "span-id"}):
+        assert request.trace_id == "trace-id"
+        assert request.span_id == "span-id"
@@ -0,0 +1,123 @@
+import threading
+
+from flask import request
+import mock
+import pytest
+
+from dmutils import request_id, trace_context as trace_context_module
+from dmutils.trace_context import (
+    get_trace_context,
+    get_trace_id,
+    reset_trace_context,
+    set_trace_context,
+    submit_with_context,
+    trace_context,
+    TraceContext,
+    wrap_with_context,
+)
+
+
+class ThreadExecutor(object):
+    """Just enough of an Executor, running each submission in a new thread"""
+    def submit(self, fn, *args, **kwargs):
+        result = {}
+        thread = threading.Thread(target=lambda: result.update(value=fn(*args, **kwargs)))
+        thread.start()
+        thread.join()
+        return result["value"]
+
+
+def _in_other_thread(fn):
+    return ThreadExecutor().submit(fn)
+
+
+@pytest.yield_fixture(autouse=True, params=("contextvars", "thread local"))
+def backend(request):
+    # run everything against the thread local fallback as well as contextvars, where the latter is available
+    if request.param == "contextvars":
+        if trace_context_module.contextvars is None:
+            pytest.skip("contextvars not available")
+        yield
+    else:
+        with mock.patch.object(trace_context_module, 'contextvars', None), \
+                mock.patch.object(trace_context_module, '_trace_context', trace_context_module._ThreadLocalVar()):
+            yield
+
+
+def test_no_trace_context_by_default():
+    assert get_trace_context() is None
+    assert get_trace_id() is None
+
+
+def test_set_and_reset_trace_context():
+    token = set_trace_context(TraceContext("trace-id", "span-id"))
+    try:
+        assert get_trace_context() == TraceContext("trace-id", "span-id")
+        assert get_trace_id() == "trace-id"
+    finally:
+        reset_trace_context(token)
+
+    assert get_trace_context() is None
+
+
+def test_trace_context_nests():
+    with trace_context("outer"):
+        with trace_context("inner", "span-id"):
+            assert get_trace_context() == TraceContext("inner", "span-id")
+        assert get_trace_id() == "outer"
+    assert get_trace_id() is None
+
+
+def test_trace_context_is_not_shared_with_other_threads():
+    with trace_context("trace-id"):
+        assert _in_other_thread(get_trace_id) is None
+
+
+def test_wrap_with_context_carries_trace_context_to_other_threads():
+    with trace_context("trace-id"):
+        wrapped = wrap_with_context(get_trace_id)
+
+    assert _in_other_thread(wrapped) == "trace-id"
+    assert get_trace_id() is None
+
+
+def test_wrapped_function_can_be_called_concurrently():
+    with trace_context("trace-id"):
+        wrapped = wrap_with_context(get_trace_id)
+
+    results = []
+    barrier = threading.Event()
+
+    def call():
+        barrier.wait()
+        results.append(wrapped())
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    barrier.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["trace-id"] * 4
+
+
+def test_submit_with_context():
+    executor = mock.Mock(wraps=ThreadExecutor())
+    with trace_context("trace-id"):
+        assert submit_with_context(executor, lambda suffix: get_trace_id() + suffix, "!") == "trace-id!"
+
+    assert executor.submit.call_args[0][1:] == ("!",)
+
+
+def test_request_id_init_app_sets_trace_context_for_each_request(app):
+    request_id.init_app(app)
+
+    @app.route('/')
+    def index():
+        return "{} {}".format(submit_with_context(ThreadExecutor(), get_trace_id), request.trace_id)
+
+    response = app.test_client().get('/', headers={'DM-Request-ID': 'from-header'})
+
+    assert response.get_data(as_text=True) == "from-header from-header"
+    assert get_trace_context() is None
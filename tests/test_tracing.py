@@ -0,0 +1,299 @@
+from __future__ import absolute_import
+
+import gc
+import json
+import logging
+import re
+
+from flask import request
+import mock
+import pytest
+
+from dmutils import request_id, tracing
+from dmutils.logging import JSONFormatter, LOG_FORMAT
+
+
+class ListSink(object):
+    def __init__(self):
+        self.batches = []
+
+    def send(self, spans):
+        self.batches.append(spans)
+
+    @property
+    def spans(self):
+        return [span for batch in self.batches for span in batch]
+
+
+@pytest.fixture
+def tracing_app(app):
+    app.config['DM_TRACING_ENABLED'] = True
+    request_id.init_app(app)
+    tracing.init_app(app)
+
+    @app.route('/')
+    def index():
+        return 'hello'
+
+    return app
+
+
+@pytest.fixture
+def sink(tracing_app):
+    tracer = tracing.get_tracer(tracing_app)
+    tracer.sink = ListSink()
+    return tracer.sink
+
+
+def test_generate_span_id():
+    assert re.match(r"^[0-9a-f]{16}$", tracing.generate_span_id())
+    assert tracing.generate_span_id() != tracing.generate_span_id()
+
+
+class TestSpan(object):
+    def test_to_zipkin(self):
+        tracer = tracing.Tracer(ListSink(), "my-app")
+        span = tracer.start_span("trace-id", span_id="span-id", parent_id="parent-id", name="GET index", kind="SERVER")
+        span.tags["http.status_code"] = 200
+        with mock.patch('dmutils.tracing.monotonic', return_value=span._start + 0.25):
+            span.finish()
+
+        assert span.to_zipkin() == {
+            "traceId": "trace-id",
+            "id": "span-id",
+            "parentId": "parent-id",
+            "name": "GET index",
+            "kind": "SERVER",
+            "timestamp": int(span.timestamp * 1000000),
+            "duration": 250000,
+            "localEndpoint": {"serviceName": "my-app"},
+            "tags": {"http.status_code": "200"},
+            "shared": True,
+        }
+
+    def test_span_started_without_an_id_gets_a_new_unshared_one(self):
+        span = tracing.Tracer(ListSink(), "my-app").start_span("trace-id")
+
+        assert re.match(r"^[0-9a-f]{16}$", span.span_id)
+        assert not span.shared
+        assert "shared" not in span.to_zipkin()
+        assert "parentId" not in span.to_zipkin()
+
+    def test_child(self):
+        parent = tracing.Tracer(ListSink(), "my-app").start_span("trace-id", span_id="span-id")
+        child = parent.child("onwards request", kind="CLIENT")
+
+        assert child.trace_id == "trace-id"
+        assert child.parent_id == "span-id"
+        assert child.span_id != "span-id"
+        assert child.kind == "CLIENT"
+
+    def test_finished_without_duration(self):
+        span = tracing.Tracer(ListSink(), "my-app").start_span("trace-id")
+        span.finish(record_duration=False)
+
+        assert "duration" not in span.to_zipkin()
+
+    def test_only_recorded_once(self):
+        tracer = tracing.Tracer(ListSink(), "my-app")
+        span = tracer.start_span("trace-id")
+        span.finish()
+        span.finish()
+        tracer.flush()
+
+        assert len(tracer.sink.spans) == 1
+
+    def test_context_manager_tags_errors(self):
+        tracer = tracing.Tracer(ListSink(), "my-app")
+        with pytest.raises(ValueError):
+            with tracer.start_span("trace-id"):
+                raise ValueError("oh no")
+        tracer.flush()
+
+        assert tracer.sink.spans[0]["tags"] == {"error": "oh no"}
+
+
+class TestTracer(object):
+    def test_flush_sends_in_batches(self):
+        tracer = tracing.Tracer(ListSink(), "my-app", batch_size=2, flush_interval=60)
+        with mock.patch.object(tracer, '_start_thread'):
+            for _ in range(5):
+                tracer.start_span("trace-id").finish()
+        tracer.flush()
+
+        assert [len(batch) for batch in tracer.sink.batches] == [2, 2, 1]
+
+    def test_spans_beyond_max_queue_size_are_dropped(self):
+        tracer = tracing.Tracer(ListSink(), "my-app", max_queue_size=2)
+        with mock.patch.object(tracer, '_start_thread'):
+            for _ in range(3):
+                tracer.start_span("trace-id").finish()
+        tracer.flush()
+
+        assert len(tracer.sink.spans) == 2
+        assert tracer.dropped == 1
+
+    def test_sink_errors_are_logged(self):
+        sink = mock.Mock()
+        sink.send.side_effect = IOError("collector unavailable")
+        tracer = tracing.Tracer(sink, "my-app")
+        with mock.patch.object(tracer, '_start_thread'):
+            tracer.start_span("trace-id").finish()
+
+        with mock.patch('dmutils.tracing.logger') as logger:
+            tracer.flush()
+
+        logger.exception.assert_called_once_with("Failed to export {count} spans", extra={'count': 1})
+
+    def test_background_thread_exports_full_batches(self):
+        tracer = tracing.Tracer(ListSink(), "my-app", batch_size=1, flush_interval=60)
+        tracer.start_span("trace-id").finish()
+        tracer.close()
+
+        assert len(tracer.sink.spans) == 1
+        assert not tracer._thread.is_alive()
+
+    def test_tracers_still_in_use_are_closed_at_exit(self):
+        tracer = tracing.Tracer(ListSink(), "my-app", flush_interval=60)
+        with mock.patch.object(tracer, '_start_thread'):
+            tracer.start_span("trace-id").finish()
+
+        tracing._close_tracers()
+
+        assert len(tracer.sink.spans) == 1
+        assert tracer._closed.is_set()
+
+    def test_discarded_tracers_are_garbage_collected_and_their_threads_stop(self):
+        tracer = tracing.Tracer(ListSink(), "discarded-app", flush_interval=0.01)
+        tracer.start_span("trace-id").finish()
+        thread = tracer._thread
+        del tracer
+        gc.collect()
+
+        thread.join(1)
+        assert not thread.is_alive()
+        assert not [t for t in tracing._tracer_instances if t.service_name == "discarded-app"]
+
+
+class TestSinks(object):
+    def test_log_sink_writes_a_json_line_per_batch(self):
+        buffer = []
+        handler = logging.Handler()
+        handler.emit = lambda record: buffer.append(handler.format(record))
+        handler.setFormatter(JSONFormatter(LOG_FORMAT))
+        logger = logging.getLogger('dmutils.tracing')
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        try:
+            tracing.LogSink().send([{"id": "span-id"}])
+        finally:
+            logger.removeHandler(handler)
+
+        [line] = buffer
+        assert json.loads(line)["message"] == "Exported 1 spans"
+        assert json.loads(line)["spans"] == [{"id": "span-id"}]
+
+    def test_zipkin_sink_posts_spans(self):
+        sink = tracing.ZipkinSink("http://zipkin:9411/api/v2/spans")
+        with mock.patch.object(sink, '_session') as session:
+            sink.send([{"id": "span-id"}])
+
+        session.post.assert_called_once_with(
+            "http://zipkin:9411/api/v2/spans", json=[{"id": "span-id"}], timeout=2,
+        )
+        session.post.return_value.raise_for_status.assert_called_once_with()
+
+
+class TestInitApp(object):
+    def test_disabled_by_default(self, app):
+        request_id.init_app(app)
+        tracing.init_app(app)
+
+        assert tracing.get_tracer(app) is None
+        with app.test_request_context('/', headers={'X-B3-SpanId': 'span-id'}):
+            app.preprocess_request()
+            assert request.get_onwards_request_headers() == {
+                'DM-Request-ID': request.trace_id,
+                'X-B3-TraceId': request.trace_id,
+                'X-B3-SpanId': 'span-id',
+            }
+
+    def test_uses_zipkin_sink_if_url_configured(self, app):
+        app.config['DM_TRACING_ENABLED'] = True
+        app.config['DM_TRACING_ZIPKIN_URL'] = "http://zipkin:9411/api/v2/spans"
+        tracing.init_app(app)
+
+        assert isinstance(tracing.get_tracer(app).sink, tracing.ZipkinSink)
+
+    def test_request_span(self, tracing_app, sink):
+        tracing_app.test_client().get('/', headers={
+            'DM-Request-ID': 'trace-id',
+            'X-B3-SpanId': 'span-id',
+            'X-B3-ParentSpan': 'parent-span-id',
+        })
+        tracing.get_tracer(tracing_app).flush()
+
+        [span] = sink.spans
+        assert span["traceId"] == "trace-id"
+        assert span["id"] == "span-id"
+        assert span["parentId"] == "parent-span-id"
+        assert span["name"] == "GET index"
+        assert span["kind"] == "SERVER"
+        assert span["shared"] is True
+        assert span["tags"] == {"http.path": "/", "http.status_code": "200"}
+        assert "duration" in span
+
+    def test_request_span_without_incoming_span_id_is_a_new_root(self, tracing_app, sink):
+        tracing_app.test_client().get('/')
+        tracing.get_tracer(tracing_app).flush()
+
+        [span] = sink.spans
+        assert "parentId" not in span
+        assert "shared" not in span
+
+    def test_onwards_request_headers_only_pass_on_the_request_span(self, tracing_app, sink):
+        with tracing_app.test_request_context('/', headers={'DM-Request-ID': 'trace-id', 'X-B3-SpanId': 'span-id'}):
+            tracing_app.preprocess_request()
+            headers = request.get_onwards_request_headers()
+            assert tracing.get_tracer(tracing_app)._queue == []
+
+        assert headers == {
+            'DM-Request-ID': 'trace-id',
+            'X-B3-TraceId': 'trace-id',
+            'X-B3-SpanId': 'span-id',
+        }
+
+    def test_onwards_request_headers_pass_on_a_new_root_span(self, tracing_app, sink):
+        with tracing_app.test_request_context('/'):
+            tracing_app.preprocess_request()
+            assert request.get_onwards_request_headers()['X-B3-SpanId'] == request.tracing_span.span_id
+
+    def test_onwards_request_span_is_a_child_of_the_request_span(self, tracing_app, sink):
+        with tracing_app.test_request_context('/', headers={'DM-Request-ID': 'trace-id', 'X-B3-SpanId': 'span-id'}):
+            tracing_app.preprocess_request()
+            with request.onwards_request_span() as headers:
+                pass
+        tracing.get_tracer(tracing_app).flush()
+
+        [onwards_span, request_span] = sink.spans
+        assert headers == {
+            'DM-Request-ID': 'trace-id',
+            'X-B3-TraceId': 'trace-id',
+            'X-B3-SpanId': onwards_span["id"],
+            'X-B3-ParentSpan': 'span-id',
+        }
+        assert onwards_span["parentId"] == "span-id"
+        assert onwards_span["kind"] == "CLIENT"
+        assert request_span["id"] == "span-id"
+
+    def test_onwards_request_span_is_timed(self, tracing_app, sink):
+        with tracing_app.test_request_context('/', headers={'X-B3-SpanId': 'span-id'}):
+            tracing_app.preprocess_request()
+            with request.onwards_request_span("get supplier") as headers:
+                assert headers['X-B3-ParentSpan'] == 'span-id'
+        tracing.get_tracer(tracing_app).flush()
+
+        [onwards_span, _] = sink.spans
+        assert onwards_span["id"] == headers['X-B3-SpanId']
+        assert onwards_span["name"] == "get supplier"
+        assert "duration" in onwards_span